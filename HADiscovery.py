@@ -1,15 +1,15 @@
-import json
-
 import yaml
 
-from utils import clean_international_text, now
+import jsoncodec
+from HCFeature import load_features
+from HCTopics import topics_for
+from utils import now
 
 CONTROL_COMPONENT_TYPES = ["switch", "number", "light", "button", "select"]
 
 
-def publish_ha_discovery(
-    discovery_yaml_path, device, device_state, client, mqtt_topic, events_as_sensors
-):
+def load_discovery_config(discovery_yaml_path):
+    """Return the discovery config, or the shipped discovery.yaml if it can't be loaded."""
     config = None
     try:
         with open(discovery_yaml_path, "r") as yaml_config:
@@ -27,6 +27,13 @@ def publish_ha_discovery(
             print(now(), "HADiscovery - unable to load fallback discovery.yaml")
             print("\t", e)
 
+    return config
+
+
+def publish_ha_discovery(
+    discovery_yaml_path, device, device_state, client, mqtt_topic, events_as_sensors
+):
+    config = load_discovery_config(discovery_yaml_path)
     if config is None:
         print(now(), "HADiscovery - unable to load discovery config, aborting...")
         return
@@ -41,7 +48,8 @@ def publish_ha_discovery(
 
     print(now(), f"HADiscovery - publishing MQTT discovery for {device['name']}")
 
-    device_ident = clean_international_text(device["name"])
+    topics = topics_for(mqtt_topic, device["name"])
+    device_ident = topics.ident
     device_description = device.get("description", {})
     base_topic = mqtt_topic.split("/")[0]
 
@@ -101,15 +109,15 @@ def publish_ha_discovery(
     if connections:
         device_info["connections"] = connections
 
+    features = load_features(device["features"])
+
     local_control_lockout = False
-    for key, value in device["features"].items():
-        value["uid"] = key
-        name = value.get("name", None)
-        if name is not None and name == "BSH.Common.Status.LocalControlActive":
+    for feature in features.values():
+        if feature.name == "BSH.Common.Status.LocalControlActive":
             print(now(), "HADiscovery - adding LocalControlActive availability topic")
             local_control_lockout = True
 
-    for feature in ADDITIONAL_FEATURES + list(device["features"].values()):
+    for feature in ADDITIONAL_FEATURES + list(features.values()):
         if "name" not in feature:
             continue  # TODO we could display things based on UID?
 
@@ -151,21 +159,21 @@ def publish_ha_discovery(
                 break
 
         uid = feature.get("uid", None)
-        feature_id = name.lower().replace(".", "_")
+        feature_id = topics.feature_id(name)
         refCID = feature.get("refCID", None)
         refDID = feature.get("refDID", None)
         handling = feature.get("handling", None)
         access = feature.get("access", "").lower()
         value = feature.get("value", None)
         values = feature.get("values", None)
-        state_topic = f"{mqtt_topic}/state/{feature_id}"
+        state_topic = topics.state(name)
 
         discovery_payload = {
             "name": friendly_name,
             "device": device_info,
             "state_topic": state_topic,
             "availability_mode": "all",
-            "availability": [{"topic": f"{base_topic}/LWT"}, {"topic": f"{mqtt_topic}/LWT"}],
+            "availability": [{"topic": f"{base_topic}/LWT"}, {"topic": topics.lwt}],
             "unique_id": f"{device_ident}_{feature_id}",
             "enabled_by_default": not disabled,
         }
@@ -199,7 +207,7 @@ def publish_ha_discovery(
                 discovery_payload["platform"] = "event"
                 discovery_payload.pop("value_template", None)
                 discovery_payload.pop("options", None)
-            discovery_payload["state_topic"] = f"{mqtt_topic}/event/{feature_id}"
+            discovery_payload["state_topic"] = topics.event(name)
         else:
             component_type = "sensor"
 
@@ -249,12 +257,12 @@ def publish_ha_discovery(
                     component_type = "light"
                 elif access == "writeonly" or override_component_type == "button":
                     component_type = "button"
-                    discovery_payload["command_topic"] = f"{mqtt_topic}/set"
+                    discovery_payload["command_topic"] = topics.set
                     discovery_payload["payload_press"] = f'[{{"uid":{uid},"value":true}}]'
                     discovery_payload.pop("value_template", None)
                 else:
                     component_type = "switch"
-                    discovery_payload["command_topic"] = f"{mqtt_topic}/set"
+                    discovery_payload["command_topic"] = topics.set
                     discovery_payload["state_on"] = True
                     discovery_payload["state_off"] = False
                     discovery_payload["payload_on"] = f'[{{"uid":{uid},"value":true}}]'
@@ -270,7 +278,7 @@ def publish_ha_discovery(
             ):
                 # some enums are just on/off so can be a binary_switch
                 component_type = "switch"
-                discovery_payload["command_topic"] = f"{mqtt_topic}/set"
+                discovery_payload["command_topic"] = topics.set
                 discovery_payload["state_on"] = "On"
                 discovery_payload["state_off"] = "Off"
                 discovery_payload["payload_on"] = f'[{{"uid":{uid},"value":"On"}}]'
@@ -279,7 +287,7 @@ def publish_ha_discovery(
             # 02/80 can be an enum e.g. Cooking.Oven.Option.Doneness
             elif refDID == "80" and (refCID in ("02", "03")) and values is not None:
                 component_type = "select"
-                discovery_payload["command_topic"] = f"{mqtt_topic}/set"
+                discovery_payload["command_topic"] = topics.set
                 template = f'[{{"uid":{uid},"value":"{{{{value}}}}"}}]'
                 discovery_payload["command_template"] = template
             # numbers
@@ -297,7 +305,7 @@ def publish_ha_discovery(
                 or override_component_type == "number"
             ):
                 component_type = "number"
-                discovery_payload["command_topic"] = f"{mqtt_topic}/set"
+                discovery_payload["command_topic"] = topics.set
                 template = f'[{{"uid":{uid},"value":{{{{value}}}}}}]'
                 discovery_payload["command_template"] = template
 
@@ -321,20 +329,20 @@ def publish_ha_discovery(
         ):
             component_type = "select"
             options = []
-            for k, v in device["features"].items():
-                if "name" in v and (
-                    "Dishcare.Dishwasher.Program." in v["name"]
-                    or "Cooking.Common.Program.Hood." in v["name"]
-                    or "ConsumerProducts.CoffeeMaker.Program." in v["name"]
-                    or "ConsumerProducts.CleaningRobot.Program." in v["name"]
-                    or "LaundryCare.Dryer.Program." in v["name"]
-                    or "LaundryCare.Washer.Program." in v["name"]
-                    or "LaundryCare.WasherDryer.Program." in v["name"]
-                    or "Cooking.Oven.Program." in v["name"]
-                    or "Cooking.Hob.Program." in v["name"]
-                    or "BSH.Common.Program.Favorite." in v["name"]
+            for v in features.values():
+                if v.name is not None and (
+                    "Dishcare.Dishwasher.Program." in v.name
+                    or "Cooking.Common.Program.Hood." in v.name
+                    or "ConsumerProducts.CoffeeMaker.Program." in v.name
+                    or "ConsumerProducts.CleaningRobot.Program." in v.name
+                    or "LaundryCare.Dryer.Program." in v.name
+                    or "LaundryCare.Washer.Program." in v.name
+                    or "LaundryCare.WasherDryer.Program." in v.name
+                    or "Cooking.Oven.Program." in v.name
+                    or "Cooking.Hob.Program." in v.name
+                    or "BSH.Common.Program.Favorite." in v.name
                 ):
-                    options.append(v["name"].split(".")[-1])
+                    options.append(v.name.split(".")[-1])
 
             if len(options) < 1:
                 continue
@@ -342,20 +350,20 @@ def publish_ha_discovery(
             discovery_payload["options"] = options
             discovery_payload["command_template"] = '[{"program":"{{value}}","options":[]}]'
             if name == "BSH.Common.Root.ActiveProgram":
-                discovery_payload["command_topic"] = f"{mqtt_topic}/activeProgram"
+                discovery_payload["command_topic"] = topics.active_program
             elif name == "BSH.Common.Root.SelectedProgram":
-                discovery_payload["command_topic"] = f"{mqtt_topic}/selectedProgram"
+                discovery_payload["command_topic"] = topics.selected_program
             elif name == "BSH.Common.Option.BaseProgram":
                 discovery_payload["command_template"] = (
                     f'[{{"uid":{uid},"value":"{{{{value}}}}"}}]'
                 )
-                discovery_payload["command_topic"] = f"{mqtt_topic}/set"
+                discovery_payload["command_topic"] = topics.set
 
         if component_type in CONTROL_COMPONENT_TYPES:
             if local_control_lockout:
                 discovery_payload["availability"] = discovery_payload["availability"] + [
                     {
-                        "topic": f"{mqtt_topic}/state/bsh_common_status_localcontrolactive",
+                        "topic": topics.state("BSH.Common.Status.LocalControlActive"),
                         "payload_available": "False",
                         "payload_not_available": "True",
                     }
@@ -365,9 +373,7 @@ def publish_ha_discovery(
             f"{component_type}.{discovery_payload['unique_id']}"
         )
 
-        discovery_topic = clean_international_text(
-            f"{HA_DISCOVERY_PREFIX}/{component_type}/hcpy/{device_ident}_{feature_id}/config"
-        )
+        discovery_topic = topics.discovery(HA_DISCOVERY_PREFIX, component_type, name)
 
         if overrides:
             # Overwrite keys with override values
@@ -376,4 +382,4 @@ def publish_ha_discovery(
                     overrides[k] = v.replace("DEVICE_NAME", device_ident)
             discovery_payload = discovery_payload | overrides
 
-        client.publish(discovery_topic, json.dumps(discovery_payload), retain=True)
+        client.publish(discovery_topic, jsoncodec.dumps(discovery_payload), retain=True)
@@ -0,0 +1,542 @@
+# asyncio versions of HCSocket and HCDevice
+#
+# One event loop can drive many appliances: every connection is a task on
+# the loop instead of a websocket-client thread, a handshake thread and a
+# coalescing timer thread. The framing, the HTTP-mode AES/HMAC chain, the
+# TLS-PSK contexts and sessions and all the protocol handling are shared with
+# the threaded classes, which stay the default.
+#
+# The websocket client is a minimal RFC 6455 implementation, enough for the
+# appliances: one upgrade request, masked client frames, fragmented messages,
+# ping/pong and close. TLS runs over a memory BIO so that sslpsk can set its
+# PSK callback on the SSLObject before the handshake.
+
+import asyncio
+import base64
+import hashlib
+import os
+import ssl
+import struct
+import threading
+import time
+import traceback
+
+from HCDevice import SERVICES_TIMEOUT, HCDevice
+from HCSocket import (
+    CONNECT_ATTEMPT_DELAY,
+    CONNECT_TIMEOUT,
+    TLS_TIMEOUT,
+    UPGRADE_TIMEOUT,
+    HCSocket,
+    encode_frame,
+    set_keepalive,
+    tls_psk_mechanism,
+)
+from HCStats import FrameStats
+from utils import now
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+MAX_HEADER_SIZE = 16384
+
+
+def websocket_accept(key):
+    """Return the Sec-WebSocket-Accept value for a Sec-WebSocket-Key."""
+    return base64.b64encode(hashlib.sha1(key.encode() + WEBSOCKET_GUID).digest()).decode()
+
+
+def mask_payload(mask, payload):
+    size = len(payload)
+    if size == 0:
+        return b""
+    key = int.from_bytes((mask * (size // 4 + 1))[0:size], "big")
+    return (int.from_bytes(payload, "big") ^ key).to_bytes(size, "big")
+
+
+def encode_ws_frame(opcode, payload, mask=True):
+    """Build a single final websocket frame, masked as a client must send it."""
+    size = len(payload)
+    header = bytearray([0x80 | opcode])
+    mask_bit = 0x80 if mask else 0
+    if size < 126:
+        header.append(mask_bit | size)
+    elif size < 65536:
+        header.append(mask_bit | 126)
+        header += struct.pack("!H", size)
+    else:
+        header.append(mask_bit | 127)
+        header += struct.pack("!Q", size)
+    if mask:
+        key = os.urandom(4)
+        header += key
+        payload = mask_payload(key, payload)
+    return bytes(header) + payload
+
+
+async def read_ws_frame(read_exactly):
+    """Read one websocket frame, returns (fin, opcode, payload)."""
+    head = await read_exactly(2)
+    fin = bool(head[0] & 0x80)
+    opcode = head[0] & 0x0F
+    size = head[1] & 0x7F
+    if size == 126:
+        (size,) = struct.unpack("!H", await read_exactly(2))
+    elif size == 127:
+        (size,) = struct.unpack("!Q", await read_exactly(8))
+    mask = await read_exactly(4) if head[1] & 0x80 else None
+    payload = await read_exactly(size) if size else b""
+    if mask is not None:
+        payload = mask_payload(mask, payload)
+    return fin, opcode, payload
+
+
+async def open_connection_staggered(addresses, delay=CONNECT_ATTEMPT_DELAY):
+    """Asyncio version of HCSocket.connect_staggered, returning reader, writer and address."""
+    queue = list(addresses)
+    attempts = {}
+    error = None
+    try:
+        while queue or attempts:
+            if queue:
+                address = queue.pop(0)[4]
+                connect = asyncio.open_connection(address[0], address[1])
+                attempts[asyncio.ensure_future(connect)] = address
+            done, _ = await asyncio.wait(
+                attempts, timeout=delay if queue else None, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                address = attempts.pop(task)
+                if task.exception() is None:
+                    reader, writer = task.result()
+                    return reader, writer, address
+                error = task.exception()
+        raise error or OSError("no address to connect to")
+    finally:
+        for task in attempts:
+            if task.done() and not task.cancelled() and task.exception() is None:
+                task.result()[1].close()
+            else:
+                task.cancel()
+
+
+class PlainStream:
+    """The reader/writer pair of a plain TCP connection."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    async def read(self):
+        return await self.reader.read(65536)
+
+    def write(self, data):
+        self.writer.write(data)
+
+    def close(self):
+        self.writer.close()
+
+
+class TLSStream(PlainStream):
+    """TLS over a reader/writer pair through a memory BIO."""
+
+    def __init__(self, reader, writer, context, server_hostname=None, session=None):
+        super().__init__(reader, writer)
+        self.incoming = ssl.MemoryBIO()
+        self.outgoing = ssl.MemoryBIO()
+        self.ssl_obj = context.wrap_bio(
+            self.incoming, self.outgoing, server_hostname=server_hostname, session=session
+        )
+
+    def _flush(self):
+        data = self.outgoing.read()
+        if data:
+            self.writer.write(data)
+
+    async def _fill(self):
+        data = await self.reader.read(65536)
+        if not data:
+            self.incoming.write_eof()
+        else:
+            self.incoming.write(data)
+
+    async def handshake(self):
+        while True:
+            try:
+                self.ssl_obj.do_handshake()
+                break
+            except ssl.SSLWantReadError:
+                self._flush()
+                await self._fill()
+        self._flush()
+
+    async def read(self):
+        while True:
+            try:
+                return self.ssl_obj.read(65536)
+            except ssl.SSLWantReadError:
+                self._flush()
+                await self._fill()
+            except (ssl.SSLEOFError, ssl.SSLZeroReturnError):
+                return b""
+
+    def write(self, data):
+        self.ssl_obj.write(data)
+        self._flush()
+
+
+class AsyncHCSocket(HCSocket):
+    """HCSocket on asyncio streams.
+
+    send() and close() may be called from any thread, they hand the frames to
+    the event loop in the order they were encrypted.
+    """
+
+    def __init__(self, host, psk64, iv64=None, domain_suffix="", debug=False, port=None):
+        super().__init__(host, psk64, iv64, domain_suffix, debug, port)
+        self.stream = None
+        self.loop = None
+        self._buffer = bytearray()
+        self._send_lock = threading.Lock()
+        self._outbox = []
+        self._closing = False
+
+    async def connect(self):
+        self.reset()
+        self.timings = {}
+        self.frame_stats = FrameStats()
+        self.loop = asyncio.get_running_loop()
+        self._buffer = bytearray()
+        self._closing = False
+
+        self.dprint("connecting to tcp socket: " + self.host + ":" + str(self.port))
+        start = time.monotonic()
+        addresses = self.resolver.cached(self.host, self.port)
+        if addresses is None:
+            addresses = await self.loop.run_in_executor(
+                None, self.resolver.resolve, self.host, self.port
+            )
+        self.timings["resolve"] = time.monotonic() - start
+
+        start = time.monotonic()
+        try:
+            reader, writer, address = await asyncio.wait_for(
+                open_connection_staggered(addresses), CONNECT_TIMEOUT
+            )
+        except (OSError, asyncio.TimeoutError):
+            self.resolver.failed(self.host, self.port)
+            raise
+        self.resolver.remember(self.host, self.port, address)
+        self.timings["connect"] = time.monotonic() - start
+        set_keepalive(writer.get_extra_info("socket"))
+        self.dprint("connected to tcp socket: " + self.host + ":" + str(self.port))
+
+        try:
+            if self.http:
+                self.stream = PlainStream(reader, writer)
+            else:
+                self.stream = await asyncio.wait_for(self.start_tls(reader, writer), TLS_TIMEOUT)
+
+            start = time.monotonic()
+            await asyncio.wait_for(self.upgrade(), UPGRADE_TIMEOUT)
+            self.timings["upgrade"] = time.monotonic() - start
+        except BaseException:
+            self.stream = None
+            writer.close()
+            raise
+        phases = " ".join(f"{phase} {t * 1000:.0f}ms" for phase, t in self.timings.items())
+        self.dprint("OPEN:", self.uri, phases)
+        if self.recorder is not None:
+            self.recorder.opened(self.uri)
+
+    async def start_tls(self, reader, writer):
+        mechanism = tls_psk_mechanism()
+        if mechanism is None:
+            raise NotImplementedError("No suitable TLS-PSK mechanism is available.")
+        self.dprint(f"wrapping socket with {mechanism} TLS-PSK")
+        start = time.monotonic()
+        server_hostname = self.host if mechanism == "native" else None
+        stream = TLSStream(reader, writer, self.tls_context(), server_hostname, self.tls_session())
+        if mechanism == "sslpsk":
+            self.set_sslpsk_callback(stream.ssl_obj)
+        try:
+            await stream.handshake()
+        except Exception:
+            self.forget_tls_session()
+            raise
+        self.tls_established(stream.ssl_obj, start)
+        return stream
+
+    async def read_exactly(self, size):
+        while len(self._buffer) < size:
+            data = await self.stream.read()
+            if not data:
+                raise ConnectionError("connection closed by the appliance")
+            self._buffer += data
+        data = bytes(self._buffer[0:size])
+        del self._buffer[0:size]
+        return data
+
+    async def upgrade(self):
+        key = base64.b64encode(os.urandom(16)).decode()
+        request = (
+            "GET /homeconnect HTTP/1.1\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n"
+            "\r\n"
+        )
+        self.stream.write(request.encode())
+
+        while b"\r\n\r\n" not in self._buffer:
+            if len(self._buffer) > MAX_HEADER_SIZE:
+                raise ConnectionError("websocket upgrade response too long")
+            data = await self.stream.read()
+            if not data:
+                raise ConnectionError("connection closed during the websocket upgrade")
+            self._buffer += data
+        end = self._buffer.index(b"\r\n\r\n") + 4
+        lines = bytes(self._buffer[0:end]).decode("latin-1").split("\r\n")
+        del self._buffer[0:end]
+
+        status = lines[0].split(" ", 2)
+        if len(status) < 2 or status[1] != "101":
+            raise ConnectionError(f"websocket upgrade failed: {lines[0]}")
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        if headers.get("sec-websocket-accept") != websocket_accept(key):
+            raise ConnectionError("websocket upgrade failed: bad Sec-WebSocket-Accept")
+
+    async def recv(self):
+        """Return the next message, decrypted in HTTP mode, or None once the socket closes."""
+        opcode = None
+        fragments = []
+        while True:
+            fin, frame_opcode, payload = await read_ws_frame(self.read_exactly)
+            self.keepalive.received()
+            if frame_opcode == OPCODE_PING:
+                self.write_frame(OPCODE_PONG, payload)
+                continue
+            if frame_opcode == OPCODE_PONG:
+                rtt = self.keepalive.pong(payload)
+                if rtt is not None:
+                    self.dprint(f"pong in {rtt * 1000:.1f}ms")
+                continue
+            if frame_opcode == OPCODE_CLOSE:
+                self.dprint(f"close: {payload[2:]!r}")
+                self.close()
+                return None
+            if frame_opcode != OPCODE_CONTINUATION:
+                opcode = frame_opcode
+                fragments = []
+            fragments.append(payload)
+            if fin:
+                break
+
+        message = b"".join(fragments)
+        self.frame_stats.received(len(message))
+        if self.http:
+            message = self.decrypt(message)
+        elif opcode == OPCODE_TEXT:
+            message = message.decode("utf-8")
+        self.dprint("RX:", message)
+        if self.recorder is not None and message is not None:
+            self.recorder.received(message)
+        return message
+
+    # Queue a frame and write the queue from the event loop, keeping the order
+    def write_frame(self, opcode, payload):
+        with self._send_lock:
+            if self.stream is None or self._closing:
+                raise ConnectionError("websocket is not connected")
+            self._outbox.append(encode_ws_frame(opcode, payload))
+        self._call_in_loop(self._flush_outbox)
+
+    def _flush_outbox(self):
+        with self._send_lock:
+            frames = self._outbox
+            self._outbox = []
+        if self.stream is None:
+            return
+        for frame in frames:
+            self.stream.write(frame)
+
+    def _call_in_loop(self, func):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            func()
+        else:
+            self.loop.call_soon_threadsafe(func)
+
+    def send(self, msg):
+        buf = encode_frame(msg)
+        self.dprint("TX:", buf)
+        with self._send_lock:
+            # The HTTP-mode chain must be encrypted in the order the frames are sent
+            if self.http:
+                payload = self.encrypt(buf)
+                frame = encode_ws_frame(OPCODE_BINARY, payload)
+            else:
+                payload = buf.encode("utf-8")
+                frame = encode_ws_frame(OPCODE_TEXT, payload)
+            if self.stream is None or self._closing:
+                raise ConnectionError("websocket is not connected")
+            self._outbox.append(frame)
+        self.frame_stats.sent(len(payload))
+        if self.recorder is not None:
+            self.recorder.sent(buf)
+        self._call_in_loop(self._flush_outbox)
+
+    # Same keepalive as KeepAliveDispatcher in the threaded HCSocket
+    async def ping_loop(self):
+        keepalive = self.keepalive
+        keepalive.connected()
+        while True:
+            await asyncio.sleep(keepalive.poll_timeout())
+            action = keepalive.check()
+            if action == "ping":
+                self.write_frame(OPCODE_PING, keepalive.ping())
+            elif action == "dead":
+                self.dprint("ping/pong timed out")
+                self.close()
+                return
+
+    def close(self):
+        if self.stream is None or self._closing:
+            return
+        try:
+            self.write_frame(OPCODE_CLOSE, struct.pack("!H", 1000))
+        except ConnectionError:
+            pass
+        self._closing = True
+        self._call_in_loop(self._close_stream)
+
+    def _close_stream(self):
+        if self.stream is not None:
+            self.stream.close()
+
+    async def run(self, on_message, on_open, on_close):
+        """Connect, then call on_message for every message until the socket closes."""
+        print(now(), "CON:", self.uri)
+        try:
+            await self.connect()
+        except Exception as e:
+            self.dprint(f"socket connection failed: {e!r}")
+            return
+
+        ping_loop = asyncio.ensure_future(self.ping_loop())
+        code = None
+        try:
+            on_open(self)
+            while True:
+                try:
+                    message = await self.recv()
+                except (ConnectionError, asyncio.IncompleteReadError, ssl.SSLError) as e:
+                    self.dprint(f"error {e!r}")
+                    break
+                if message is None:
+                    if self._closing:
+                        code = 1000
+                        break
+                    continue
+                on_message(self, message)
+        finally:
+            ping_loop.cancel()
+            stream = self.stream
+            self.stream = None
+            if stream is not None:
+                stream.close()
+            on_close(self, code, None)
+
+
+class ThreadsafeTimer:
+    """loop.call_later from another thread, which can also be cancelled from any thread."""
+
+    def __init__(self, loop, delay, func):
+        self.loop = loop
+        self.cancelled = False
+        self._handle = None
+        loop.call_soon_threadsafe(self._schedule, delay, func)
+
+    def _schedule(self, delay, func):
+        if not self.cancelled:
+            self._handle = self.loop.call_later(delay, func)
+
+    def _cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+
+    def cancel(self):
+        self.cancelled = True
+        try:
+            self.loop.call_soon_threadsafe(self._cancel)
+        except RuntimeError:
+            # The loop is closed, nothing will run anyway
+            pass
+
+
+class AsyncHCDevice(HCDevice):
+    """HCDevice driven by an AsyncHCSocket on an asyncio event loop."""
+
+    # The handshake runs as a task on the loop instead of a thread
+    def start_handshake(self):
+        asyncio.ensure_future(self.async_reconnect())
+
+    async def async_reconnect(self):
+        start = time.monotonic()
+        request = self.get("/ci/services", timeout=SERVICES_TIMEOUT)
+        try:
+            await asyncio.wrap_future(request)
+        except Exception as e:
+            self.print(f"no /ci/services response ({e!r}), closing connection")
+            self.ws.close()
+            return
+        if not self._services_event.is_set():
+            self.print("timeout waiting for /ci/services, closing connection")
+            self.ws.close()
+            return
+        self.request_device_info(start)
+
+    # Run func after delay seconds on the event loop, from any thread
+    def call_later(self, delay, func):
+        loop = self.ws.loop
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            return loop.call_later(delay, func)
+        return ThreadsafeTimer(loop, delay, func)
+
+    async def run(self, on_message, on_open, on_close):
+        def _on_message(ws, message):
+            try:
+                values = self.handle_message(message)
+            except Exception as e:
+                self.print("error handling msg", e, message, traceback.format_exc())
+                return
+            on_message(values)
+
+        def _on_open(ws):
+            self.connected = True
+            on_open(ws)
+
+        def _on_close(ws, code, message):
+            self.connected = False
+            self.fail_requests(ConnectionError("websocket closed"))
+            on_close(ws, code, message)
+
+        await self.ws.run(on_message=_on_message, on_open=_on_open, on_close=_on_close)
@@ -0,0 +1,271 @@
+# Crypto for the websocket frames of HTTP (port 80) Home Connect appliances
+#
+# The frames are AES-CBC encrypted and signed with a chained HMAC-SHA256, see
+# FrameCodec. The primitives come from a backend: pycryptodome, which hcpy
+# requires, is the default. Its HMAC comes from the standard library, since
+# pycryptodome's costs several times more to copy and update for each frame.
+# When the OpenSSL-backed cryptography package is installed it is selected
+# instead, provided its self-test produces frames byte-identical to
+# pycryptodome.
+
+import abc
+import hashlib
+import hmac as stdlib_hmac
+import os
+import sys
+
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+
+try:
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives import hmac as crypto_hmac
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+# Direction bytes mixed into the frame HMAC
+DEVICE_TO_CLIENT = b"\x43"
+CLIENT_TO_DEVICE = b"\x45"
+
+
+class CryptoBackend(abc.ABC):
+    """The primitives used by FrameCodec and the HTTP-mode key derivation."""
+
+    name = None
+
+    @abc.abstractmethod
+    def cbc_encryptor(self, key, iv):
+        """Return a function that AES-CBC encrypts block aligned data.
+
+        The CBC chain continues from one call to the next.
+        """
+
+    @abc.abstractmethod
+    def cbc_decryptor(self, key, iv):
+        """Return a function that AES-CBC decrypts block aligned data, chaining like above."""
+
+    @abc.abstractmethod
+    def hmac(self, key, msg=b""):
+        """Return an HMAC-SHA256 of msg with update(), copy() and digest()."""
+
+    @abc.abstractmethod
+    def random_bytes(self, n):
+        """Return n random bytes."""
+
+
+class PycryptodomeBackend(CryptoBackend):
+    name = "pycryptodome"
+
+    def cbc_encryptor(self, key, iv):
+        return AES.new(key, AES.MODE_CBC, iv).encrypt
+
+    def cbc_decryptor(self, key, iv):
+        return AES.new(key, AES.MODE_CBC, iv).decrypt
+
+    def hmac(self, key, msg=b""):
+        # hashlib's HMAC, pycryptodome's is several times slower to copy and update
+        return stdlib_hmac.new(key, msg, hashlib.sha256)
+
+    def random_bytes(self, n):
+        return get_random_bytes(n)
+
+
+class _CryptographyHMAC:
+    __slots__ = ("_mac",)
+
+    def __init__(self, mac):
+        self._mac = mac
+
+    def update(self, data):
+        self._mac.update(data)
+
+    def copy(self):
+        return _CryptographyHMAC(self._mac.copy())
+
+    def digest(self):
+        return self._mac.finalize()
+
+
+class CryptographyBackend(CryptoBackend):
+    name = "cryptography"
+
+    def cbc_encryptor(self, key, iv):
+        return Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor().update
+
+    def cbc_decryptor(self, key, iv):
+        return Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor().update
+
+    def hmac(self, key, msg=b""):
+        mac = crypto_hmac.HMAC(key, hashes.SHA256())
+        mac.update(msg)
+        return _CryptographyHMAC(mac)
+
+    def random_bytes(self, n):
+        return os.urandom(n)
+
+
+class FrameCodec:
+    """AES-CBC encryption and chained HMAC of the HTTP (port 80) websocket frames.
+
+    Every frame is AES-CBC encrypted, continuing the cipher state of the
+    previous frame, and followed by the first 16 bytes of
+    HMAC(mackey, iv + direction + previous hmac + ciphertext). The HMAC keyed
+    with the iv prefix is computed once and copied for every frame, and
+    received frames are split with memoryviews instead of being copied.
+
+    rx and tx are the direction bytes of received and sent frames, a device
+    side codec swaps them.
+    """
+
+    def __init__(self, enckey, mackey, iv, rx=DEVICE_TO_CLIENT, tx=CLIENT_TO_DEVICE, backend=None):
+        self.enckey = enckey
+        self.iv = iv
+        self.rx = rx
+        self.tx = tx
+        self.backend = backend or default_backend
+        self.random_bytes = self.backend.random_bytes
+        self._mac = self.backend.hmac(mackey, iv)
+        self.hmac_failures = 0
+        self.reset()
+
+    # restore the encryption state for a fresh connection
+    def reset(self):
+        self.last_rx_hmac = bytes(16)
+        self.last_tx_hmac = bytes(16)
+        self.aes_encrypt = self.backend.cbc_encryptor(self.enckey, self.iv)
+        self.aes_decrypt = self.backend.cbc_decryptor(self.enckey, self.iv)
+
+    # hmac an inbound or outbound message, chaining the last hmac too
+    def sign(self, direction, last_hmac, enc_msg):
+        mac = self._mac.copy()
+        mac.update(direction)
+        mac.update(last_hmac)
+        mac.update(enc_msg)
+        return mac.digest()[0:16]
+
+    def decrypt(self, buf):
+        if len(buf) < 32:
+            print("Short message?", buf.hex(), file=sys.stderr)
+            return None
+        if len(buf) % 16 != 0:
+            print("Unaligned message? probably bad", buf.hex(), file=sys.stderr)
+
+        # split the message into the encrypted message and the first 16-bytes of the HMAC
+        frame = memoryview(buf)
+        enc_msg = frame[0:-16]
+        their_hmac = bytes(frame[-16:])
+
+        # compute the expected hmac on the encrypted message
+        our_hmac = self.sign(self.rx, self.last_rx_hmac, enc_msg)
+
+        if their_hmac != our_hmac:
+            self.hmac_failures += 1
+            print("HMAC failure", their_hmac.hex(), our_hmac.hex(), file=sys.stderr)
+            return None
+
+        self.last_rx_hmac = their_hmac
+
+        # decrypt the message with CBC, so the last message block is mixed in
+        msg = self.aes_decrypt(enc_msg)
+
+        # check for padding and trim it off the end
+        pad_len = msg[-1]
+        if len(msg) < pad_len:
+            print("padding error?", msg.hex())
+            return None
+
+        return msg[0:-pad_len]
+
+    def encrypt(self, clear_msg):
+        # convert the UTF-8 string into a byte array that the padding is appended to
+        clear_msg = bytearray(clear_msg, "utf-8")
+
+        # pad the buffer, adding an extra block if necessary
+        pad_len = 16 - (len(clear_msg) % 16)
+        if pad_len == 1:
+            pad_len += 16
+        clear_msg.append(0)
+        clear_msg += self.random_bytes(pad_len - 2)
+        clear_msg.append(pad_len)
+
+        # encrypt the padded message with CBC, so there is chained
+        # state from the last cipher block sent
+        enc_msg = self.aes_encrypt(clear_msg)
+
+        # compute the hmac of the encrypted message, chaining the
+        # hmac of the previous message plus the direction
+        self.last_tx_hmac = self.sign(self.tx, self.last_tx_hmac, enc_msg)
+
+        # append the new hmac to the message
+        return enc_msg + self.last_tx_hmac
+
+
+BACKENDS = {"pycryptodome": PycryptodomeBackend()}
+if Cipher is not None:
+    BACKENDS["cryptography"] = CryptographyBackend()
+
+
+def self_test(candidate, reference=None):
+    """Check that a backend produces the same frames as the reference backend.
+
+    Both encrypt the same session with the same padding. Every frame must be
+    byte-identical, including the chained HMAC, and must decrypt on the other
+    side.
+    """
+    reference = reference or BACKENDS["pycryptodome"]
+    psk = bytes(range(32))
+    iv = bytes(range(16, 32))
+    texts = ['{"sID":%d,"data":"%s"}' % (i, "x" * (i * 7 % 53)) for i in range(24)]
+
+    def padding(n):
+        return bytes(range(n))
+
+    try:
+        enckey = candidate.hmac(psk, b"ENC").digest()
+        mackey = candidate.hmac(psk, b"MAC").digest()
+        if (enckey, mackey) != (
+            reference.hmac(psk, b"ENC").digest(),
+            reference.hmac(psk, b"MAC").digest(),
+        ):
+            return False
+
+        ours = FrameCodec(enckey, mackey, iv, backend=candidate)
+        theirs = FrameCodec(enckey, mackey, iv, backend=reference)
+        device = FrameCodec(
+            enckey, mackey, iv, rx=CLIENT_TO_DEVICE, tx=DEVICE_TO_CLIENT, backend=reference
+        )
+        ours.random_bytes = theirs.random_bytes = padding
+        for text in texts:
+            frame = ours.encrypt(text)
+            if frame != theirs.encrypt(text):
+                return False
+            if device.decrypt(frame) != text.encode():
+                return False
+            if ours.decrypt(device.encrypt(text)) != text.encode():
+                return False
+    except Exception as e:
+        print(f"{candidate.name} crypto self-test failed: {e!r}", file=sys.stderr)
+        return False
+    return True
+
+
+def set_backend(name):
+    """Select the backend used by new FrameCodecs, "pycryptodome" or "cryptography"."""
+    global default_backend
+    if name not in BACKENDS:
+        raise ValueError(f"Crypto backend {name} is not available")
+    default_backend = BACKENDS[name]
+
+
+if "cryptography" in BACKENDS and self_test(BACKENDS["cryptography"]):
+    set_backend("cryptography")
+else:
+    set_backend("pycryptodome")
+
+
+if __name__ == "__main__":
+    for name, candidate in BACKENDS.items():
+        result = "ok" if self_test(candidate) else "FAILED"
+        print(f"{name}: {result}")
+    print(f"selected: {default_backend.name}")
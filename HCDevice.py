@@ -40,23 +40,197 @@
 #
 # /iz/services
 
-import json
+import bisect
+import heapq
+import itertools
 import re
 import sys
 import threading
+import time
 import traceback
 from base64 import urlsafe_b64encode as base64url_encode
+from concurrent.futures import Future
 
 from Crypto.Random import get_random_bytes
 
+import jsoncodec
+from HCFeature import Feature, enum_index, load_features
+from HCState import DeviceState
+from HCStats import TimingStats
 from utils import now
 
+# Seconds to wait for the RESPONSE to a request
+REQUEST_TIMEOUT = 30
+# Seconds to wait for the /ci/services RESPONSE before giving up on a connection
+SERVICES_TIMEOUT = 10
+
+# Error codes returned by the appliances in the "code" field of a RESPONSE
+ERROR_CODES = {
+    400: "bad request",
+    403: "forbidden",
+    404: "unknown resource",
+    405: "action not allowed",
+    409: "conflict",
+    500: "internal error",
+    503: "busy",
+}
+
+
+class HCDeviceError(Exception):
+    """The appliance answered a request with an error code."""
+
+    def __init__(self, code, resource):
+        self.code = code
+        self.resource = resource
+        description = ERROR_CODES.get(code, "error")
+        super().__init__(f"{resource} failed with {description} ({code})")
+
+
+# Feature name lookups remembered per snapshot, names come from MQTT so
+# unknown ones mustn't grow the memo forever
+MAX_UID_QUERIES = 4096
+
+# Features whose value is the UID of a program
+PROGRAM_FEATURES = (
+    "BSH.Common.Root.SelectedProgram",
+    "BSH.Common.Root.ActiveProgram",
+    "BSH.Common.Option.BaseProgram",
+)
+
+
+class Timer:
+    """A callback scheduled by Timers.call_later."""
+
+    __slots__ = ("func", "cancelled")
+
+    def __init__(self, func):
+        self.func = func
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Timers:
+    """Run callbacks after a delay on one thread, instead of a thread per callback.
+
+    The thread is started when a callback is scheduled and exits once none are left.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self._condition = threading.Condition()
+        # (monotonic due time, sequence, Timer), earliest first
+        self._heap = []
+        self._sequence = itertools.count()
+        self._thread = None
+
+    def call_later(self, delay, func):
+        timer = Timer(func)
+        with self._condition:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._sequence), timer))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return timer
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if not self._heap:
+                        self._thread = None
+                        return
+                    due, _, timer = self._heap[0]
+                    delay = due - time.monotonic()
+                    if delay <= 0:
+                        heapq.heappop(self._heap)
+                        break
+                    self._condition.wait(delay)
+
+            if timer.cancelled:
+                continue
+            try:
+                timer.func()
+            except Exception:
+                print(now(), self.name, "timer failed", traceback.format_exc())
+
+
+class FeatureSnapshot:
+    """An immutable view of a device's features and the lookup tables built from them.
+
+    HCDevice never changes a published snapshot. Writers build a new one and swap
+    it in, so readers can use whichever snapshot they picked up without a lock.
+    """
+
+    __slots__ = ("features", "uid_by_query", "decoders", "names", "name_offsets", "name_uids")
+
+    def __init__(self, features, compile_decoder, base=None, added=None):
+        self.features = features
+        if base is None:
+            self.uid_by_query = {}
+            self.decoders = {}
+            added = features
+        elif not added:
+            # Changed attributes don't change names or decoders, so share them
+            self.uid_by_query = base.uid_by_query
+            self.decoders = base.decoders
+            self.names = base.names
+            self.name_offsets = base.name_offsets
+            self.name_uids = base.name_uids
+        else:
+            # Features are only ever appended, so a name that was found is
+            # still found first. A name that wasn't may match an added feature.
+            self.uid_by_query = {
+                query: uid for query, uid in base.uid_by_query.items() if uid is not None
+            }
+            self.decoders = dict(base.decoders)
+
+        for uid in added:
+            self.decoders[features[uid].uid] = compile_decoder(uid, features[uid])
+
+        if base is None or added:
+            # Every name in one string, so a lookup is a single str.find().
+            # Names have no newlines, so a match never spans two of them.
+            self.name_uids = [k for k, v in features.items() if v.name is not None]
+            names = [features[k].name for k in self.name_uids]
+            self.names = "\n".join(names)
+            self.name_offsets = list(
+                itertools.accumulate((len(n) + 1 for n in names[:-1]), initial=0)
+            )
+
+    def find_uid(self, name):
+        """Return the UID of the first feature (in devices.json order) whose name contains name.
+
+        The first match in the joined names is the first feature containing
+        name, and the answer of each name is remembered. uid_by_query is the
+        only state a reader changes, the answers it holds never change for a
+        snapshot.
+        """
+        try:
+            return self.uid_by_query[name]
+        except KeyError:
+            pass
+
+        uid = None
+        pos = self.names.find(name) if "\n" not in name else -1
+        if pos >= 0 and self.name_uids:
+            uid = self.name_uids[bisect.bisect_right(self.name_offsets, pos) - 1]
+
+        if len(self.uid_by_query) < MAX_UID_QUERIES:
+            self.uid_by_query[name] = uid
+        return uid
+
 
 class HCDevice:
-    def __init__(self, ws, device, debug=False):
+    def __init__(self, ws, device, debug=False, coalesce_window=0):
         self.ws = ws
+        # Only taken by writers, readers use the current snapshot
         self.features_lock = threading.Lock()
-        self.features = device.get("features")
+        self._device = device
+        features = load_features(device.get("features"))
+        self._snapshot = FeatureSnapshot(features, self._compile_decoder)
         self.name = device.get("name")
         self.session_id = None
         self.tx_msg_id = None
@@ -64,104 +238,152 @@ class HCDevice:
         self.device_id = "0badcafe"
         self.debug = debug
         self._services_event = threading.Event()
+        self._timers = Timers(self.name)
+        # msgID -> (future, expiry timer, resource) of requests waiting for a RESPONSE
+        self._tx_lock = threading.Lock()
+        self._requests = {}
+        self.handshake_duration = None
+        # Time spent in handle_message per resource
+        self.handler_stats = TimingStats()
+        # /ro/values writes waiting for the coalescing window to close
+        self.coalesce_window = coalesce_window
+        self._values_lock = threading.Lock()
+        self._pending_values = {}
+        self._pending_waiters = []
+        self._values_timer = None
         self.services = {}
         self.token = None
         self.connected = False
-        self.state_lock = threading.Lock()
-        self.state = {}
+        self.state = DeviceState()
         self.set_init_feature_values()
 
-    def set_init_feature_values(self):
-        with self.features_lock:
-            for uid, feature in self.features.items():
-                name = feature.get("name")
-                if name is None:
-                    continue
-
-                initValue = feature.get("initValue", None)
-                values = feature.get("values", None)
-                refCID = feature.get("refCID", None)
-                refDID = feature.get("refDID", None)
-
-                with self.state_lock:
-                    if initValue is not None and values is not None:
-                        self.state[name] = values.get(initValue, None)
-                    elif initValue is not None and refCID == "00" and refDID == "01":
-                        if initValue.lower() == "true" or initValue.lower() == "false":
-                            self.state[name] = initValue
-                        elif initValue == "1":
-                            self.state[name] = "True"
-                        elif initValue == "0":
-                            self.state[name] = "False"
+    @property
+    def features(self):
+        return self._snapshot.features
 
-    def get_feature_uid(self, name):
-        uid = None
+    # Apply /ro/descriptionChange entries to a copy of the features and swap it in.
+    # Known features get a new dict with the changed attributes, unknown UIDs are added.
+    def update_features(self, changes):
         with self.features_lock:
-            for k, v in self.features.items():
-                # Would EndsWith be better approach?
-                if "name" in v and name in v["name"]:
-                    uid = k
-                    break
+            snapshot = self._snapshot
+            features = dict(snapshot.features)
+            added = []
+            for change in changes:
+                uid = str(change["uid"])
+                feature = features.get(uid)
+                if feature is not None:
+                    feature = feature.updated(
+                        {
+                            key: change[key]
+                            for key in ("access", "available", "min", "max", "default")
+                            if key in change
+                        }
+                    )
+                    features[uid] = feature
 
-        return uid
+                    if self.debug:
+                        name = feature.get("name", f"<missing name for uid {uid}>")
+                        self.print(f"Access change {name} - {change}")
+                else:
+                    # We wont have name for this item, so have to be careful
+                    # when resolving elsewhere
+                    features[uid] = Feature.from_dict(uid, change)
+                    added.append(uid)
+
+            self._snapshot = FeatureSnapshot(features, self._compile_decoder, snapshot, added)
+
+    # Build the (name, decode) pair parse_values uses for a single UID.
+    # decode is None when the value is passed through unchanged.
+    def _compile_decoder(self, uid, feature):
+        name = feature.name if feature.name is not None else uid
+        values = feature.values
+
+        if name in PROGRAM_FEATURES:
+            get_feature_name = self.get_feature_name
+
+            # Convert the returned value to a program name
+            def decode(value):
+                program = get_feature_name(str(value))
+                if program is not None:
+                    program = program.split(".")[-1]
+                return program
+
+        elif feature.ref_cid == "01" and feature.ref_did == "00":
+
+            def decode(value):
+                if type(value) is bool:
+                    return value
+                return str(value).lower() in ("1", "true", "on")
+
+        elif values is not None:
+            # Convert index values to their named equivalent
+            by_int = enum_index(values)
+
+            def decode(value):
+                if type(value) is int:
+                    return by_int.get(value)
+                return values.get(str(value), None)
+
+        else:
+            decode = None
+
+        return (name, decode)
+
+    def set_init_feature_values(self):
+        for feature in self.features.values():
+            name = feature.name
+            if name is None:
+                continue
+
+            initValue = feature.init_value
+            values = feature.values
+            refCID = feature.ref_cid
+            refDID = feature.ref_did
+
+            if initValue is not None and values is not None:
+                self.state.seed(name, values.get(initValue, None))
+            elif initValue is not None and refCID == "00" and refDID == "01":
+                if initValue.lower() == "true" or initValue.lower() == "false":
+                    self.state.seed(name, initValue)
+                elif initValue == "1":
+                    self.state.seed(name, "True")
+                elif initValue == "0":
+                    self.state.seed(name, "False")
+
+    def get_feature_uid(self, name):
+        return self._snapshot.find_uid(name)
 
     def get_feature_name(self, uid):
         name = None
-        uid = str(uid)
-        with self.features_lock:
-            if uid in self.features:
-                feature = self.features.get(uid, None)
-                if feature is not None:
-                    name = feature.get("name", None)
+        feature = self._snapshot.features.get(str(uid), None)
+        if feature is not None:
+            name = feature.name
 
         return name
 
     def parse_values(self, values):
-        if not self.features:
+        snapshot = self._snapshot
+        if not snapshot.features:
             return values
 
         result = {}
+        decoders = snapshot.decoders
 
         for msg in values:
-            uid = str(msg["uid"])
             value = msg.get("value", None)
-
             if value is None:
                 continue
 
-            value_str = str(value)
-
-            name = uid
-            feature = None
-            with self.features_lock:
-                if uid in self.features:
-                    feature = self.features[uid]
-
-            if feature:
-                if "name" in feature:
-                    name = feature["name"]
-
-                if "values" in feature:
-                    # Convert index values to their named equivalent
-                    value = feature["values"].get(value_str, None)
-
-                refCID = feature.get("refCID", None)
-                refDID = feature.get("refDID", None)
-
-                if refCID == "01" and refDID == "00":
-                    value = value_str.lower() in ("1", "true", "on")
-
-                if (
-                    name == "BSH.Common.Root.SelectedProgram"
-                    or name == "BSH.Common.Root.ActiveProgram"
-                    or name == "BSH.Common.Option.BaseProgram"
-                ):
-                    # Convert the returned value to a program name
-                    value = self.get_feature_name(value_str)
-                    if value is not None:
-                        value = value.split(".")[-1]
+            uid = msg["uid"]
+            decoder = decoders.get(uid)
+            if decoder is None and not isinstance(uid, int):
+                decoder = decoders.get(int(uid)) if str(uid).isdigit() else None
+            if decoder is None:
+                result[str(uid)] = value
+                continue
 
-            result[name] = value
+            name, decode = decoder
+            result[name] = value if decode is None else decode(value)
 
         return result
 
@@ -238,73 +460,83 @@ class HCDevice:
             if value is None:
                 raise Exception("Unable to configure appliance. Value is required.")
 
-            # Check if the uid is present for this appliance
-            uid = str(uid)
-            with self.features_lock:
-                if uid not in self.features:
-                    raise Exception(f"Unable to configure appliance. UID {uid} is not valid.")
-
-                feature = self.features[uid]
+            uid, value = self.validate_feature_value(uid, value)
 
-                # check the access level of the feature
-            self.print(f"Processing feature {feature['name']} with uid {uid}")
-            if "access" not in feature:
-                self.print(
-                    f"Feature {feature['name']} with uid {uid} does not have access."
-                    "Attempting to send instruction anyway."
-                )
-            else:
-                access = feature["access"].lower()
-                if access != "readwrite" and access != "writeonly":
-                    self.print(
-                        f"Feature {feature['name']} with uid {uid} "
-                        f"has got access {feature['access']}."
-                        "Attempting to send instruction anyway."
-                    )
+            # UID has to be the first attribute in the dict because the devices require it that way
+            data["uid"] = uid
+            data.pop("value")
+            data["value"] = value
+        return data_array
 
-            # check if selected list with values is allowed
-            if "values" in feature:
-                if isinstance(value, int) is False and value.isdigit() is False:
-                    try:
-                        key = next(k for k, v in feature["values"].items() if v == value)
-                        value = int(key)
-                    except StopIteration:
-                        raise Exception(
-                            f"Unable to configure appliance. The value {value} must "
-                            f"be in the allowed values {feature['values']}."
-                        )
-                elif isinstance(value, int) is False and value.isdigit():
-                    value = int(value)
+    # Check a single value against the feature description and return the
+    # (uid, value) pair to send to the appliance. Messages are only built
+    # when the value is rejected.
+    def validate_feature_value(self, uid, value):
+        uid = str(uid)
+        feature = self._snapshot.features.get(uid)
+        if feature is None:
+            raise Exception(f"Unable to configure appliance. UID {uid} is not valid.")
 
+        if self.debug:
+            self.print(f"Processing feature {feature.name} with uid {uid}")
+
+        # check the access level of the feature
+        access = feature.access
+        if access is None:
+            self.print(
+                f"Feature {feature.name} with uid {uid} does not have access."
+                "Attempting to send instruction anyway."
+            )
+        elif access.lower() not in ("readwrite", "writeonly"):
+            self.print(
+                f"Feature {feature.name} with uid {uid} "
+                f"has got access {access}."
+                "Attempting to send instruction anyway."
+            )
+
+        # check if selected list with values is allowed
+        values = feature.values
+        if values is not None:
+            if isinstance(value, int):
+                valid = str(value) in values
+            elif value.isdigit():
+                value = int(value)
+                valid = str(value) in values
+            else:
                 # values are strings in the feature list,
                 # but always seem to be an integer. An integer must be provided
-                if str(value) not in feature["values"]:
+                key = feature.labels.get(value) if feature.labels else None
+                if key is None:
                     raise Exception(
-                        "Unable to configure appliance. "
-                        f"Value {data['value']} is not a valid value. "
-                        f"Allowed values are {feature['values']}. "
+                        f"Unable to configure appliance. The value {value} must "
+                        f"be in the allowed values {values}."
                     )
+                value = key
+                valid = True
 
-            if "min" in feature:
-                min = int(feature["min"])
-                max = int(feature["max"])
-                if isinstance(value, int) is False or value < min or value > max:
-                    raise Exception(
-                        "Unable to configure appliance. "
-                        f"Value {value} is not a valid value. "
-                        f"The value must be an integer in the range {min} and {max}."
-                    )
-            # BSH.Common.Option.BaseProgram - Convert named programs to UIDs
-            if uid == "32773":
-                value = self.get_feature_uid(value)
-                if value is not None:
-                    value = int(value)
+            if not valid:
+                raise Exception(
+                    "Unable to configure appliance. "
+                    f"Value {value} is not a valid value. "
+                    f"Allowed values are {values}. "
+                )
 
-            # UID has to be the first attribute in the dict because the devices require it that way
-            data["uid"] = int(uid)
-            data.pop("value")
-            data["value"] = value
-        return data_array
+        if feature.min is not None:
+            min = int(feature.min)
+            max = int(feature.max)
+            if isinstance(value, int) is False or value < min or value > max:
+                raise Exception(
+                    "Unable to configure appliance. "
+                    f"Value {value} is not a valid value. "
+                    f"The value must be an integer in the range {min} and {max}."
+                )
+        # BSH.Common.Option.BaseProgram - Convert named programs to UIDs
+        if uid == "32773":
+            value = self.get_feature_uid(value)
+            if value is not None:
+                value = int(value)
+
+        return int(uid), value
 
     def recv(self):
         try:
@@ -334,7 +566,30 @@ class HCDevice:
         )
 
     # send a message to the device
-    def get(self, resource, version=1, action="GET", data=None):
+    # Returns a Future that resolves to the "data" of the RESPONSE, or fails
+    # with HCDeviceError, TimeoutError or ConnectionError. NOTIFY messages
+    # don't get a response so their future resolves once they are sent.
+    def get(self, resource, version=1, action="GET", data=None, timeout=REQUEST_TIMEOUT):
+        if data is not None:
+            if isinstance(data, list) is False:
+                data = [data]
+
+            if action == "POST":
+                if resource == "/ro/values":
+                    # Raises exceptions on failure
+                    # Replace named values with integers if possible
+                    data = self.test_feature(data)
+                elif resource == "/ro/activeProgram":
+                    # Raises exception on failure
+                    data = self.test_program_data(data)
+                elif resource == "/ro/selectedProgram":
+                    # Raises exception on failure
+                    data = self.test_program_data(data)
+
+        return self.send_request(resource, version, action, data, timeout)
+
+    # Send a request without validating the data
+    def send_request(self, resource, version=1, action="GET", data=None, timeout=REQUEST_TIMEOUT):
         if self._services_event.is_set():
             resource_parts = resource.split("/")
             if len(resource_parts) > 1:
@@ -346,71 +601,205 @@ class HCDevice:
 
         msg = {
             "sID": self.session_id,
-            "msgID": self.tx_msg_id,
+            "msgID": None,
             "resource": resource,
             "version": version,
             "action": action,
         }
-
         if data is not None:
-            if isinstance(data, list) is False:
-                data = [data]
+            msg["data"] = data
 
-            if action == "POST":
-                if resource == "/ro/values":
-                    # Raises exceptions on failure
-                    # Replace named values with integers if possible
-                    data = self.test_feature(data)
-                elif resource == "/ro/activeProgram":
-                    # Raises exception on failure
-                    data = self.test_program_data(data)
-                elif resource == "/ro/selectedProgram":
-                    # Raises exception on failure
-                    data = self.test_program_data(data)
+        future = Future()
+        with self._tx_lock:
+            msg_id = self.tx_msg_id
+            msg["msgID"] = msg_id
+            if action != "NOTIFY":
+                timer = self.call_later(timeout, lambda: self._expire_request(msg_id, future))
+                self._requests[msg_id] = (future, timer, resource)
+            try:
+                if self.debug:
+                    self.print(f"TX: {msg}")
+                self.ws.send(msg)
+            except Exception as e:
+                print(self.name, "Failed to send", e, msg, traceback.format_exc())
+                request = self._requests.pop(msg_id, None)
+                if request is not None:
+                    request[1].cancel()
+                future.set_exception(e)
+            else:
+                if action == "NOTIFY":
+                    future.set_result(None)
+            self.tx_msg_id += 1
+        return future
+
+    # POST values to /ro/values, merging writes that arrive within the
+    # coalescing window into a single request. A later write to the same UID
+    # replaces the earlier one. Values are validated straight away so errors
+    # are raised to the caller, the returned Future resolves with the POST.
+    def set_values(self, data):
+        if isinstance(data, list) is False:
+            data = [data]
+        data = self.test_feature(data)
+
+        if self.coalesce_window <= 0:
+            return self.send_request("/ro/values", 1, "POST", data)
+
+        future = Future()
+        with self._values_lock:
+            for item in data:
+                self._pending_values[item["uid"]] = item
+            self._pending_waiters.append(future)
+            if self._values_timer is None:
+                self._values_timer = self.call_later(self.coalesce_window, self.flush_values)
+        return future
+
+    # Run func after delay seconds, returns a handle with a cancel() method
+    def call_later(self, delay, func):
+        return self._timers.call_later(delay, func)
+
+    # Send the values collected by set_values
+    def flush_values(self):
+        with self._values_lock:
+            values = list(self._pending_values.values())
+            waiters = self._pending_waiters
+            self._pending_values = {}
+            self._pending_waiters = []
+            self._values_timer = None
+        if not values:
+            return
 
-            msg["data"] = data
+        if self.debug and len(waiters) > 1:
+            self.print(f"Coalesced {len(waiters)} writes into one /ro/values POST")
+        request = self.send_request("/ro/values", 1, "POST", values)
 
-        try:
-            if self.debug:
-                self.print(f"TX: {msg}")
-            self.ws.send(msg)
-        except Exception as e:
-            print(self.name, "Failed to send", e, msg, traceback.format_exc())
-        self.tx_msg_id += 1
+        def done(request):
+            error = request.exception()
+            for waiter in waiters:
+                if error is None:
+                    waiter.set_result(request.result())
+                else:
+                    waiter.set_exception(error)
+
+        request.add_done_callback(done)
+
+    # Resolve the future of the request this RESPONSE belongs to
+    def _complete_request(self, msg):
+        with self._tx_lock:
+            request = self._requests.pop(msg.get("msgID"), None)
+        if request is None:
+            return
+
+        future, timer, resource = request
+        timer.cancel()
+        if future.done():
+            return
+        if "code" in msg:
+            future.set_exception(HCDeviceError(msg["code"], resource))
+        else:
+            future.set_result(msg.get("data"))
+
+    # Fail a request when its timeout passes without a RESPONSE, scheduled by send_request
+    def _expire_request(self, msg_id, future):
+        with self._tx_lock:
+            request = self._requests.get(msg_id)
+            # The msgID may have been reused by a later connection
+            if request is None or request[0] is not future:
+                return
+            del self._requests[msg_id]
+        if not future.done():
+            future.set_exception(TimeoutError(f"no response to {request[2]} ({msg_id})"))
+
+    # Fail every outstanding request, e.g. when the connection closes
+    def fail_requests(self, error):
+        with self._tx_lock:
+            requests = list(self._requests.values())
+            self._requests.clear()
+        for future, timer, _ in requests:
+            timer.cancel()
+            if not future.done():
+                future.set_exception(error)
+
+    # Return a Future that resolves to the list of futures once all of them are done
+    @staticmethod
+    def gather(futures):
+        futures = list(futures)
+        combined = Future()
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def done(_):
+            with lock:
+                remaining[0] -= 1
+                finished = remaining[0] == 0
+            if finished:
+                combined.set_result(futures)
+
+        if not futures:
+            combined.set_result(futures)
+        for future in futures:
+            future.add_done_callback(done)
+        return combined
+
+    # Start the handshake after /ei/initialValues, without blocking the receive loop
+    def start_handshake(self):
+        threading.Thread(target=self.reconnect).start()
 
     def reconnect(self):
         # Receive initialization message /ei/initialValues
         # Automatically responds in the handle_message function
+        start = time.monotonic()
 
         # Ask the device which services it supports and wait for the response.
-        self.get("/ci/services")
-        if not self._services_event.wait(timeout=10):
-            self.print("timeout waiting for /ci/services, closing connection")
+        request = self.get("/ci/services", timeout=SERVICES_TIMEOUT)
+        try:
+            request.result()
+        except Exception as e:
+            self.print(f"no /ci/services response ({e!r}), closing connection")
             self.ws.close()
             return
 
+        self.request_device_info(start)
+
+    # Send the rest of the handshake once the services are known. The requests
+    # are pipelined, the responses are handled as they arrive in handle_message
+    def request_device_info(self, start):
+        requests = []
+
         # Gate endpoints based on advertised services (see /ci/services response).
         # iz-capable devices (ci:3) use /iz/info for device identity.
         # Non-iz devices (ci:2) use /ci/authentication + /ci/info.
         if "iz" in self.services:
-            self.get("/iz/info")
+            requests.append(self.get("/iz/info"))
         else:
             self.token = base64url_encode(get_random_bytes(32)).decode("UTF-8")
             self.token = re.sub(r"=", "", self.token)
-            self.get("/ci/authentication", version=2, data={"nonce": self.token})
-            self.get("/ci/info")
+            requests.append(self.get("/ci/authentication", version=2, data={"nonce": self.token}))
+            requests.append(self.get("/ci/info"))
 
         # We need to send deviceReady for some devices or /ni/ will come back as 403 unauth
-        self.get("/ei/deviceReady", version=2, action="NOTIFY")
+        requests.append(self.get("/ei/deviceReady", version=2, action="NOTIFY"))
 
         if "ni" in self.services:
-            self.get("/ni/info")
+            requests.append(self.get("/ni/info"))
+
+        requests.append(self.get("/ro/allMandatoryValues"))
+        requests.append(self.get("/ro/allDescriptionChanges"))
+
+        def handshake_done(future):
+            self.handshake_duration = time.monotonic() - start
+            failed = [f.exception() for f in future.result() if f.exception() is not None]
+            if failed:
+                self.print(f"handshake finished with errors in {self.handshake_duration:.3f}s:")
+                for e in failed:
+                    self.print("\t", e)
+            else:
+                self.print(f"handshake complete in {self.handshake_duration:.3f}s")
 
-        self.get("/ro/allMandatoryValues")
-        self.get("/ro/allDescriptionChanges")
+        self.gather(requests).add_done_callback(handshake_done)
 
     def handle_message(self, buf):
-        msg = json.loads(buf)
+        start = time.perf_counter()
+        msg = jsoncodec.loads(buf)
         if self.debug:
             self.print("RX:", msg)
         sys.stdout.flush()
@@ -442,7 +831,7 @@ class HCDevice:
                     },
                 )
 
-                threading.Thread(target=self.reconnect).start()
+                self.start_handshake()
             else:
                 self.print("Unknown resource", resource, file=sys.stderr)
 
@@ -457,34 +846,7 @@ class HCDevice:
                     # Retrieve any value changes
                     values = self.parse_values(msg["data"])
 
-                    for change in msg["data"]:
-                        uid = str(change["uid"])
-                        with self.features_lock:
-                            if uid in self.features:
-                                if "access" in change:
-                                    access = change["access"]
-                                    self.features[uid]["access"] = access
-                                if "available" in change:
-                                    self.features[uid]["available"] = change["available"]
-                                if "min" in change:
-                                    self.features[uid]["min"] = change["min"]
-                                if "max" in change:
-                                    self.features[uid]["max"] = change["max"]
-                                # if "value" in change:
-                                #    name = self.features[str(uid)]["name"]
-                                #    values | self.parse_values(change)
-                                if "default" in change:
-                                    self.features[str(uid)]["default"] = change["default"]
-
-                                if self.debug:
-                                    feature = self.features.get(uid, {})
-                                    name = feature.get("name", f"<missing name for uid {uid}>")
-                                    self.print(f"Access change {name} - {change}")
-
-                            else:
-                                # We wont have name for this item, so have to be careful
-                                # when resolving elsewhere
-                                self.features[uid] = change
+                    self.update_features(msg["data"])
 
             elif resource == "/ni/info":
                 if "data" in msg and len(msg["data"]) > 0:
@@ -537,9 +899,27 @@ class HCDevice:
         else:
             self.print("Unknown message", msg)
 
+        # Once the message is handled, so whoever waits for it sees what it changed
+        if action == "RESPONSE":
+            self._complete_request(msg)
+
+        self.handler_stats.record(resource, time.perf_counter() - start)
+
         # return whatever we've parsed out of it
         return values
 
+    def stats(self):
+        """Counters of the current connection and the time spent handling each resource."""
+        return {
+            "connected": self.connected,
+            "handshake_ms": (
+                None if self.handshake_duration is None else round(self.handshake_duration * 1000)
+            ),
+            "pending_requests": len(self._requests),
+            "socket": self.ws.stats(),
+            "handlers": self.handler_stats.summary(),
+        }
+
     def run_forever(self, on_message, on_open, on_close):
         def _on_message(ws, message):
             values = self.handle_message(message)
@@ -551,6 +931,7 @@ class HCDevice:
 
         def _on_close(ws, code, message):
             self.connected = False
+            self.fail_requests(ConnectionError("websocket closed"))
             on_close(ws, code, message)
 
         def on_error(ws, message):
@@ -0,0 +1,212 @@
+# Compact records for the features of a Home Connect device
+#
+# devices.json stores every feature as a dict keyed by its attribute names
+# (refCID, refDID, access, values, min, max, ...). With thousands of features
+# per appliance those dicts dominate the memory of hc2mqtt, so they are
+# converted to slotted Feature records once, after devices.json is loaded.
+# Identical enum tables are shared between features and devices.
+#
+# Feature still behaves like a read-only dict, so code that uses
+# feature.get("name") or "values" in feature keeps working.
+
+import sys
+from collections.abc import Mapping
+
+# devices.json key -> Feature attribute
+FIELDS = {
+    "uid": "uid",
+    "name": "name",
+    "access": "access",
+    "available": "available",
+    "refCID": "ref_cid",
+    "refDID": "ref_did",
+    "values": "values",
+    "min": "min",
+    "max": "max",
+    "stepSize": "step",
+    "initValue": "init_value",
+    "default": "default",
+    "handling": "handling",
+}
+
+# Enum tables shared by every feature with the same values, with their reverse map
+_enum_tables = {}
+# id() of a shared values table -> {int key: label}, used when decoding device values
+_enum_indexes = {}
+
+
+def parse_number(value):
+    """Convert a min/max/stepSize attribute to an int or float, leaving anything else as is."""
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    return value
+
+
+def enum_table(values):
+    """Return the shared (values, labels) pair for an enum.
+
+    values maps the key sent by the device to its label, labels maps a label back
+    to the integer key. The first key wins when a label is listed twice.
+    """
+    key = tuple((str(k), v) for k, v in values.items())
+    try:
+        return _enum_tables[key]
+    except KeyError:
+        pass
+    except TypeError:
+        # Unhashable labels, nothing to share
+        key = None
+
+    values = {str(k): v for k, v in values.items()}
+    labels = {}
+    for k, label in values.items():
+        if k.isdigit():
+            try:
+                labels.setdefault(label, int(k))
+            except TypeError:
+                pass
+    if key is not None:
+        _enum_tables[key] = (values, labels)
+        _enum_indexes[id(values)] = _int_index(values)
+    return values, labels
+
+
+def _int_index(values):
+    return {int(k): v for k, v in values.items() if k.isdigit() and str(int(k)) == k}
+
+
+def enum_index(values):
+    """Return {int key: label} for a values table, shared when the table is shared."""
+    index = _enum_indexes.get(id(values))
+    if index is None:
+        index = _int_index({str(k): v for k, v in values.items()})
+    return index
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+class Feature(Mapping):
+    __slots__ = (
+        "uid",
+        "name",
+        "access",
+        "available",
+        "ref_cid",
+        "ref_did",
+        "values",
+        "labels",
+        "min",
+        "max",
+        "step",
+        "init_value",
+        "default",
+        "handling",
+        "extra",
+    )
+
+    def __init__(self, uid, name=None, **kwargs):
+        self.uid = int(uid)
+        self.name = name
+        self.access = kwargs.get("access")
+        self.available = kwargs.get("available")
+        self.ref_cid = kwargs.get("ref_cid")
+        self.ref_did = kwargs.get("ref_did")
+        self.values = kwargs.get("values")
+        self.labels = kwargs.get("labels")
+        self.min = kwargs.get("min")
+        self.max = kwargs.get("max")
+        self.step = kwargs.get("step")
+        self.init_value = kwargs.get("init_value")
+        self.default = kwargs.get("default")
+        self.handling = kwargs.get("handling")
+        # Attributes without a slot, None when there are none
+        self.extra = kwargs.get("extra")
+
+    @classmethod
+    def from_dict(cls, uid, data):
+        """Build a Feature from a devices.json or /ro/descriptionChange entry."""
+        kwargs = {}
+        extra = None
+        for key, value in data.items():
+            attr = FIELDS.get(key)
+            if attr is None:
+                if extra is None:
+                    extra = {}
+                extra[sys.intern(key)] = _intern(value)
+            elif attr == "uid":
+                continue
+            elif attr == "values":
+                if isinstance(value, dict):
+                    kwargs["values"], kwargs["labels"] = enum_table(value)
+                else:
+                    kwargs["values"] = value
+            elif attr in ("min", "max", "step"):
+                kwargs[attr] = parse_number(value)
+            else:
+                kwargs[attr] = _intern(value)
+        kwargs["extra"] = extra
+        return cls(uid, **kwargs)
+
+    def updated(self, changes):
+        """Return a copy of this feature with the given devices.json attributes replaced."""
+        data = dict(self)
+        data.update(changes)
+        return Feature.from_dict(self.uid, data)
+
+    def as_dict(self):
+        return dict(self)
+
+    # Read-only dict view using the devices.json key names
+    def __getitem__(self, key):
+        attr = FIELDS.get(key)
+        if attr is not None:
+            value = getattr(self, attr)
+            if value is not None:
+                return value
+        elif self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        attr = FIELDS.get(key)
+        if attr is not None:
+            return getattr(self, attr) is not None
+        return self.extra is not None and key in self.extra
+
+    def __iter__(self):
+        for key, attr in FIELDS.items():
+            if getattr(self, attr) is not None:
+                yield key
+        if self.extra is not None:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"Feature({self.uid}, {self.name!r})"
+
+
+def load_features(features):
+    """Convert a devices.json features dict to {uid: Feature}.
+
+    Entries that are already Feature records are kept, so this can be called
+    again on features that have been loaded before.
+    """
+    if features is None:
+        return None
+    loaded = {}
+    for uid, feature in features.items():
+        if not isinstance(feature, Feature):
+            feature = Feature.from_dict(uid, feature)
+        loaded[sys.intern(str(uid))] = feature
+    return loaded
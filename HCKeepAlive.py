@@ -0,0 +1,198 @@
+# Websocket keepalive and round trip times of appliance connections
+#
+# A ping is only sent once nothing has been received for the ping interval,
+# or every RTT_SAMPLE_INTERVAL to keep measuring a chatty appliance. The pong
+# timeout follows the measured round trip times.
+#
+# The interval follows the measured gaps between received frames: an
+# appliance that usually sends every few seconds is pinged after
+# IDLE_GAP_FACTOR times its usual gap, never sooner than PING_INTERVAL_MIN,
+# a quiet one every PING_INTERVAL_MAX. A missed pong closes the connection.
+# The state of an appliance outlives its connections, so a reconnect starts
+# from what was measured before.
+
+import struct
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+
+PING_INTERVAL_MIN = 5
+PING_INTERVAL_MAX = 30
+PING_TIMEOUT_MIN = 2
+PING_TIMEOUT_MAX = 10
+# Upper bounds of the round trip time histogram buckets, in milliseconds
+RTT_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+# Number of recent pings the histogram covers
+RTT_WINDOW = 128
+# Ping at least this often, even when frames keep arriving
+RTT_SAMPLE_INTERVAL = 300
+# Ping once nothing has been received for this many times the usual gap
+IDLE_GAP_FACTOR = 3
+# Weight of a new gap in the moving average of the gaps between frames
+IDLE_GAP_SMOOTHING = 0.2
+
+
+class RTTHistogram:
+    """Bucketed round trip times of the last window pings."""
+
+    def __init__(self, window=RTT_WINDOW, bounds=RTT_BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.samples = deque(maxlen=window)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, rtt):
+        if len(self.samples) == self.samples.maxlen:
+            self.counts[self.bucket(self.samples[0])] -= 1
+        self.samples.append(rtt)
+        self.counts[self.bucket(rtt)] += 1
+
+    def bucket(self, rtt):
+        return bisect_left(self.bounds, rtt * 1000)
+
+    def percentile(self, p):
+        """Return the upper bound in seconds of the bucket holding the p-th percentile."""
+        if not self.samples:
+            return None
+        rank = p / 100 * len(self.samples)
+        total = 0
+        for i, count in enumerate(self.counts):
+            total += count
+            if count and total >= rank:
+                break
+        if i == len(self.bounds):
+            return max(self.samples)
+        return self.bounds[i] / 1000
+
+    def summary(self):
+        if not self.samples:
+            return {"count": 0}
+        labels = [f"<={bound}ms" for bound in self.bounds] + [f">{self.bounds[-1]}ms"]
+        return {
+            "count": len(self.samples),
+            "last_ms": round(self.samples[-1] * 1000, 1),
+            "min_ms": round(min(self.samples) * 1000, 1),
+            "max_ms": round(max(self.samples) * 1000, 1),
+            "p50_ms": round(self.percentile(50) * 1000, 1),
+            "p95_ms": round(self.percentile(95) * 1000, 1),
+            "buckets": {label: n for label, n in zip(labels, self.counts) if n},
+        }
+
+
+class KeepAlive:
+    """Decides when to ping an appliance and when it is gone.
+
+    check() returning "dead" ends the connection. The ping interval is
+    IDLE_GAP_FACTOR times the moving average of the gaps between frames,
+    within interval_min and interval_max.
+    """
+
+    def __init__(
+        self,
+        interval_min=PING_INTERVAL_MIN,
+        interval_max=PING_INTERVAL_MAX,
+        timeout_min=PING_TIMEOUT_MIN,
+        timeout_max=PING_TIMEOUT_MAX,
+    ):
+        self.interval_min = interval_min
+        self.interval_max = interval_max
+        self.timeout_min = timeout_min
+        self.timeout_max = timeout_max
+        self.interval = interval_max
+        # Moving average of the seconds between received frames
+        self.idle_gap = None
+        self.rtt = RTTHistogram()
+        self.pings = 0
+        self.missed = 0
+        self.last_rx = time.monotonic()
+        self.last_ping = self.last_rx
+        self.ping_sent = None
+        self.ping_payload = None
+
+    def connected(self):
+        self.last_rx = self.last_ping = time.monotonic()
+        self.ping_sent = None
+
+    def received(self):
+        """Any frame from the appliance shows it is alive."""
+        now = time.monotonic()
+        gap = now - self.last_rx
+        if self.idle_gap is None:
+            self.idle_gap = gap
+        else:
+            self.idle_gap += IDLE_GAP_SMOOTHING * (gap - self.idle_gap)
+        self.interval = min(
+            self.interval_max, max(self.interval_min, IDLE_GAP_FACTOR * self.idle_gap)
+        )
+        self.last_rx = now
+
+    def timeout(self):
+        """Seconds to wait for a pong: four times the 95th percentile round trip."""
+        p95 = self.rtt.percentile(95)
+        if p95 is None:
+            return self.timeout_max
+        return min(self.timeout_max, max(self.timeout_min, 4 * p95))
+
+    def poll_timeout(self):
+        """Seconds until check() has something to do."""
+        if self.ping_sent is not None:
+            deadline = max(self.ping_sent, self.last_rx) + self.timeout()
+        else:
+            deadline = min(self.last_rx + self.interval, self.last_ping + RTT_SAMPLE_INTERVAL)
+        return max(0, deadline - time.monotonic())
+
+    def check(self):
+        """Return "ping" if a ping is due, "dead" if the last one went unanswered, else None."""
+        now = time.monotonic()
+        if self.ping_sent is not None:
+            # Frames received after the ping show the appliance is still there,
+            # the pong may be queued behind them
+            if now - max(self.ping_sent, self.last_rx) >= self.timeout():
+                self.ping_sent = None
+                self.missed += 1
+                return "dead"
+            return None
+        if now - self.last_rx >= self.interval or now - self.last_ping >= RTT_SAMPLE_INTERVAL:
+            return "ping"
+        return None
+
+    def ping(self):
+        """Record a ping being sent and return its payload."""
+        self.pings += 1
+        self.ping_payload = struct.pack("!Q", self.pings)
+        self.ping_sent = self.last_ping = time.monotonic()
+        return self.ping_payload
+
+    def pong(self, payload):
+        """Record a pong, returning the round trip time or None for an unsolicited pong."""
+        if self.ping_sent is None or bytes(payload) != self.ping_payload:
+            return None
+        rtt = time.monotonic() - self.ping_sent
+        self.ping_sent = None
+        self.rtt.add(rtt)
+        return rtt
+
+    def stats(self):
+        return {
+            "ping_interval": round(self.interval, 1),
+            "ping_timeout": round(self.timeout(), 1),
+            "pings": self.pings,
+            "missed_pongs": self.missed,
+            "rtt": self.rtt.summary(),
+        }
+
+
+_keepalives = {}
+_keepalives_lock = threading.Lock()
+
+
+def keepalive_for(host):
+    """Return the keepalive state of an appliance, shared by all its connections."""
+    with _keepalives_lock:
+        keepalive = _keepalives.get(host)
+        if keepalive is None:
+            keepalive = _keepalives[host] = KeepAlive()
+        return keepalive
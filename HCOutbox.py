@@ -0,0 +1,149 @@
+# Updates waiting for the MQTT broker to come back
+#
+# While the broker is unreachable, changed values stay dirty in the
+# device's DeviceState, which only keeps the newest value of each key.
+# Events are not part of the state, so the newest payload of each event
+# topic waits in the device's Outbox, up to OUTBOX_LIMIT topics. Beyond
+# that the oldest is dropped. Everything pending goes out in one burst
+# when the broker connection is re-established.
+#
+# Values that change every few seconds can be given a minimum interval
+# between publishes in PUBLISH_RATE_LIMITS of discovery.yaml. A change within
+# the interval stays dirty and is published when the interval ends, so the
+# last value always goes out.
+
+import threading
+import time
+from collections import OrderedDict
+
+OUTBOX_LIMIT = 256
+
+
+class RateLimits:
+    """Minimum seconds between publishes of a feature, matched by prefix like SKIP_ENTITIES."""
+
+    def __init__(self, limits=None):
+        # Longest prefix first, so the most specific entry wins
+        self.limits = sorted((limits or {}).items(), key=lambda item: -len(item[0]))
+        # feature name -> interval or None, resolved on first use
+        self._intervals = {}
+
+    def __bool__(self):
+        return bool(self.limits)
+
+    def interval(self, key):
+        try:
+            return self._intervals[key]
+        except KeyError:
+            pass
+        interval = None
+        for prefix, seconds in self.limits:
+            if key.startswith(prefix):
+                interval = seconds
+                break
+        self._intervals[key] = interval
+        return interval
+
+
+def rate_limits_from(config):
+    """Return the RateLimits of a discovery config, none if it has no PUBLISH_RATE_LIMITS."""
+    return RateLimits((config or {}).get("PUBLISH_RATE_LIMITS"))
+
+
+class Outbox:
+    def __init__(self, limit=OUTBOX_LIMIT):
+        # Held while publishing, so a flush on reconnect and a device message
+        # can't publish two values of one key out of order
+        self.lock = threading.RLock()
+        self.limit = limit
+        # topic -> payload, oldest first
+        self.pending = OrderedDict()
+        # Updates held back while the broker was unreachable
+        self.deferred = 0
+        # Held back updates replaced by a newer value before they went out
+        self.superseded = 0
+        # Held back updates dropped because the outbox was full
+        self.dropped = 0
+        self.rate_limits = RateLimits()
+        # feature name -> monotonic time of its last publish, for rate limited features
+        self.last_published = {}
+        # Changes held back by the rate limits
+        self.rate_limited = 0
+        # Keys held back right now. They stay dirty until published, so a key
+        # is only counted in rate_limited when it is first held back
+        self.held = set()
+        # Monotonic time a timer is due to publish the held back changes, or None.
+        # See hc2mqtt.schedule_flush
+        self.flush_due = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def put(self, topic, payload):
+        with self.lock:
+            if topic in self.pending:
+                self.superseded += 1
+                self.pending.move_to_end(topic)
+            elif len(self.pending) >= self.limit:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+            self.pending[topic] = payload
+
+    def hold_back(self, changed):
+        """Remove the changes of rate limited features that are not due yet from changed.
+
+        Returns {key: seconds until it is due} for the changes removed.
+        """
+        held = {}
+        if not self.rate_limits:
+            return held
+        now = time.monotonic()
+        for key in list(changed):
+            interval = self.rate_limits.interval(key)
+            if interval is None:
+                continue
+            last = self.last_published.get(key)
+            if last is not None and now - last < interval:
+                del changed[key]
+                held[key] = last + interval - now
+        self.rate_limited += len(held.keys() - self.held)
+        self.held = set(held)
+        return held
+
+    def published(self, keys):
+        """Start the rate limit interval of the keys that have just been published."""
+        if not self.rate_limits:
+            return
+        now = time.monotonic()
+        for key in keys:
+            if self.rate_limits.interval(key) is not None:
+                self.last_published[key] = now
+
+    def take(self):
+        """Return the pending (topic, payload) pairs, oldest first, and clear them."""
+        with self.lock:
+            pending = list(self.pending.items())
+            self.pending.clear()
+        return pending
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "deferred": self.deferred,
+            "superseded": self.superseded,
+            "dropped": self.dropped,
+            "rate_limited": self.rate_limited,
+        }
+
+
+_outboxes = {}
+_outboxes_lock = threading.Lock()
+
+
+def outbox_for(mqtt_topic):
+    """Return the outbox of the device published under mqtt_topic, shared by its connections."""
+    with _outboxes_lock:
+        outbox = _outboxes.get(mqtt_topic)
+        if outbox is None:
+            outbox = _outboxes[mqtt_topic] = Outbox()
+        return outbox
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# Recording and offline replay of appliance traffic
+#
+# A FrameRecorder set as HCSocket.recorder appends every decrypted frame the
+# socket receives or sends to a file, with its monotonic timestamp.
+# ReplaySocket stands in for an HCSocket and feeds the received frames of
+# such a file to HCDevice.run_forever without a network, at the recorded
+# pace, N times faster, or as fast as they can be handled.
+#
+# The file starts with MAGIC, followed by one record per frame: a RECORD
+# header (timestamp, direction, payload length) and the UTF-8 payload.
+# Direction is RX or TX, or OPEN for the start of a connection, whose
+# payload is the websocket URI. Records are only ever appended, so one file
+# holds every connection of a device.
+
+import json
+import struct
+import sys
+import threading
+import time
+
+import click
+
+from HCDevice import HCDevice
+from HCSocket import encode_frame
+from HCStats import FrameStats
+
+MAGIC = b"HCREC1\n"
+RECORD = struct.Struct("!dcI")
+RX = b"R"
+TX = b"T"
+OPEN = b"O"
+# Seconds between flushes of a recording, close() flushes the rest
+FLUSH_INTERVAL = 1
+
+
+class FrameRecorder:
+    """Appends the frames of an appliance's connections to a recording."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self._last_flush = time.monotonic()
+        # Flushes frames written since the last flush if no frame follows them
+        self._flush_timer = None
+
+    def record(self, direction, frame):
+        if isinstance(frame, str):
+            frame = frame.encode("utf-8")
+        now = time.monotonic()
+        header = RECORD.pack(now, direction, len(frame))
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(header + frame)
+            # A crash loses at most the last FLUSH_INTERVAL of frames
+            if now - self._last_flush >= FLUSH_INTERVAL:
+                self._flush()
+            elif self._flush_timer is None:
+                self._flush_timer = threading.Timer(
+                    self._last_flush + FLUSH_INTERVAL - now, self.flush
+                )
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def flush(self):
+        with self._lock:
+            if not self._file.closed:
+                self._flush()
+
+    # Called with the lock held
+    def _flush(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        self._file.flush()
+        self._last_flush = time.monotonic()
+
+    def opened(self, uri):
+        self.record(OPEN, uri)
+
+    def received(self, frame):
+        self.record(RX, frame)
+
+    def sent(self, frame):
+        self.record(TX, frame)
+
+    def close(self):
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            self._file.close()
+
+
+def read_recording(path):
+    """Yield the (timestamp, direction, payload) records of a recording.
+
+    A record cut short by a crash while it was written ends the recording.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a frame recording")
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, direction, size = RECORD.unpack(header)
+            payload = f.read(size)
+            if len(payload) < size:
+                return
+            yield timestamp, direction, payload.decode("utf-8")
+
+
+class ReplaySocket:
+    """Stands in for HCSocket, feeding the frames received in a recording to HCDevice.
+
+    speed 1 keeps the recorded gaps between frames, 10 plays ten times
+    faster and 0 plays them back to back. Each recorded connection starts
+    straight after the previous one. The frames HCDevice sends are kept in
+    sent instead of going anywhere.
+    """
+
+    http = False
+
+    def __init__(self, path, speed=1.0, debug=False):
+        self.path = path
+        self.speed = speed
+        self.debug = debug
+        self.uri = f"replay:{path}"
+        self.sent = []
+        self.closed = False
+        self.frame_stats = FrameStats()
+
+    def run_forever(self, on_message, on_open, on_close, on_error):
+        self.frame_stats = FrameStats()
+        self.closed = False
+        on_open(self)
+        try:
+            base = None
+            for timestamp, direction, payload in read_recording(self.path):
+                if self.closed:
+                    break
+                if direction == OPEN:
+                    base = None
+                if direction != RX:
+                    continue
+                if self.speed:
+                    if base is None:
+                        base = time.monotonic() - timestamp / self.speed
+                    delay = base + timestamp / self.speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                self.frame_stats.received(len(payload))
+                on_message(self, payload)
+        except Exception as e:
+            on_error(self, e)
+        finally:
+            on_close(self, 1000, "end of recording")
+
+    def send(self, msg):
+        buf = encode_frame(msg)
+        self.sent.append(buf)
+        self.frame_stats.sent(len(buf))
+
+    def close(self):
+        self.closed = True
+
+    def stats(self):
+        return self.frame_stats.summary()
+
+
+@click.command()
+@click.argument("recording")
+@click.option("-d", "--devices_file", default="config/devices.json")
+@click.option("--device", "device_name", help="Name of the device in devices_file")
+@click.option(
+    "--speed", default=1.0, type=float, help="1 for real time, 0 for as fast as possible"
+)
+@click.option("--debug/--no-debug", default=False)
+def replay(recording, devices_file, device_name, speed, debug):
+    """Replay a recording through HCDevice and report how long handling it took."""
+    device = {"name": device_name or "replay", "features": {}}
+    if device_name:
+        with open(devices_file, "r") as f:
+            devices = json.load(f)
+        matches = [d for d in devices if d["name"] == device_name]
+        if not matches:
+            raise click.ClickException(f"{device_name} is not in {devices_file}")
+        device = matches[0]
+
+    ws = ReplaySocket(recording, speed, debug)
+    mydevice = HCDevice(ws, device, debug)
+    messages = 0
+
+    def on_message(values):
+        nonlocal messages
+        messages += 1
+
+    start = time.perf_counter()
+    mydevice.run_forever(on_message=on_message, on_open=lambda ws: None, on_close=lambda *a: None)
+    elapsed = time.perf_counter() - start
+
+    print(f"{messages} frames in {elapsed:.3f}s, {messages / elapsed:.0f} frames/s")
+    for resource, stats in sorted(mydevice.handler_stats.summary().items()):
+        print(f"{resource:<32} {stats['count']:8} {stats['mean_us']:10.1f} us/frame")
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    replay()
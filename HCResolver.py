@@ -0,0 +1,154 @@
+# Name resolution for appliance hostnames
+#
+# Lookups are cached for RESOLVE_TTL seconds, failed lookups for
+# NEGATIVE_TTL, so a reconnect loop doesn't hit a slow resolver on every
+# attempt. The address that last connected is tried first and can be saved
+# to a file, so after a restart the appliance is reached without a lookup.
+# A failed connect moves the address tried first to the back, the name is
+# only looked up again early when the addresses of a fresh lookup fail.
+
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+from utils import now
+
+RESOLVE_TTL = 300
+NEGATIVE_TTL = 30
+
+
+def address_info(ip, port):
+    """Return a getaddrinfo() style entry for a literal IP address."""
+    if ":" in ip:
+        return (socket.AF_INET6, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", (ip, port, 0, 0))
+    return (socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", (ip, port))
+
+
+def interleave(addresses):
+    """Alternate address families, keeping the order within each (RFC 8305 section 4)."""
+    families = {}
+    for info in addresses:
+        families.setdefault(info[0], []).append(info)
+    queues = list(families.values())
+    result = []
+    while queues:
+        for queue in queues:
+            result.append(queue.pop(0))
+        queues = [queue for queue in queues if queue]
+    return result
+
+
+class Resolver:
+    def __init__(self, ttl=RESOLVE_TTL, negative_ttl=NEGATIVE_TTL, cache_file=None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache_file = cache_file
+        self._lock = threading.Lock()
+        # (host, port) -> (expiry, addresses or the lookup error, whether the
+        # addresses are from a lookup no connection has been tried on yet)
+        self._cache = {}
+        # host -> IP address of the last successful connection
+        self._last_good = {}
+
+    def load(self, cache_file):
+        """Read the last good addresses saved by a previous run."""
+        self.cache_file = cache_file
+        try:
+            with open(cache_file, "r") as f:
+                last_good = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(now(), f"ignoring address cache {cache_file}: {e}", file=sys.stderr)
+            return
+        with self._lock:
+            self._last_good.update(last_good)
+
+    def cached(self, host, port):
+        """Return the cached addresses of host, or None if it has to be looked up.
+
+        Raises the cached error if the last lookup failed less than
+        negative_ttl seconds ago.
+        """
+        with self._lock:
+            entry = self._cache.get((host, port))
+            if entry is None:
+                ip = self._last_good.get(host)
+                if ip is None:
+                    return None
+                # Saved by a previous run, connect without a lookup
+                entry = (time.monotonic() + self.ttl, [address_info(ip, port)], False)
+                self._cache[(host, port)] = entry
+            expiry, result, _ = entry
+            if time.monotonic() >= expiry:
+                return None
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def resolve(self, host, port):
+        """Return the addresses of host in the order they should be tried."""
+        addresses = self.cached(host, port)
+        if addresses is not None:
+            return addresses
+
+        try:
+            addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            with self._lock:
+                self._cache[(host, port)] = (time.monotonic() + self.negative_ttl, e, False)
+            raise
+
+        addresses = interleave(addresses)
+        with self._lock:
+            ip = self._last_good.get(host)
+            addresses.sort(key=lambda info: info[4][0] != ip)
+            self._cache[(host, port)] = (time.monotonic() + self.ttl, addresses, True)
+        return addresses
+
+    def failed(self, host, port):
+        """Record that no connection to host could be made on its cached addresses.
+
+        The address tried first is moved to the back. If the addresses came
+        from a lookup right before, the next connect looks the name up again.
+        The last good address is kept, the appliance may just be switched off.
+        """
+        with self._lock:
+            entry = self._cache.get((host, port))
+            if entry is None or isinstance(entry[1], Exception):
+                return
+            expiry, addresses, fresh = entry
+            if fresh:
+                del self._cache[(host, port)]
+            else:
+                self._cache[(host, port)] = (expiry, addresses[1:] + addresses[:1], False)
+
+    def remember(self, host, port, address):
+        """Record the address a connection to host succeeded on."""
+        ip = address[0]
+        with self._lock:
+            entry = self._cache.get((host, port))
+            if entry is not None and not isinstance(entry[1], Exception):
+                addresses = sorted(entry[1], key=lambda info: info[4][0] != ip)
+                self._cache[(host, port)] = (entry[0], addresses, False)
+            if self._last_good.get(host) == ip:
+                return
+            self._last_good[host] = ip
+            if self.cache_file:
+                self.save()
+
+    # Called with the lock held
+    def save(self):
+        tmp = f"{self.cache_file}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(self._last_good, f, indent=2)
+            os.replace(tmp, self.cache_file)
+        except OSError as e:
+            print(now(), f"unable to save address cache {self.cache_file}: {e}", file=sys.stderr)
+
+
+default_resolver = Resolver()
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+# Simulated Home Connect appliances for load and soak tests of hc2mqtt
+#
+# Every VirtualAppliance is a websocket server on localhost that speaks the
+# device side of the protocol: the HTTP-mode AES/HMAC framing, or TLS-PSK
+# where Python supports PSK servers (3.13+). It opens the session with
+# /ei/initialValues, answers the handshake requests HCDevice sends, applies
+# /ro/values writes and sends a stream of random value changes. Its values
+# come from the features of a devices.json entry.
+#
+# The command line starts any number of appliances cloned from devices.json
+# on consecutive ports of one event loop, and writes a devices.json that
+# points hc2mqtt at them:
+#
+#   python3 HCSimulator.py -d config/devices.json --count 200 --out sim-devices.json
+
+import asyncio
+import json
+import random
+import ssl
+import sys
+import time
+from base64 import urlsafe_b64decode as base64url
+
+import click
+
+from HCAsync import (
+    MAX_HEADER_SIZE,
+    OPCODE_BINARY,
+    OPCODE_CLOSE,
+    OPCODE_CONTINUATION,
+    OPCODE_PING,
+    OPCODE_PONG,
+    OPCODE_TEXT,
+    encode_ws_frame,
+    read_ws_frame,
+    websocket_accept,
+)
+from HCCrypto import CLIENT_TO_DEVICE, DEVICE_TO_CLIENT, FrameCodec
+from HCFeature import parse_number
+from HCSocket import encode_frame, hmac
+from utils import now
+
+SERVICES = [
+    {"service": "ci", "version": 3},
+    {"service": "ei", "version": 2},
+    {"service": "iz", "version": 1},
+    {"service": "ni", "version": 1},
+    {"service": "ro", "version": 1},
+]
+
+
+def initial_value(feature):
+    """Return the value an appliance would report for a feature before anything changed."""
+    values = feature.get("values")
+    if values:
+        return int(next(iter(values)))
+    if feature.get("refCID") == "01":
+        return False
+    init_value = parse_number(feature.get("initValue"))
+    if isinstance(init_value, (int, float)):
+        return init_value
+    minimum = parse_number(feature.get("min"))
+    if isinstance(minimum, (int, float)):
+        return minimum
+    return 0
+
+
+def changed_value(feature, value, rnd):
+    """Return a different value for a feature, as a value-change stream would send."""
+    values = feature.get("values")
+    if values:
+        keys = [int(k) for k in values if int(k) != value]
+        return rnd.choice(keys) if keys else value
+    if isinstance(value, bool):
+        return not value
+    minimum = parse_number(feature.get("min"))
+    maximum = parse_number(feature.get("max"))
+    if isinstance(minimum, (int, float)) and isinstance(maximum, (int, float)):
+        step = parse_number(feature.get("stepSize"))
+        if not isinstance(step, (int, float)) or step <= 0:
+            step = 1
+        return minimum + step * rnd.randrange(int((maximum - minimum) / step) + 1)
+    return value + 1
+
+
+class VirtualAppliance:
+    """One simulated appliance, serving one websocket client at a time.
+
+    change_interval is the number of seconds between value changes and
+    changes the number of values in each NOTIFY. A change_interval of 0
+    sends no changes.
+    """
+
+    def __init__(
+        self, device, host="127.0.0.1", port=0, change_interval=1.0, changes=1, seed=None
+    ):
+        self.name = device["name"]
+        self.host = host
+        self.port = port
+        self.change_interval = change_interval
+        self.changes = changes
+        self.rnd = random.Random(seed)
+        self.psk = base64url(device["key"] + "===")
+        self.http = "iv" in device
+        if self.http:
+            self.iv = base64url(device["iv"] + "===")
+            self.enckey = hmac(self.psk, b"ENC")
+            self.mackey = hmac(self.psk, b"MAC")
+
+        self.features = {}
+        self.values = {}
+        for uid, feature in device.get("features", {}).items():
+            self.features[int(uid)] = feature
+            access = str(feature.get("access", "")).lower()
+            if feature.get("refCID") is not None and access in ("read", "readwrite"):
+                self.values[int(uid)] = initial_value(feature)
+
+        self.server = None
+        self.codec = None
+        self.writer = None
+        self.session_id = self.rnd.randrange(1, 1 << 31)
+        self.tx_msg_id = self.rnd.randrange(1, 1 << 31)
+        self.frames_in = 0
+        self.frames_out = 0
+
+    async def start(self):
+        context = None if self.http else self.tls_context()
+        self.server = await asyncio.start_server(self.handle, self.host, self.port, ssl=context)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    def tls_context(self):
+        if not hasattr(ssl.SSLContext, "set_psk_server_callback"):
+            raise NotImplementedError("simulating TLS-PSK appliances needs Python 3.13 or newer")
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.maximum_version = ssl.TLSVersion.TLSv1_2
+        context.set_ciphers("PSK")
+        psk = self.psk
+        context.set_psk_server_callback(lambda identity: psk)
+        return context
+
+    def next_msg_id(self):
+        self.tx_msg_id += 1
+        return self.tx_msg_id
+
+    def send(self, msg):
+        buf = encode_frame(msg)
+        if self.http:
+            frame = encode_ws_frame(OPCODE_BINARY, self.codec.encrypt(buf), mask=False)
+        else:
+            frame = encode_ws_frame(OPCODE_TEXT, buf.encode("utf-8"), mask=False)
+        self.writer.write(frame)
+        self.frames_out += 1
+
+    def notify(self, resource, data):
+        self.send(
+            {
+                "sID": self.session_id,
+                "msgID": self.next_msg_id(),
+                "resource": resource,
+                "version": 1,
+                "action": "NOTIFY",
+                "data": data,
+            }
+        )
+
+    def respond(self, msg, data=None, code=None):
+        reply = {
+            "sID": msg["sID"],
+            "msgID": msg["msgID"],
+            "resource": msg["resource"],
+            "version": msg["version"],
+            "action": "RESPONSE",
+        }
+        if code is not None:
+            reply["code"] = code
+        elif data is not None:
+            reply["data"] = data
+        self.send(reply)
+
+    def device_info(self):
+        return {
+            "deviceID": f"SIM{self.port:08d}",
+            "eNumber": "SIM000000/01",
+            "brand": "SIMULATOR",
+            "vib": "SIM000000",
+            "mac": "02-00-00-%02X-%02X-%02X" % (0, self.port >> 8 & 0xFF, self.port & 0xFF),
+            "haVersion": "1.4",
+            "swVersion": "3.2.10.20200911163726",
+            "hwVersion": "2.0.0.2",
+            "deviceType": "Simulator",
+            "deviceInfo": "",
+            "customerIndex": "01",
+            "serialNumber": f"{self.port:012d}",
+            "fdString": "0000",
+            "shipSki": "0000000000000000000000000000000000000000",
+        }
+
+    def handle_request(self, msg):
+        resource = msg["resource"]
+        action = msg["action"]
+        if action in ("RESPONSE", "NOTIFY"):
+            return
+        if resource == "/ci/services":
+            self.respond(msg, SERVICES)
+        elif resource in ("/iz/info", "/ci/info"):
+            self.respond(msg, [self.device_info()])
+        elif resource == "/ci/authentication":
+            self.respond(msg, [{"response": "simulated"}])
+        elif resource == "/ni/info":
+            self.respond(msg, [{"interfaceID": 0, "ipV4": {"ipAddress": self.host}}])
+        elif resource == "/ro/allMandatoryValues":
+            self.respond(msg, [{"uid": uid, "value": v} for uid, v in self.values.items()])
+        elif resource == "/ro/allDescriptionChanges":
+            self.respond(
+                msg,
+                [
+                    {"uid": uid, "available": True, "access": feature.get("access")}
+                    for uid, feature in self.features.items()
+                    if feature.get("access") is not None
+                ],
+            )
+        elif resource == "/ro/values" and action == "POST":
+            data = msg.get("data", [])
+            for item in data:
+                self.values[item["uid"]] = item["value"]
+            self.respond(msg)
+            self.notify("/ro/values", data)
+        elif resource in ("/ro/activeProgram", "/ro/selectedProgram") and action == "POST":
+            self.respond(msg)
+        else:
+            self.respond(msg, code=404)
+
+    async def change_values(self):
+        uids = list(self.values)
+        if not uids or self.change_interval <= 0:
+            return
+        while True:
+            await asyncio.sleep(self.change_interval)
+            data = []
+            for uid in self.rnd.sample(uids, min(self.changes, len(uids))):
+                self.values[uid] = changed_value(self.features[uid], self.values[uid], self.rnd)
+                data.append({"uid": uid, "value": self.values[uid]})
+            self.notify("/ro/values", data)
+
+    async def upgrade(self, reader, writer):
+        request = await reader.readuntil(b"\r\n\r\n")
+        if len(request) > MAX_HEADER_SIZE:
+            raise ConnectionError("websocket upgrade request too long")
+        headers = {}
+        for line in request.decode("latin-1").split("\r\n")[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        writer.write(
+            (
+                "HTTP/1.1 101 Switching Protocols\r\n"
+                "Upgrade: websocket\r\n"
+                "Connection: Upgrade\r\n"
+                f"Sec-WebSocket-Accept: {websocket_accept(headers['sec-websocket-key'])}\r\n"
+                "\r\n"
+            ).encode()
+        )
+
+    async def handle(self, reader, writer):
+        if self.writer is not None:
+            # Appliances only talk to one client at a time
+            writer.close()
+            return
+        self.writer = writer
+        if self.http:
+            self.codec = FrameCodec(
+                self.enckey, self.mackey, self.iv, rx=CLIENT_TO_DEVICE, tx=DEVICE_TO_CLIENT
+            )
+        changes = None
+        try:
+            await self.upgrade(reader, writer)
+            self.session_id += 1
+            self.send(
+                {
+                    "sID": self.session_id,
+                    "msgID": self.next_msg_id(),
+                    "resource": "/ei/initialValues",
+                    "version": 2,
+                    "action": "POST",
+                    "data": [{"edMsgID": self.rnd.randrange(1, 1 << 31)}],
+                }
+            )
+            changes = asyncio.ensure_future(self.change_values())
+            fragments = []
+            while True:
+                fin, opcode, payload = await read_ws_frame(reader.readexactly)
+                if opcode == OPCODE_PING:
+                    writer.write(encode_ws_frame(OPCODE_PONG, payload, mask=False))
+                    continue
+                if opcode == OPCODE_PONG:
+                    continue
+                if opcode == OPCODE_CLOSE:
+                    writer.write(encode_ws_frame(OPCODE_CLOSE, payload, mask=False))
+                    break
+                if opcode != OPCODE_CONTINUATION:
+                    fragments = []
+                fragments.append(payload)
+                if not fin:
+                    continue
+                message = b"".join(fragments)
+                if self.http:
+                    message = self.codec.decrypt(message)
+                    if message is None:
+                        break
+                self.frames_in += 1
+                self.handle_request(json.loads(message))
+        except (ConnectionError, asyncio.IncompleteReadError, ssl.SSLError):
+            pass
+        finally:
+            if changes is not None:
+                changes.cancel()
+            self.writer = None
+            writer.close()
+
+
+async def run_appliances(appliances, duration=None, report_interval=10):
+    """Start the appliances and report the frames they exchanged until duration has passed."""
+    for appliance in appliances:
+        await appliance.start()
+    print(now(), f"{len(appliances)} appliances listening", flush=True)
+    start = time.monotonic()
+    try:
+        while duration is None or time.monotonic() - start < duration:
+            await asyncio.sleep(report_interval)
+            connected = sum(appliance.writer is not None for appliance in appliances)
+            frames_in = sum(appliance.frames_in for appliance in appliances)
+            frames_out = sum(appliance.frames_out for appliance in appliances)
+            print(
+                now(),
+                f"{connected} connected, {frames_in} frames in, {frames_out} frames out",
+                flush=True,
+            )
+    finally:
+        for appliance in appliances:
+            await appliance.stop()
+
+
+@click.command()
+@click.option("-d", "--devices_file", default="config/devices.json")
+@click.option("--count", default=1, type=int, help="Number of appliances to start")
+@click.option("--host", default="127.0.0.1")
+@click.option("--base_port", default=18000, type=int)
+@click.option("--change_interval", default=1.0, type=float, help="Seconds between changes")
+@click.option("--changes", default=1, type=int, help="Values changed in each NOTIFY")
+@click.option("--duration", type=float, help="Seconds to run, forever by default")
+@click.option("--out", "out_file", default="sim-devices.json")
+def simulate(devices_file, count, host, base_port, change_interval, changes, duration, out_file):
+    """Run simulated appliances cloned from devices.json."""
+    with open(devices_file, "r") as f:
+        templates = json.load(f)
+
+    appliances = []
+    devices = []
+    for i in range(count):
+        device = dict(templates[i % len(templates)])
+        device["name"] = f"{device['name']}_sim{i}"
+        device["host"] = host
+        device["port"] = base_port + i
+        appliances.append(
+            VirtualAppliance(device, host, device["port"], change_interval, changes, seed=i)
+        )
+        devices.append(device)
+
+    with open(out_file, "w") as f:
+        json.dump(devices, f, indent=4)
+    print(now(), f"wrote {out_file}, run hc2mqtt -d {out_file}", file=sys.stderr)
+
+    try:
+        asyncio.run(run_appliances(appliances, duration))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    simulate()
@@ -1,19 +1,23 @@
 # Create a websocket that wraps a connection to a
 # Bosh-Siemens Home Connect device
+import errno
 import ipaddress
-import json
-import re
+import os
+import selectors
 import socket
 import ssl
 import sys
-import threading
+import time
 from base64 import urlsafe_b64decode as base64url
 
 import websocket
-from Crypto.Cipher import AES
-from Crypto.Hash import HMAC, SHA256
-from Crypto.Random import get_random_bytes
 
+import HCCrypto
+import jsoncodec
+from HCCrypto import FrameCodec
+from HCKeepAlive import keepalive_for
+from HCResolver import default_resolver
+from HCStats import FrameStats
 from utils import now
 
 
@@ -41,14 +45,237 @@ if sys.version_info[1] < 13:
         print("Unable to import sslpsk library, will use OpenSSL if available")
 
 
+# Serialized "resource", "version" and "action" members of outgoing frames,
+# keyed by (resource, version, action). Appliances use the same few resources
+# so the cache is shared by every socket.
+_frame_templates = {}
+MAX_FRAME_TEMPLATES = 256
+FRAME_KEYS = frozenset(("sID", "msgID", "resource", "version", "action", "data"))
+
+
+def frame_template(resource, version, action):
+    key = (resource, version, action)
+    template = _frame_templates.get(key)
+    if template is None:
+        template = jsoncodec.dumps_frame(
+            {"resource": resource, "version": version, "action": action}
+        )
+        template = "," + template[1:-1].replace("'", '"')
+        if len(_frame_templates) >= MAX_FRAME_TEMPLATES:
+            _frame_templates.clear()
+        _frame_templates[key] = template
+    return template
+
+
+def encode_frame(msg):
+    """Serialize a message for the device, replacing every ' with ".
+
+    Frames with integer sID and msgID are built from a cached template so only
+    the ids and the data are serialized, anything else takes the slow path.
+    """
+    sid = msg.get("sID")
+    msg_id = msg.get("msgID")
+    if (
+        type(sid) is not int
+        or type(msg_id) is not int
+        or len(msg) != 5 + ("data" in msg)
+        or not FRAME_KEYS.issuperset(msg)
+    ):
+        buf = jsoncodec.dumps_frame(msg)
+        return buf.replace("'", '"') if "'" in buf else buf
+
+    buf = f'{{"sID":{sid},"msgID":{msg_id}'
+    buf += frame_template(msg["resource"], msg["version"], msg["action"])
+    if "data" in msg:
+        data = jsoncodec.dumps_frame(msg["data"])
+        if "'" in data:
+            data = data.replace("'", '"')
+        buf += ',"data":' + data
+    return buf + "}"
+
+
+# Deadlines in seconds for the phases of a connection
+CONNECT_TIMEOUT = 10
+TLS_TIMEOUT = 10
+UPGRADE_TIMEOUT = 10
+# Timeout of blocking socket operations once connected
+SOCKET_TIMEOUT = 10
+
+
+def set_keepalive(sock):
+    # A silent peer is dropped after idle + interval * count seconds, or when
+    # sent data stays unacknowledged for user_timeout
+    idle = 10
+    interval = 5
+    count = 3
+    user_timeout = 30
+    if sys.platform.startswith("linux"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, user_timeout * 1000)
+
+    elif sys.platform == "darwin":
+        TCP_KEEPALIVE = 0x10
+        sock.setsockopt(socket.IPPROTO_TCP, TCP_KEEPALIVE, idle)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+
+    elif sys.platform.startswith("win"):
+        sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, idle * 1000, interval * 1000))
+
+
+def wait_for(sock, events, deadline, what):
+    """Wait until sock is ready for events, raising TimeoutError at the deadline."""
+    with selectors.DefaultSelector() as selector:
+        selector.register(sock, events)
+        if not selector.select(max(0, deadline - time.monotonic())):
+            raise TimeoutError(f"{what} timed out")
+
+
+# Seconds before the next address is tried while the earlier attempts are still running
+CONNECT_ATTEMPT_DELAY = 0.25
+
+
+class KeepAliveDispatcher:
+    """Read loop for websocket-client that pings the appliance when it goes quiet.
+
+    Wraps the dispatcher websocket-client creates, which still sends the
+    frames, and replaces its read loop with one that sleeps until the next
+    keepalive deadline, so no ping thread is needed. A missed pong raises
+    WebSocketTimeoutException, which closes the connection.
+
+    create_dispatcher() and the dispatcher's read() are not documented
+    websocket-client API, requirements.txt pins the versions this was tested
+    with and TestWebsocketClientAPI checks they still match.
+    """
+
+    def __init__(self, app, dispatcher, keepalive):
+        self.app = app
+        self.dispatcher = dispatcher
+        self.keepalive = keepalive
+
+    def __getattr__(self, name):
+        return getattr(self.dispatcher, name)
+
+    def read(self, sock, read_callback, check_callback):
+        keepalive = self.keepalive
+        keepalive.connected()
+        with selectors.DefaultSelector() as selector:
+            selector.register(sock, selectors.EVENT_READ)
+            while self.app.keep_running:
+                # TLS records already read from the socket don't wake the selector
+                buffered = isinstance(sock, ssl.SSLSocket) and sock.pending()
+                if buffered or selector.select(keepalive.poll_timeout()):
+                    if not read_callback():
+                        break
+                    keepalive.received()
+                action = keepalive.check()
+                if action == "ping":
+                    self.app.sock.ping(keepalive.ping())
+                elif action == "dead":
+                    raise websocket.WebSocketTimeoutException("ping/pong timed out")
+
+
+class KeepAliveApp(websocket.WebSocketApp):
+    def __init__(self, url, keepalive, **kwargs):
+        super().__init__(url, **kwargs)
+        self.keepalive = keepalive
+
+    def create_dispatcher(self, *args, **kwargs):
+        dispatcher = super().create_dispatcher(*args, **kwargs)
+        return KeepAliveDispatcher(self, dispatcher, self.keepalive)
+
+
+def connect_staggered(addresses, deadline, delay=CONNECT_ATTEMPT_DELAY):
+    """Connect to the first address that answers, returning the socket and its address.
+
+    A new attempt is started every delay seconds, or as soon as one fails,
+    while the earlier ones keep running (RFC 8305), so an unreachable
+    address only costs delay instead of the whole connect timeout.
+    """
+    queue = list(addresses)
+    pending = {}
+    error = None
+    next_attempt = time.monotonic()
+    with selectors.DefaultSelector() as selector:
+        try:
+            while queue or pending:
+                if queue and (not pending or time.monotonic() >= next_attempt):
+                    family, type_, proto, _, address = queue.pop(0)
+                    sock = socket.socket(family, type_, proto)
+                    sock.setblocking(False)
+                    err = sock.connect_ex(address)
+                    if err == 0:
+                        return sock, address
+                    if err not in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                        sock.close()
+                        error = OSError(err, os.strerror(err), address[0])
+                        continue
+                    selector.register(sock, selectors.EVENT_WRITE)
+                    pending[sock] = address
+                    next_attempt = time.monotonic() + delay
+
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    tried = ", ".join(address[0] for address in pending.values())
+                    raise TimeoutError(f"connect to {tried} timed out")
+                if queue:
+                    timeout = min(timeout, next_attempt - time.monotonic())
+                for key, _ in selector.select(max(0, timeout)):
+                    sock = key.fileobj
+                    selector.unregister(sock)
+                    address = pending.pop(sock)
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err == 0:
+                        return sock, address
+                    sock.close()
+                    error = OSError(err, os.strerror(err), address[0])
+                    next_attempt = time.monotonic()
+            raise error or OSError("no address to connect to")
+        finally:
+            for sock in pending:
+                sock.close()
+
+
+def tls_handshake(sock, deadline):
+    """Run the handshake of a non-blocking SSLSocket, waiting on a selector between steps."""
+    sock.setblocking(False)
+    while True:
+        try:
+            sock.do_handshake()
+            break
+        except ssl.SSLWantReadError:
+            wait_for(sock, selectors.EVENT_READ, deadline, "TLS handshake")
+        except ssl.SSLWantWriteError:
+            wait_for(sock, selectors.EVENT_WRITE, deadline, "TLS handshake")
+    sock.setblocking(True)
+    sock.settimeout(SOCKET_TIMEOUT)
+
+
+# TLS context and last session of every TLS-PSK appliance, keyed by
+# (host, psk). HCSocket is created again for every reconnect, so they are
+# kept here for the next connection to reuse and resume.
+_tls_contexts = {}
+_tls_sessions = {}
+
+
+def tls_psk_mechanism():
+    """Return the TLS-PSK implementation in use, "native", "sslpsk" or None."""
+    if sys.version_info[1] >= 13 and ssl.HAS_PSK:
+        return "native"
+    if "sslpsk" in sys.modules:
+        return "sslpsk"
+    return None
+
+
 # Convience to compute an HMAC on a message
 def hmac(key, msg):
-    mac = HMAC.new(key, msg=msg, digestmod=SHA256).digest()
+    mac = HCCrypto.default_backend.hmac(key, msg).digest()
     return mac
 
 
 class HCSocket:
-    def __init__(self, host, psk64, iv64=None, domain_suffix="", debug=False):
+    def __init__(self, host, psk64, iv64=None, domain_suffix="", debug=False, port=None):
         self.host = host
         if domain_suffix and not is_ip_address(host):
             self.host = f"{host}.{domain_suffix}"
@@ -65,125 +292,166 @@ class HCSocket:
             self.iv = base64url(iv64 + "===")
             self.enckey = hmac(self.psk, b"ENC")
             self.mackey = hmac(self.psk, b"MAC")
-            self.port = 80
-            self.uri = f"ws://{host}:80/homeconnect"
+            self.codec = FrameCodec(self.enckey, self.mackey, self.iv)
+            self.port = port or 80
+            self.uri = f"ws://{host}:{self.port}/homeconnect"
         else:
             self.http = False
-            self.port = 443
-            self.uri = f"wss://{host}:443/homeconnect"
+            self.port = port or 443
+            self.uri = f"wss://{host}:{self.port}/homeconnect"
+        self.resolver = default_resolver
+        # Set to an HCReplay.FrameRecorder to record the decrypted frames
+        self.recorder = None
+        # Keyed by port too, simulated appliances share one host
+        self.keepalive = keepalive_for(f"{self.host}:{self.port}")
+        # Seconds taken by each phase of the last connection
+        self.timings = {}
+        self.frame_stats = FrameStats()
+        # Filled in by wrap_socket_psk
+        self.tls_handshake_duration = None
+        self.tls_session_reused = None
 
     # restore the encryption state for a fresh connection
     # this is only used by the HTTP connection
     def reset(self):
         if not self.http:
             return
-        self.last_rx_hmac = bytes(16)
-        self.last_tx_hmac = bytes(16)
-
-        self.aes_encrypt = AES.new(self.enckey, AES.MODE_CBC, self.iv)
-        self.aes_decrypt = AES.new(self.enckey, AES.MODE_CBC, self.iv)
-
-    # hmac an inbound or outbound message, chaining the last hmac too
-    def hmac_msg(self, direction, enc_msg):
-        hmac_msg = self.iv + direction + enc_msg
-        return hmac(self.mackey, hmac_msg)[0:16]
-
-    def wrap_socket_psk(self, tcp_socket):
+        self.codec.reset()
+
+    # The TLS context of an appliance is created once and reused by every
+    # reconnect, so its last session can be resumed
+    def tls_context(self):
+        key = (self.host, self.psk)
+        context = _tls_contexts.get(key)
+        if context is None:
+            context = self.create_tls_context()
+            _tls_contexts[key] = context
+        return context
+
+    def create_tls_context(self):
+        mechanism = tls_psk_mechanism()
+        psk = self.psk
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        # TLSv1.3 doesn't appear to be supported
+        context.maximum_version = ssl.TLSVersion.TLSv1_2
+        # Allow session tickets for appliances that issue them
+        context.options &= ~ssl.OP_NO_TICKET
+        if mechanism == "native":
+            context.minimum_version = ssl.TLSVersion.SSLv3
+            context.set_ciphers("PSK")  # Originally ECDHE-PSK-CHACHA20-POLY1305a
+            # Identity hint from server is HCCOM_Local_App but can be null
+            context.set_psk_client_callback(lambda hint: ("HCCOM_Local_App", psk))
+        elif mechanism == "sslpsk":
+            context.minimum_version = ssl.TLSVersion.TLSv1_2
+            context.set_ciphers("ECDHE-PSK-CHACHA20-POLY1305")
+        else:
+            raise NotImplementedError("No suitable TLS-PSK mechanism is available.")
+        return context
+
+    def wrap_socket_psk(self, tcp_socket, deadline=None):
+        if deadline is None:
+            deadline = time.monotonic() + TLS_TIMEOUT
+        mechanism = tls_psk_mechanism()
+        session = self.tls_session()
+        start = time.monotonic()
         # TLS-PSK implemented in Python3.13
-        if sys.version_info[1] >= 13 and ssl.HAS_PSK:
+        if mechanism == "native":
             try:
                 self.dprint("Using native TLS-PSK")
-                context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-                context.check_hostname = False
-                context.verify_mode = ssl.CERT_NONE
-                # TLSv1.3 doesn't appear to be supported
-                context.maximum_version = ssl.TLSVersion.TLSv1_2
-                context.minimum_version = ssl.TLSVersion.SSLv3
-                context.set_ciphers("PSK")  # Originally ECDHE-PSK-CHACHA20-POLY1305a
-                # Identity hint from server is HCCOM_Local_App but can be null
-                context.set_psk_client_callback(lambda hint: ("HCCOM_Local_App", self.psk))
+                context = self.tls_context()
                 self.dprint("Wrapping socket...")
-                return context.wrap_socket(tcp_socket, server_hostname=self.host)
+                sock = context.wrap_socket(
+                    tcp_socket,
+                    server_hostname=self.host,
+                    do_handshake_on_connect=False,
+                    session=session,
+                )
+                tls_handshake(sock, deadline)
             except Exception as e:
+                self.forget_tls_session()
                 print(e)
-        # sslpsk needs wrap_socket which was removed in 3.12 but may be fixed
-        elif "sslpsk" in sys.modules:
+                return None
+        # sslpsk sets the PSK callback on a socket wrapped by our context
+        elif mechanism == "sslpsk":
             self.dprint("Using sslpsk")
             try:
-                return sslpsk.wrap_socket(
-                    tcp_socket,
-                    ssl_version=ssl.PROTOCOL_TLSv1_2,
-                    ciphers="ECDHE-PSK-CHACHA20-POLY1305",
-                    psk=self.psk,
+                context = self.tls_context()
+                sock = context.wrap_socket(
+                    tcp_socket, do_handshake_on_connect=False, session=session
                 )
-            except AttributeError as e:
-                raise NotImplementedError("sslpsk requires ssl.wrap_socket") from e
+                self.set_sslpsk_callback(sock)
+                tls_handshake(sock, deadline)
+            except NotImplementedError:
+                raise
+            except Exception:
+                self.forget_tls_session()
+                raise
         else:
             raise NotImplementedError("No suitable TLS-PSK mechanism is available.")
 
-    def decrypt(self, buf):
-        if len(buf) < 32:
-            print("Short message?", buf.hex(), file=sys.stderr)
-            return None
-        if len(buf) % 16 != 0:
-            print("Unaligned message? probably bad", buf.hex(), file=sys.stderr)
-
-        # split the message into the encrypted message and the first 16-bytes of the HMAC
-        enc_msg = buf[0:-16]
-        their_hmac = buf[-16:]
-
-        # compute the expected hmac on the encrypted message
-        our_hmac = self.hmac_msg(b"\x43" + self.last_rx_hmac, enc_msg)
+        self.tls_established(sock, start)
+        return sock
 
-        if their_hmac != our_hmac:
-            print("HMAC failure", their_hmac.hex(), our_hmac.hex(), file=sys.stderr)
-            return None
-
-        self.last_rx_hmac = their_hmac
+    def tls_session(self):
+        return _tls_sessions.get((self.host, self.psk))
 
-        # decrypt the message with CBC, so the last message block is mixed in
-        msg = self.aes_decrypt.decrypt(enc_msg)
+    def forget_tls_session(self):
+        _tls_sessions.pop((self.host, self.psk), None)
 
-        # check for padding and trim it off the end
-        pad_len = msg[-1]
-        if len(msg) < pad_len:
-            print("padding error?", msg.hex())
-            return None
+    # sslpsk sets the PSK callback on the SSLSocket or SSLObject before the handshake
+    def set_sslpsk_callback(self, ssl_obj):
+        try:
+            sslpsk.sslpsk._ssl_set_psk_client_callback(ssl_obj, lambda hint: (self.psk, b""))
+        except AttributeError as e:
+            raise NotImplementedError("sslpsk can't set the PSK callback") from e
+
+    # Record the handshake time and keep the session for the next connection
+    def tls_established(self, ssl_obj, start):
+        self.tls_handshake_duration = time.monotonic() - start
+        self.timings["tls"] = self.tls_handshake_duration
+        self.tls_session_reused = ssl_obj.session_reused
+        if ssl_obj.session is not None:
+            _tls_sessions[(self.host, self.psk)] = ssl_obj.session
+        resumed = "resumed session" if self.tls_session_reused else "full handshake"
+        self.dprint("TLS:", f"{resumed} in {self.tls_handshake_duration:.3f}s")
 
-        return msg[0:-pad_len]
+    def decrypt(self, buf):
+        start = time.perf_counter()
+        msg = self.codec.decrypt(buf)
+        self.frame_stats.decrypt_seconds += time.perf_counter() - start
+        return msg
 
     def encrypt(self, clear_msg):
-        # convert the UTF-8 string into a byte array
-        clear_msg = bytes(clear_msg, "utf-8")
-
-        # pad the buffer, adding an extra block if necessary
-        pad_len = 16 - (len(clear_msg) % 16)
-        if pad_len == 1:
-            pad_len += 16
-        pad = b"\x00" + get_random_bytes(pad_len - 2) + bytearray([pad_len])
-
-        clear_msg = clear_msg + pad
-
-        # encrypt the padded message with CBC, so there is chained
-        # state from the last cipher block sent
-        enc_msg = self.aes_encrypt.encrypt(clear_msg)
-
-        # compute the hmac of the encrypted message, chaining the
-        # hmac of the previous message plus direction 'E'
-        self.last_tx_hmac = self.hmac_msg(b"\x45" + self.last_tx_hmac, enc_msg)
-
-        # append the new hmac to the message
-        return enc_msg + self.last_tx_hmac
+        start = time.perf_counter()
+        frame = self.codec.encrypt(clear_msg)
+        self.frame_stats.encrypt_seconds += time.perf_counter() - start
+        return frame
 
     def send(self, msg):
-        buf = json.dumps(msg, separators=(",", ":"))
-        # swap " for '
-        buf = re.sub("'", '"', buf)
+        buf = encode_frame(msg)
         self.dprint("TX:", buf)
         if self.http:
-            self.ws.send_bytes(self.encrypt(buf))
+            frame = self.encrypt(buf)
+            self.ws.send_bytes(frame)
         else:
+            frame = buf
             self.ws.send(buf)
+        self.frame_stats.sent(len(frame))
+        if self.recorder is not None:
+            self.recorder.sent(buf)
+
+    def stats(self):
+        """Counters of the current connection."""
+        stats = self.frame_stats.summary()
+        if self.http:
+            stats["hmac_failures"] = self.codec.hmac_failures
+        else:
+            stats["tls_session_reused"] = self.tls_session_reused
+        stats["connect_ms"] = {phase: round(t * 1000, 1) for phase, t in self.timings.items()}
+        stats["keepalive"] = self.keepalive.stats()
+        return stats
 
     def recv(self):
         buf = self.ws.recv()
@@ -198,61 +466,43 @@ class HCSocket:
         self.dprint("RX:", buf)
         return buf
 
-    def run_forever(self, on_message, on_open, on_close, on_error):
-        self.reset()
+    def connect_socket(self, deadline):
+        self.dprint("connecting to tcp socket: " + self.host + ":" + str(self.port))
+        start = time.monotonic()
+        addresses = self.resolver.resolve(self.host, self.port)
+        self.timings["resolve"] = time.monotonic() - start
 
-        def connect_socket():
-            try:
-                self.dprint("connecting to tcp socket: " + self.host + ":" + str(self.port))
-                sock = socket.create_connection((self.host, self.port), timeout=10)
-                self.dprint("connected to socket")
-                idle = 30
-                interval = 10
-                count = 3
-                if sys.platform.startswith("linux"):
-                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
-                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
-                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
-
-                elif sys.platform == "darwin":
-                    TCP_KEEPALIVE = 0x10
-                    sock.setsockopt(socket.IPPROTO_TCP, TCP_KEEPALIVE, idle)
-                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
-
-                elif sys.platform.startswith("win"):
-                    sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, idle * 1000, interval * 1000))
-
-                self.dprint("connected to tcp socket: " + self.host + ":" + str(self.port))
-                return sock
-            except Exception as e:
-                self.dprint(f"socket connection failed: {e}")
-                return None
-
-        # Create a thread for the socket connection to ensure timeout works
-        sock = None
-        connection_event = threading.Event()
-
-        def connect_in_thread():
-            nonlocal sock
-            sock = connect_socket()
-            connection_event.set()
+        start = time.monotonic()
+        try:
+            sock, address = connect_staggered(addresses, deadline)
+        except OSError:
+            self.resolver.failed(self.host, self.port)
+            raise
+        self.resolver.remember(self.host, self.port, address)
+        self.timings["connect"] = time.monotonic() - start
+        self.dprint("connected to socket")
 
-        thread = threading.Thread(target=connect_in_thread)
-        thread.daemon = True
-        thread.start()
+        sock.setblocking(True)
+        sock.settimeout(SOCKET_TIMEOUT)
+        set_keepalive(sock)
+        self.dprint("connected to tcp socket: " + self.host + ":" + str(self.port))
+        return sock
 
-        # Wait for connection with timeout
-        if not connection_event.wait(timeout=15):  # 15 second timeout for connection
-            self.dprint("socket connection timeout")
-            return
+    def run_forever(self, on_message, on_open, on_close, on_error):
+        self.reset()
+        self.timings = {}
+        self.frame_stats = FrameStats()
 
-        if sock is None:
+        try:
+            sock = self.connect_socket(time.monotonic() + CONNECT_TIMEOUT)
+        except Exception as e:
+            self.dprint(f"socket connection failed: {e}")
             return
 
         if not self.http:
             self.dprint("wrapping socket: " + self.host + ":" + str(self.port))
             try:
-                sock = self.wrap_socket_psk(sock)
+                sock = self.wrap_socket_psk(sock, time.monotonic() + TLS_TIMEOUT)
                 if sock is not None:
                     self.dprint("wrapping complete: " + self.host + ":" + str(self.port))
                 else:
@@ -265,8 +515,19 @@ class HCSocket:
         if sock is None:
             return
 
+        # The upgrade request is sent by websocket-client on the socket we
+        # pass in, so it is bounded by the socket timeout
+        sock.settimeout(UPGRADE_TIMEOUT)
+        upgrade_start = time.monotonic()
+
         def _on_open(ws):
+            self.timings["upgrade"] = time.monotonic() - upgrade_start
+            sock.settimeout(SOCKET_TIMEOUT)
             self.dprint("on connect")
+            phases = " ".join(f"{phase} {t * 1000:.0f}ms" for phase, t in self.timings.items())
+            self.dprint("OPEN:", self.uri, phases)
+            if self.recorder is not None:
+                self.recorder.opened(self.uri)
             on_open(ws)
 
         def _on_close(ws, close_status_code, close_msg):
@@ -274,31 +535,41 @@ class HCSocket:
             on_close(ws, close_status_code, close_msg)
 
         def _on_message(ws, message):
+            self.frame_stats.received(len(message))
             if self.http:
                 message = self.decrypt(message)
             self.dprint("RX:", message)
+            if self.recorder is not None and message is not None:
+                self.recorder.received(message)
             on_message(ws, message)
 
+        def _on_pong(ws, payload):
+            rtt = self.keepalive.pong(payload)
+            if rtt is not None:
+                self.dprint(f"pong in {rtt * 1000:.1f}ms")
+
         def _on_error(ws, error):
             self.dprint(f"error {error}")
             on_error(ws, error)
 
         print(now(), "CON:", self.uri)
-        self.ws = websocket.WebSocketApp(
+        self.ws = KeepAliveApp(
             self.uri,
+            self.keepalive,
             socket=sock,
             on_open=_on_open,
             on_message=_on_message,
             on_close=_on_close,
             on_error=_on_error,
+            on_pong=_on_pong,
         )
 
         # Set a more robust timeout for the websocket operations
         websocket.setdefaulttimeout(30)
 
-        # Add a timeout for the entire connection process
         try:
-            self.ws.run_forever(ping_interval=120, ping_timeout=10)
+            # Pings are sent by KeepAliveDispatcher
+            self.ws.run_forever()
         except Exception as e:
             self.dprint(f"websocket run_forever failed: {e}")
             # Ensure we clean up any open connections
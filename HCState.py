@@ -0,0 +1,95 @@
+# Versioned store for the values reported by a Home Connect device
+#
+# Every change bumps the store version and records it as the sequence number
+# of the key, so a consumer that remembers the version it last saw can ask for
+# changes_since(version) and only walk the keys that changed. The dirty set
+# holds the keys changed since the last take_dirty(), which is what the MQTT
+# publisher uses instead of keeping its own copy of the published values.
+
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+
+
+class DeviceState(Mapping):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = 0
+        self._values = {}
+        # key -> sequence number, kept in the order of the last change
+        self._seq = OrderedDict()
+        # Keys changed since the last take_dirty(), dict used as an ordered set
+        self._dirty = {}
+
+    def seed(self, key, value):
+        """Set a value from devices.json that the device hasn't reported yet.
+
+        Seeded values are not dirty, and the first update of the key counts
+        as a change even if the device reports the same value.
+        """
+        with self.lock:
+            self._values[key] = value
+            self._seq[key] = 0
+            self._seq.move_to_end(key, last=False)
+
+    def update(self, key, value):
+        """Store a value reported by the device. Returns True if it changed."""
+        with self.lock:
+            if self._seq.get(key, 0) and self._values[key] == value:
+                return False
+            self.version += 1
+            self._values[key] = value
+            self._seq[key] = self.version
+            self._seq.move_to_end(key)
+            self._dirty[key] = None
+            return True
+
+    def changes_since(self, version):
+        """Return {key: value} for every key changed after version, oldest first."""
+        changes = []
+        with self.lock:
+            for key in reversed(self._seq):
+                if self._seq[key] <= version:
+                    break
+                changes.append((key, self._values[key]))
+        return dict(reversed(changes))
+
+    def take_dirty(self):
+        """Return {key: value} for the keys changed since the last call and clear them."""
+        with self.lock:
+            dirty = {key: self._values[key] for key in self._dirty}
+            self._dirty = {}
+        return dirty
+
+    def mark_dirty(self, key):
+        """Make take_dirty() return key again, its last value could not be published."""
+        with self.lock:
+            if key in self._values:
+                self._dirty[key] = None
+
+    def snapshot(self):
+        """Return a copy of every value, taken under the lock."""
+        with self.lock:
+            return dict(self._values)
+
+    @property
+    def dirty(self):
+        with self.lock:
+            return set(self._dirty)
+
+    def seq(self, key):
+        """Return the sequence number of the last change to key, 0 if it was never changed."""
+        return self._seq.get(key, 0)
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self._values))
+
+    def __len__(self):
+        return len(self._values)
@@ -0,0 +1,78 @@
+# Counters for the cost of each appliance connection
+#
+# They are updated on every frame, so they are plain attributes and dict
+# entries bumped without a lock. A reader on another thread may see a
+# frame counted before its bytes, which is fine for monitoring.
+
+import time
+
+
+class FrameStats:
+    """Frames and bytes in each direction, and the time spent encrypting them."""
+
+    __slots__ = (
+        "started",
+        "frames_in",
+        "bytes_in",
+        "frames_out",
+        "bytes_out",
+        "decrypt_seconds",
+        "encrypt_seconds",
+    )
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.frames_in = 0
+        self.bytes_in = 0
+        self.frames_out = 0
+        self.bytes_out = 0
+        self.decrypt_seconds = 0.0
+        self.encrypt_seconds = 0.0
+
+    def received(self, size):
+        self.frames_in += 1
+        self.bytes_in += size
+
+    def sent(self, size):
+        self.frames_out += 1
+        self.bytes_out += size
+
+    def summary(self):
+        return {
+            "uptime": round(time.monotonic() - self.started, 1),
+            "frames_in": self.frames_in,
+            "bytes_in": self.bytes_in,
+            "frames_out": self.frames_out,
+            "bytes_out": self.bytes_out,
+            "decrypt_ms": round(self.decrypt_seconds * 1000, 3),
+            "encrypt_ms": round(self.encrypt_seconds * 1000, 3),
+        }
+
+
+class TimingStats:
+    """Count, total and maximum duration per key, e.g. per resource."""
+
+    def __init__(self):
+        # key -> [count, total seconds, max seconds]
+        self.entries = {}
+
+    def record(self, key, seconds):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.entries[key] = [1, seconds, seconds]
+            return
+        entry[0] += 1
+        entry[1] += seconds
+        if seconds > entry[2]:
+            entry[2] = seconds
+
+    def summary(self):
+        return {
+            key: {
+                "count": count,
+                "total_ms": round(total * 1000, 3),
+                "mean_us": round(total / count * 1e6, 1),
+                "max_us": round(longest * 1e6, 1),
+            }
+            for key, (count, total, longest) in list(self.entries.items())
+        }
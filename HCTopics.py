@@ -0,0 +1,75 @@
+# MQTT topic names of each device
+#
+# A device's topics are built the first time a feature is published and
+# kept, interned, for the life of the process, so publishing a value looks
+# its topic up instead of lowercasing the feature name and formatting a new
+# string every time. The cache of a device is shared by all its connections.
+
+import sys
+import threading
+
+from utils import clean_international_text
+
+
+class DeviceTopics:
+    """The state, event, command and discovery topics of one device."""
+
+    def __init__(self, mqtt_topic, name):
+        self.name = name
+        self.ident = sys.intern(clean_international_text(name))
+        self.base = sys.intern(mqtt_topic)
+        self.lwt = sys.intern(f"{mqtt_topic}/LWT")
+        self.set = sys.intern(f"{mqtt_topic}/set")
+        self.active_program = sys.intern(f"{mqtt_topic}/activeProgram")
+        self.selected_program = sys.intern(f"{mqtt_topic}/selectedProgram")
+        self.state_document = sys.intern(f"{mqtt_topic}/state")
+        self.stats = sys.intern(f"{mqtt_topic}/stats")
+        # feature name -> topic
+        self._feature_ids = {}
+        self._state = {}
+        self._event = {}
+        # (discovery prefix, component type, feature name) -> topic
+        self._discovery = {}
+
+    def feature_id(self, key):
+        """Return the topic name of a feature, e.g. bsh_common_status_doorstate."""
+        feature_id = self._feature_ids.get(key)
+        if feature_id is None:
+            feature_id = self._feature_ids[key] = sys.intern(key.lower().replace(".", "_"))
+        return feature_id
+
+    def state(self, key):
+        topic = self._state.get(key)
+        if topic is None:
+            topic = self._state[key] = sys.intern(f"{self.base}/state/{self.feature_id(key)}")
+        return topic
+
+    def event(self, key):
+        topic = self._event.get(key)
+        if topic is None:
+            topic = self._event[key] = sys.intern(f"{self.base}/event/{self.feature_id(key)}")
+        return topic
+
+    def discovery(self, prefix, component_type, key):
+        topic = self._discovery.get((prefix, component_type, key))
+        if topic is None:
+            topic = clean_international_text(
+                f"{prefix}/{component_type}/hcpy/{self.ident}_{self.feature_id(key)}/config"
+            )
+            topic = self._discovery[(prefix, component_type, key)] = sys.intern(topic)
+        return topic
+
+
+_topics = {}
+_topics_lock = threading.Lock()
+
+
+def topics_for(mqtt_topic, name):
+    """Return the topic cache of the device published under mqtt_topic."""
+    topics = _topics.get(mqtt_topic)
+    if topics is None:
+        with _topics_lock:
+            topics = _topics.get(mqtt_topic)
+            if topics is None:
+                topics = _topics[mqtt_topic] = DeviceTopics(mqtt_topic, name)
+    return topics
@@ -0,0 +1,36 @@
+# Throughput of the HCCrypto backends encrypting and decrypting HTTP-mode
+# frames of different sizes.
+#
+#   python -m benchmarks.bench_crypto_backends
+from benchmarks.common import measure
+from HCCrypto import BACKENDS, CLIENT_TO_DEVICE, DEVICE_TO_CLIENT, FrameCodec
+
+ENCKEY = bytes(range(32))
+MACKEY = bytes(range(32, 64))
+IV = bytes(range(16))
+SIZES = [64, 350, 4096, 32768]
+FRAMES = 100
+
+
+def run(backend, texts):
+    client = FrameCodec(ENCKEY, MACKEY, IV, backend=backend)
+    device = FrameCodec(
+        ENCKEY, MACKEY, IV, rx=CLIENT_TO_DEVICE, tx=DEVICE_TO_CLIENT, backend=backend
+    )
+    for text in texts:
+        device.decrypt(client.encrypt(text))
+
+
+def main():
+    for size in SIZES:
+        texts = ["x" * size] * FRAMES
+        print(f"{FRAMES} frames of {size} bytes, encrypted and decrypted")
+        for name, backend in BACKENDS.items():
+            seconds = measure(name, lambda: run(backend, texts))
+            print(f"{name:<40} {size * FRAMES / seconds / 2**20:12.1f} MiB/s")
+    if "cryptography" not in BACKENDS:
+        print("cryptography is not installed, only pycryptodome was measured")
+
+
+if __name__ == "__main__":
+    main()
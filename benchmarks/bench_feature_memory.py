@@ -0,0 +1,69 @@
+# Memory used by the features of a devices.json file, as plain dicts and as
+# Feature records.
+#
+#   python -m benchmarks.bench_feature_memory [config/devices.json]
+#
+# Without an argument a synthetic file with a dozen large appliances is used.
+import gc
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+
+from benchmarks.common import make_features
+from HCFeature import load_features
+
+
+def make_devices_file(devices=12, features=3000):
+    config = []
+    for i in range(devices):
+        config.append(
+            {
+                "name": f"appliance{i}",
+                "host": f"appliance{i}",
+                "key": "",
+                "features": make_features(features, seed=i),
+            }
+        )
+    f = tempfile.NamedTemporaryFile(mode="w", suffix=".json", delete=False)
+    json.dump(config, f)
+    f.close()
+    return f.name
+
+
+def measure_load(path, convert):
+    gc.collect()
+    tracemalloc.start()
+    with open(path, "r") as f:
+        devices = json.load(f)
+    if convert:
+        for device in devices:
+            device["features"] = load_features(device["features"])
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    count = sum(len(device["features"]) for device in devices)
+    return current, peak, count
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else make_devices_file()
+
+    try:
+        raw, raw_peak, count = measure_load(path, convert=False)
+        records, records_peak, _ = measure_load(path, convert=True)
+    finally:
+        if len(sys.argv) < 2:
+            os.unlink(path)
+
+    print(f"{path}: {count} features")
+    print(f"{'dicts':<20} {raw / 2**20:8.2f} MiB (peak {raw_peak / 2**20:.2f} MiB)")
+    print(
+        f"{'Feature records':<20} {records / 2**20:8.2f} MiB (peak {records_peak / 2**20:.2f} MiB)"
+    )
+    print(f"saved {(raw - records) / 2**20:.2f} MiB ({100 * (raw - records) / raw:.0f}%)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# Compare FrameCodec with the previous HCSocket encrypt/decrypt on the frames
+# of an HTTP (port 80) appliance.
+#
+#   python -m benchmarks.bench_frame_codec [hc2mqtt-debug.log]
+#
+# The frames are taken from the RX lines of an hc2mqtt --debug log, or from a
+# synthetic session without an argument, and encrypted as the device would.
+import sys
+
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+
+from benchmarks.common import load_traffic, make_features, make_traffic, measure
+from HCCrypto import CLIENT_TO_DEVICE, DEVICE_TO_CLIENT, FrameCodec
+from HCSocket import hmac
+
+PSK = bytes(range(32))
+IV = bytes(range(16))
+
+
+# HCSocket.encrypt/decrypt before FrameCodec
+class LegacyCodec:
+    def __init__(self, enckey, mackey, iv, rx=DEVICE_TO_CLIENT, tx=CLIENT_TO_DEVICE):
+        self.enckey = enckey
+        self.mackey = mackey
+        self.iv = iv
+        self.rx = rx
+        self.tx = tx
+        self.reset()
+
+    def reset(self):
+        self.last_rx_hmac = bytes(16)
+        self.last_tx_hmac = bytes(16)
+        self.aes_encrypt = AES.new(self.enckey, AES.MODE_CBC, self.iv)
+        self.aes_decrypt = AES.new(self.enckey, AES.MODE_CBC, self.iv)
+
+    def hmac_msg(self, direction, enc_msg):
+        hmac_msg = self.iv + direction + enc_msg
+        return hmac(self.mackey, hmac_msg)[0:16]
+
+    def decrypt(self, buf):
+        enc_msg = buf[0:-16]
+        their_hmac = buf[-16:]
+        our_hmac = self.hmac_msg(self.rx + self.last_rx_hmac, enc_msg)
+        if their_hmac != our_hmac:
+            return None
+        self.last_rx_hmac = their_hmac
+        msg = self.aes_decrypt.decrypt(enc_msg)
+        pad_len = msg[-1]
+        return msg[0:-pad_len]
+
+    def encrypt(self, clear_msg):
+        clear_msg = bytes(clear_msg, "utf-8")
+        pad_len = 16 - (len(clear_msg) % 16)
+        if pad_len == 1:
+            pad_len += 16
+        pad = b"\x00" + get_random_bytes(pad_len - 2) + bytearray([pad_len])
+        clear_msg = clear_msg + pad
+        enc_msg = self.aes_encrypt.encrypt(clear_msg)
+        self.last_tx_hmac = self.hmac_msg(self.tx + self.last_tx_hmac, enc_msg)
+        return enc_msg + self.last_tx_hmac
+
+
+def run(codec, func, frames):
+    codec.reset()
+    for frame in frames:
+        func(frame)
+
+
+def main(path=None):
+    texts = load_traffic(path) if path else make_traffic(make_features())
+    enckey = hmac(PSK, b"ENC")
+    mackey = hmac(PSK, b"MAC")
+
+    device = FrameCodec(enckey, mackey, IV, rx=CLIENT_TO_DEVICE, tx=DEVICE_TO_CLIENT)
+    frames = [device.encrypt(text) for text in texts]
+    size = sum(len(frame) for frame in frames)
+    print(f"{len(frames)} frames, average {size / len(frames):.0f} bytes")
+
+    legacy = LegacyCodec(enckey, mackey, IV)
+    codec = FrameCodec(enckey, mackey, IV)
+    run(legacy, legacy.decrypt, frames)
+    run(codec, codec.decrypt, frames)
+    legacy.reset()
+    codec.reset()
+    for frame in frames:
+        assert legacy.decrypt(frame) == codec.decrypt(frame), "codecs disagree"
+
+    for label, func, data in (("decrypt", "decrypt", frames), ("encrypt", "encrypt", texts)):
+        before = measure(f"legacy {label}", lambda: run(legacy, getattr(legacy, func), data))
+        after = measure(f"FrameCodec {label}", lambda: run(codec, getattr(codec, func), data))
+        print(f"{before / len(data) * 1e6:.1f} -> {after / len(data) * 1e6:.1f} us/frame")
+        print(f"speedup {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
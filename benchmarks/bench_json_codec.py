@@ -0,0 +1,43 @@
+# Per-frame cost of the JSON backends in jsoncodec on device traffic.
+#
+#   python -m benchmarks.bench_json_codec [hc2mqtt-debug.log]
+#
+# The argument is a log written by hc2mqtt --debug, the frames are taken from
+# its "HCSocket <host> RX:" lines. Without it a synthetic session is used.
+import sys
+
+import jsoncodec
+from benchmarks.common import load_traffic, make_features, make_traffic, measure
+
+
+def main(path=None):
+    if path:
+        frames = load_traffic(path)
+        print(f"{len(frames)} frames from {path}")
+    else:
+        frames = make_traffic(make_features())
+        print(f"{len(frames)} synthetic frames")
+    messages = [jsoncodec.BACKENDS["json"][0](frame) for frame in frames]
+    size = sum(len(frame) for frame in frames)
+    print(f"average frame {size / len(frames):.0f} bytes")
+
+    # Frames and MQTT payloads are encoded with the standard library whatever
+    # the backend, so only decoding differs between them
+    encode = measure(
+        "dumps_frame + dumps",
+        lambda: [(jsoncodec.dumps_frame(msg), jsoncodec.dumps(msg)) for msg in messages],
+    )
+    results = {}
+    for name, (loads, _) in jsoncodec.BACKENDS.items():
+        decode = measure(f"{name} loads", lambda: [loads(frame) for frame in frames])
+        results[name] = (decode + encode) / len(frames)
+        print(f"{name:<40} {results[name] * 1e6:12.1f} us/frame")
+
+    if "orjson" in results:
+        print(f"speedup {results['json'] / results['orjson']:.1f}x")
+    else:
+        print("orjson is not installed, only the json backend was measured")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
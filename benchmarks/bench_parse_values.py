@@ -0,0 +1,66 @@
+# Compare HCDevice.parse_values against the previous per-entry implementation
+# on a full /ro/allMandatoryValues payload.
+#
+#   python -m benchmarks.bench_parse_values
+import threading
+from unittest.mock import Mock
+
+from benchmarks.common import make_features, make_mandatory_values, measure
+from HCDevice import HCDevice
+
+
+# The parse_values loop as it was before decoders were compiled per UID
+def legacy_parse_values(features, features_lock, get_feature_name, values):
+    result = {}
+    for msg in values:
+        uid = str(msg["uid"])
+        value = msg.get("value", None)
+        if value is None:
+            continue
+        value_str = str(value)
+        name = uid
+        feature = None
+        with features_lock:
+            if uid in features:
+                feature = features[uid]
+        if feature:
+            if "name" in feature:
+                name = feature["name"]
+            if "values" in feature:
+                value = feature["values"].get(value_str, None)
+            refCID = feature.get("refCID", None)
+            refDID = feature.get("refDID", None)
+            if refCID == "01" and refDID == "00":
+                value = value_str.lower() in ("1", "true", "on")
+            if (
+                name == "BSH.Common.Root.SelectedProgram"
+                or name == "BSH.Common.Root.ActiveProgram"
+                or name == "BSH.Common.Option.BaseProgram"
+            ):
+                value = get_feature_name(value_str)
+                if value is not None:
+                    value = value.split(".")[-1]
+        result[name] = value
+    return result
+
+
+def main(count=3000):
+    features = make_features(count)
+    device = HCDevice(Mock(), {"name": "bench", "features": features})
+    data = make_mandatory_values(features)
+    lock = threading.Lock()
+
+    legacy = legacy_parse_values(features, lock, device.get_feature_name, data)
+    assert legacy == device.parse_values(data), "decoders disagree with legacy parser"
+
+    print(f"/ro/allMandatoryValues with {len(data)} values")
+    before = measure(
+        "legacy parse_values",
+        lambda: legacy_parse_values(features, lock, device.get_feature_name, data),
+    )
+    after = measure("compiled decoders", lambda: device.parse_values(data))
+    print(f"speedup {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
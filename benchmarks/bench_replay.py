@@ -0,0 +1,63 @@
+# Parse and publish throughput of HCDevice and hc2mqtt on recorded traffic.
+#
+#   python -m benchmarks.bench_replay [recording.hcrec]
+#
+# The argument is a file written by hc2mqtt --record_dir. Without it a
+# synthetic session is recorded to a temporary file first. The frames are
+# replayed as fast as possible, with a stub MQTT client that drops messages.
+import os
+import sys
+import tempfile
+import time
+from unittest.mock import Mock
+
+from benchmarks.common import make_features, make_traffic
+from hc2mqtt import handle_device_message
+from HCDevice import HCDevice
+from HCReplay import FrameRecorder, ReplaySocket
+
+
+def record_synthetic(path, features):
+    recorder = FrameRecorder(path)
+    recorder.opened("ws://synthetic/homeconnect")
+    for frame in make_traffic(features, notifications=5000):
+        recorder.received(frame)
+    recorder.close()
+
+
+def replay(path, features):
+    client = Mock()
+    client.is_connected.return_value = True
+    ws = ReplaySocket(path, speed=0)
+    device = HCDevice(ws, {"name": "bench", "features": features})
+    # No appliance to answer the handshake
+    device.start_handshake = lambda: None
+
+    def on_message(values):
+        handle_device_message(values, device, client, "homeconnect/bench", "bench")
+
+    start = time.perf_counter()
+    device.run_forever(on_message=on_message, on_open=lambda ws: None, on_close=lambda *a: None)
+    elapsed = time.perf_counter() - start
+    return ws.frame_stats.frames_in, elapsed, client.publish.call_count, device
+
+
+def main(path=None):
+    features = make_features()
+    with tempfile.TemporaryDirectory() as tmp:
+        if path is None:
+            path = os.path.join(tmp, "synthetic.hcrec")
+            record_synthetic(path, features)
+            print(f"synthetic recording of {os.path.getsize(path)} bytes")
+        else:
+            features = {}
+        frames, elapsed, published, device = replay(path, features)
+
+    print(f"{frames} frames in {elapsed:.3f}s, {frames / elapsed:.0f} frames/s")
+    print(f"{published} MQTT messages, {elapsed / frames * 1e6:.1f} us/frame")
+    for resource, stats in sorted(device.handler_stats.summary().items()):
+        print(f"{resource:<40} {stats['count']:8} {stats['mean_us']:10.1f} us/frame")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,59 @@
+# Compare building outgoing frames from cached templates with serializing
+# the whole message and running re.sub over it, as HCSocket.send used to.
+#
+#   python -m benchmarks.bench_send_frame
+import json
+import re
+
+from benchmarks.common import measure
+from HCSocket import encode_frame
+
+SESSION_ID = 1834234000
+HANDSHAKE = [
+    ("/ci/services", 1, "GET", None),
+    ("/ci/info", 2, "GET", None),
+    ("/iz/info", 1, "GET", None),
+    ("/ei/deviceReady", 2, "NOTIFY", None),
+    ("/ro/allDescriptionChanges", 1, "GET", None),
+    ("/ro/allMandatoryValues", 1, "GET", None),
+]
+COMMANDS = [
+    ("/ro/values", 1, "POST", [{"uid": 539, "value": 2}]),
+    ("/ro/values", 1, "POST", [{"uid": 539, "value": 3}, {"uid": 4101, "value": True}]),
+    ("/ro/activeProgram", 1, "POST", [{"program": 8196, "options": [{"uid": 558, "value": 600}]}]),
+    ("/ro/values", 1, "GET", None),
+]
+
+
+def make_messages(requests):
+    messages = []
+    for msg_id, (resource, version, action, data) in enumerate(requests * 50, 3906210000):
+        msg = {
+            "sID": SESSION_ID,
+            "msgID": msg_id,
+            "resource": resource,
+            "version": version,
+            "action": action,
+        }
+        if data is not None:
+            msg["data"] = data
+        messages.append(msg)
+    return messages
+
+
+def legacy_encode(msg):
+    buf = json.dumps(msg, separators=(",", ":"))
+    return re.sub("'", '"', buf)
+
+
+def main():
+    for label, requests in (("handshake", HANDSHAKE), ("commands", COMMANDS)):
+        messages = make_messages(requests)
+        print(f"{label}: {len(messages)} frames")
+        before = measure("json.dumps + re.sub", lambda: [legacy_encode(m) for m in messages])
+        after = measure("encode_frame", lambda: [encode_frame(m) for m in messages])
+        print(f"speedup {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+# Shared helpers for the benchmark scripts.
+#
+# Run a benchmark from the repository root, e.g.:
+#   python -m benchmarks.bench_parse_values
+import json
+import random
+import timeit
+
+PROGRAMS = ["Eco50", "Intensiv70", "Auto2", "Quick45", "PreRinse", "Favorite.001"]
+
+
+def make_features(count=3000, seed=1):
+    """Build a devices.json style feature table similar to a large oven or washer."""
+    rnd = random.Random(seed)
+    features = {}
+    uid = 256
+    for i, program in enumerate(PROGRAMS):
+        features[str(8192 + i)] = {"name": f"Dishcare.Dishwasher.Program.{program}"}
+    features["256"] = {
+        "name": "BSH.Common.Root.SelectedProgram",
+        "access": "readWrite",
+        "available": "true",
+        "refCID": "03",
+        "refDID": "80",
+    }
+    features["257"] = {
+        "name": "BSH.Common.Root.ActiveProgram",
+        "access": "readWrite",
+        "available": "true",
+        "refCID": "03",
+        "refDID": "80",
+    }
+    uid = 300
+    while len(features) < count:
+        kind = rnd.randrange(4)
+        name = f"Cooking.Oven.Option.Feature{uid}"
+        if kind == 0:
+            feature = {
+                "name": name,
+                "access": "readWrite",
+                "available": "true",
+                "refCID": "03",
+                "refDID": "80",
+                "values": {str(k): f"Label{k}" for k in range(rnd.randrange(2, 12))},
+            }
+        elif kind == 1:
+            feature = {
+                "name": name,
+                "access": "read",
+                "available": "true",
+                "refCID": "01",
+                "refDID": "00",
+            }
+        elif kind == 2:
+            feature = {
+                "name": name,
+                "access": "readWrite",
+                "available": "true",
+                "refCID": "07",
+                "refDID": "A1",
+                "min": "0",
+                "max": "300",
+                "stepSize": "5",
+            }
+        else:
+            feature = {
+                "name": name,
+                "access": "read",
+                "available": "true",
+                "refCID": "10",
+                "refDID": "82",
+                "initValue": "0",
+            }
+        features[str(uid)] = feature
+        uid += 1
+    return features
+
+
+def make_mandatory_values(features, seed=2):
+    """Build the data array of a /ro/allMandatoryValues response."""
+    rnd = random.Random(seed)
+    data = []
+    for uid, feature in features.items():
+        if "values" in feature:
+            value = rnd.choice(list(feature["values"]))
+            value = int(value)
+        elif feature.get("refCID") == "01":
+            value = rnd.choice([True, False])
+        elif feature.get("name", "").startswith("BSH.Common.Root."):
+            value = 8192
+        else:
+            value = rnd.randrange(300)
+        data.append({"uid": int(uid), "value": value})
+    return data
+
+
+def measure(label, func, number=None, repeat=5):
+    """Time func and print the best per-call time. Returns seconds per call."""
+    timer = timeit.Timer(func)
+    if number is None:
+        number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+    print(f"{label:<40} {best * 1e6:12.1f} us/call")
+    return best
+
+
+def make_traffic(features, notifications=500, seed=3):
+    """Build the frames a device sends in a session, as the JSON text on the wire.
+
+    A connection starts with /ei/initialValues and the /ro/allMandatoryValues
+    response, and is followed by NOTIFY frames with a few changed values each.
+    """
+    rnd = random.Random(seed)
+    session_id = 1834234000
+    values = make_mandatory_values(features, seed)
+    frames = [
+        {
+            "sID": session_id,
+            "msgID": 3906210000,
+            "resource": "/ei/initialValues",
+            "version": 2,
+            "action": "POST",
+            "data": [{"edMsgID": 1046722117}],
+        },
+        {
+            "sID": session_id,
+            "msgID": 3906210004,
+            "resource": "/ro/allMandatoryValues",
+            "version": 1,
+            "action": "RESPONSE",
+            "data": values,
+        },
+    ]
+    for i in range(notifications):
+        frames.append(
+            {
+                "sID": session_id,
+                "msgID": 3906210100 + i,
+                "resource": "/ro/values",
+                "version": 1,
+                "action": "NOTIFY",
+                "data": rnd.sample(values, rnd.randrange(1, 6)),
+            }
+        )
+    return [json.dumps(frame, separators=(",", ":")) for frame in frames]
+
+
+def load_traffic(path):
+    """Read the frames received from a device out of an hc2mqtt --debug log."""
+    frames = []
+    with open(path, "r") as f:
+        for line in f:
+            if " HCSocket " in line and " RX: " in line:
+                frames.append(line.split(" RX: ", 1)[1].strip())
+    return frames
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 # Contact Bosh-Siemens Home Connect devices
 # and connect their messages to the mqtt server
+import asyncio
 import json
+import os
 import signal
 import ssl
 import sys
@@ -12,81 +14,224 @@ import click
 import click_config_file
 import paho.mqtt.client as mqtt
 
-from HADiscovery import publish_ha_discovery
+import jsoncodec
+from HADiscovery import load_discovery_config, publish_ha_discovery
+from HCAsync import AsyncHCDevice, AsyncHCSocket
 from HCDevice import HCDevice
+from HCFeature import load_features
+from HCOutbox import outbox_for, rate_limits_from
+from HCReplay import FrameRecorder
+from HCResolver import default_resolver
 from HCSocket import HCSocket
+from HCTopics import topics_for
 from utils import clean_international_text, now
 
-SENTINEL = object()
-
 
 def hcprint(*args):
     print(now(), *args, flush=True)
 
 
-def handle_device_message(msg, mydevice, published_state, client, mqtt_topic, name, debug=False):
-    """Process a device message: update state, publish only changed keys to MQTT."""
+def report_command(name, resource, future):
+    """Log whether the appliance accepted a command sent from MQTT."""
+    error = future.exception()
+    if error is None:
+        hcprint(name, f"{resource} accepted by the appliance")
+    else:
+        hcprint(name, f"ERROR {resource} failed: {error}")
+
+
+def command_topics(devices, device_topics):
+    """Return {topic: (device, resource)} for every topic commands are accepted on.
+
+    Every device accepts /ro/values writes on its set topic. Devices with the
+    ActiveProgram or SelectedProgram feature can also start and select
+    programs. Connected devices are looked at with the features their
+    /ro/descriptionChange updates left, the others with those of devices.json.
+    """
+    commands = {}
+    for device in devices:
+        topics = device_topics[device["name"]]
+        commands[topics.set] = (topics.ident, "/ro/values")
+        mydevice = dev.get(topics.ident)
+        features = device["features"] if mydevice is None else mydevice.features
+        for feature in features.values():
+            if feature.name == "BSH.Common.Root.ActiveProgram":
+                commands[topics.active_program] = (topics.ident, "/ro/activeProgram")
+            elif feature.name == "BSH.Common.Root.SelectedProgram":
+                commands[topics.selected_program] = (topics.ident, "/ro/selectedProgram")
+    return commands
+
+
+def publish_retained(client, topic, payload):
+    """Publish a retained message, returning False if the client turned out not to be connected."""
+    return client.publish(topic, payload, retain=True).rc != mqtt.MQTT_ERR_NO_CONN
+
+
+def handle_device_message(
+    msg,
+    mydevice,
+    client,
+    mqtt_topic,
+    name,
+    debug=False,
+    state_document=False,
+    state_per_key=True,
+):
+    """Process a device message: update state, publish only changed keys to MQTT.
+
+    Changes are tracked by the device's state store. While MQTT is not
+    connected, changed keys stay dirty and events wait in the device's
+    outbox, to be published by publish_pending() when it reconnects.
+    """
     if msg is None or len(msg) == 0:
         return
 
     if debug:
         hcprint(name, msg)
 
-    changed = {}
-    events = {}
+    state = mydevice.state
+    topics = topics_for(mqtt_topic, name)
+    outbox = outbox_for(mqtt_topic)
+    events = 0
+    changes = 0
 
     for key in msg.keys():
         val = msg.get(key, None)
 
         # Dont persist event to the device state
         if ".Event." in key:
-            event_type = {"event_type": val}
-            events[key] = event_type
+            outbox.put(topics.event(key), jsoncodec.dumps({"event_type": val}))
+            events += 1
             continue
 
         # Don't store None for keys we haven't seen yet.
-        if key not in mydevice.state and val is None:
+        if key not in state and val is None:
             continue
-        mydevice.state[key] = val
-
-        # Diff against what was last published, not what's in state.
-        old_published = published_state.get(key, SENTINEL)
-        if val != old_published:
-            changed[key] = val
+        changes += state.update(key, val)
 
-    if not changed and not events:
+    # Keys held back by the rate limits stay dirty, their flush is already scheduled
+    if not events and state.dirty <= outbox.held and flush_scheduled(outbox):
         return
 
     if client.is_connected():
-        for key, value in events.items():
-            event_topic_name = key.lower().replace(".", "_")
-            hcprint(
+        publish_pending(mydevice, client, mqtt_topic, name, debug, state_document, state_per_key)
+    else:
+        outbox.deferred += events + changes
+        if debug:
+            hcprint(name, "mqtt is not connected, holding the update until it reconnects")
+
+
+def publish_pending(
+    mydevice, client, mqtt_topic, name, debug=False, state_document=False, state_per_key=True
+):
+    """Publish the events in the device's outbox and its changed state.
+
+    With state_document the whole state is published as one JSON document to
+    <mqtt_topic>/state, state_per_key publishes each changed key to
+    <mqtt_topic>/state/<key>. Whatever can't be published is kept for the
+    next attempt. Changes held back by the device's rate limits are published
+    when their interval has passed.
+    """
+    state = mydevice.state
+    topics = topics_for(mqtt_topic, name)
+    outbox = outbox_for(mqtt_topic)
+    with outbox.lock:
+        for topic, payload in outbox.take():
+            hcprint(name, f"publish to {topic}")
+            if not publish_retained(client, topic, payload):
+                outbox.put(topic, payload)
+
+        changed = state.take_dirty()
+        held = outbox.hold_back(changed)
+        if held:
+            for key in held:
+                state.mark_dirty(key)
+            schedule_flush(
+                mydevice,
+                client,
+                mqtt_topic,
                 name,
-                f"publish to {mqtt_topic}/event/{event_topic_name}",
+                min(held.values()),
+                debug,
+                state_document,
+                state_per_key,
             )
-            client.publish(
-                f"{mqtt_topic}/event/{event_topic_name}",
-                json.dumps(value),
-                retain=True,
+        if not changed:
+            return
+        if debug:
+            hcprint(
+                name, f"publishing {len(changed)} changed keys: {jsoncodec.dumps_compact(changed)}"
             )
-        if changed:
-            if debug:
-                hcprint(name, f"publishing {len(changed)} changed keys: {json.dumps(changed)}")
+        failed = set()
+        if state_per_key:
             for key, value in changed.items():
-                state_topic_name = key.lower().replace(".", "_")
                 if isinstance(value, dict):
-                    value = json.dumps(value)
-                client.publish(
-                    f"{mqtt_topic}/state/{state_topic_name}",
-                    str(value),
-                    retain=True,
-                )
-                published_state[key] = changed[key]
-    else:
-        hcprint(
-            name,
-            "ERROR Unable to publish update as mqtt is not connected.",
-        )
+                    value = jsoncodec.dumps(value)
+                if not publish_retained(client, topics.state(key), str(value)):
+                    failed.add(key)
+        if state_document:
+            snapshot = jsoncodec.dumps_compact(state.snapshot())
+            if not publish_retained(client, topics.state_document, snapshot):
+                failed.update(changed)
+        for key in failed:
+            state.mark_dirty(key)
+        outbox.published(key for key in changed if key not in failed)
+
+
+def flush_scheduled(outbox):
+    """Return whether a flush of the held back changes is scheduled and not overdue."""
+    return outbox.flush_due is not None and outbox.flush_due + FLUSH_RETRY > time.monotonic()
+
+
+def schedule_flush(
+    mydevice, client, mqtt_topic, name, delay, debug, state_document, state_per_key
+):
+    """Call publish_pending after delay seconds for the changes held back by the rate limits.
+
+    One flush is scheduled per device, whichever connection asks first. If
+    it can't publish it tries again every FLUSH_RETRY seconds, and a flush
+    that never ran, e.g. because its event loop is gone, is replaced once it
+    is FLUSH_RETRY seconds overdue. Called with the outbox lock held.
+    """
+    outbox = outbox_for(mqtt_topic)
+    due = time.monotonic() + delay
+    if flush_scheduled(outbox):
+        return
+
+    def flush():
+        with outbox.lock:
+            if outbox.flush_due != due:
+                # Replaced by a later flush
+                return
+            outbox.flush_due = None
+            # The device of the current connection, the one that asked may be gone
+            current = dev.get(topics_for(mqtt_topic, name).ident, mydevice)
+            published = False
+            try:
+                if client.is_connected():
+                    publish_pending(
+                        current, client, mqtt_topic, name, debug, state_document, state_per_key
+                    )
+                    published = True
+            finally:
+                if not published:
+                    schedule_flush(
+                        current,
+                        client,
+                        mqtt_topic,
+                        name,
+                        FLUSH_RETRY,
+                        debug,
+                        state_document,
+                        state_per_key,
+                    )
+
+    outbox.flush_due = due
+    try:
+        mydevice.call_later(delay, flush)
+    except Exception as e:
+        outbox.flush_due = None
+        print(now(), name, "ERROR scheduling publish of rate limited values", e, file=sys.stderr)
 
 
 @click.command()
@@ -106,6 +251,13 @@ def handle_device_message(msg, mydevice, published_state, client, mqtt_topic, na
 @click.option("--ha-discovery", is_flag=True)
 @click.option("--discovery_file", default="config/discovery.yaml")
 @click.option("--events_as_sensors", is_flag=True)
+@click.option("--values_coalesce_ms", default=0, type=int)
+@click.option("--asyncio", "use_asyncio", is_flag=True)
+@click.option("--address_cache_file", default=None)
+@click.option("--stats_interval", default=0, type=int)
+@click.option("--record_dir")
+@click.option("--state_document", is_flag=True)
+@click.option("--state_per_key/--no-state_per_key", default=True)
 @click_config_file.configuration_option()
 def hc2mqtt(
     devices_file: str,
@@ -124,6 +276,13 @@ def hc2mqtt(
     ha_discovery: bool,
     discovery_file: str,
     events_as_sensors: bool,
+    values_coalesce_ms: int,
+    use_asyncio: bool,
+    address_cache_file: str,
+    stats_interval: int,
+    record_dir: str,
+    state_document: bool,
+    state_per_key: bool,
 ):
 
     def on_connect(client, userdata, flags, rc):
@@ -132,32 +291,27 @@ def hc2mqtt(
         elif rc == 0:
             hcprint(f"MQTT connection established: {rc}")
             client.publish(f"{mqtt_prefix}LWT", payload="online", qos=0, retain=True)
-            # Re-subscribe to all device topics on reconnection
+            # Re-subscribe to all command topics on reconnection, in one SUBSCRIBE,
+            # including those of features added since the last connection
+            nonlocal commands, subscriptions
+            commands = command_topics(devices, device_topics)
+            subscriptions = [(topic, 0) for topic in commands]
+            if subscriptions:
+                client.subscribe(subscriptions)
+            # Publish what changed while the broker was unreachable
             for device in devices:
-                cleaned_name = clean_international_text(device["name"])
-                mqtt_set_topic = f"{mqtt_prefix}{cleaned_name}/set"
-                hcprint(device["name"], f"set topic: {mqtt_set_topic}")
-                client.subscribe(mqtt_set_topic)
-                for value in device["features"]:
-                    # If the device has the ActiveProgram feature it allows programs to be started
-                    # and scheduled via /ro/activeProgram
-                    if "name" in device["features"][value]:
-                        if "BSH.Common.Root.ActiveProgram" == device["features"][value]["name"]:
-                            mqtt_active_program_topic = (
-                                f"{mqtt_prefix}{cleaned_name}/activeProgram"
-                            )
-                            hcprint(device["name"], f"program topic: {mqtt_active_program_topic}")
-                            client.subscribe(mqtt_active_program_topic)
-                        # If the device has the SelectedProgram feature it allows programs to be
-                        # selected via /ro/selectedProgram
-                        if "BSH.Common.Root.SelectedProgram" == device["features"][value]["name"]:
-                            mqtt_selected_program_topic = (
-                                f"{mqtt_prefix}{cleaned_name}/selectedProgram"
-                            )
-                            hcprint(
-                                device["name"], f"program topic: {mqtt_selected_program_topic}"
-                            )
-                            client.subscribe(mqtt_selected_program_topic)
+                topics = device_topics[device["name"]]
+                mydevice = dev.get(topics.ident)
+                if mydevice is not None:
+                    publish_pending(
+                        mydevice,
+                        client,
+                        topics.base,
+                        device["name"],
+                        debug,
+                        state_document,
+                        state_per_key,
+                    )
         else:
             hcprint(f"ERROR MQTT connection failed: {rc}")
 
@@ -166,32 +320,28 @@ def hc2mqtt(
 
     def on_message(client, userdata, msg):
         mqtt_state = msg.payload.decode()
-        mqtt_topic = msg.topic.split("/")
         hcprint(f"{msg.topic} received mqtt message {mqtt_state}")
 
+        device_name = None
         try:
-            if len(mqtt_topic) >= 2:
-                device_name = mqtt_topic[-2]
-                topic = mqtt_topic[-1]
-            else:
-                raise Exception(f"Invalid mqtt topic {msg.topic}.")
+            command = commands.get(msg.topic)
+            if command is None:
+                raise Exception(f"Payload topic {msg.topic} is unknown.")
+            device_name, resource = command
 
             try:
-                msg = json.loads(mqtt_state)
+                msg = jsoncodec.loads(mqtt_state)
             except ValueError as e:
                 raise ValueError(f"Invalid JSON in message: {mqtt_state}.") from e
 
-            if topic == "set":
-                resource = "/ro/values"
-            elif topic == "activeProgram":
-                resource = "/ro/activeProgram"
-            elif topic == "selectedProgram":
-                resource = "/ro/selectedProgram"
-            else:
-                raise Exception(f"Payload topic {topic} is unknown.")
-
             if dev[device_name].connected:
-                dev[device_name].get(resource, 1, "POST", msg)
+                if resource == "/ro/values":
+                    request = dev[device_name].set_values(msg)
+                else:
+                    request = dev[device_name].get(resource, 1, "POST", msg)
+                request.add_done_callback(
+                    lambda future: report_command(device_name, resource, future)
+                )
             else:
                 hcprint(device_name, "ERROR cant send message as websocket is not connected")
         except Exception as e:
@@ -202,12 +352,35 @@ def hc2mqtt(
         f"Hello {devices_file=} {mqtt_host=} {mqtt_prefix=} "
         f"{mqtt_port=} {mqtt_username=} mqtt_password={masked_password!r} "
         f"{mqtt_ssl=} {mqtt_cafile=} {mqtt_certfile=} {mqtt_keyfile=} {mqtt_clientname=}"
-        f"{domain_suffix=} {debug=} {ha_discovery=}"
+        f"{domain_suffix=} {debug=} {ha_discovery=} {values_coalesce_ms=} {use_asyncio=}"
+        f" {address_cache_file=} {stats_interval=} {record_dir=} {state_document=}"
+        f" {state_per_key=}"
     )
 
+    if ha_discovery and not state_per_key:
+        hcprint("WARNING Home Assistant discovery uses the per-key state topics")
+
     with open(devices_file, "r") as f:
         devices = json.load(f)
 
+    rate_limits = rate_limits_from(load_discovery_config(discovery_file))
+
+    device_topics = {}
+    for device in devices:
+        device["features"] = load_features(device["features"])
+        mqtt_topic = mqtt_prefix + clean_international_text(device["name"])
+        device_topics[device["name"]] = topics_for(mqtt_topic, device["name"])
+        outbox_for(mqtt_topic).rate_limits = rate_limits
+
+    commands = command_topics(devices, device_topics)
+    subscriptions = [(topic, 0) for topic in commands]
+    for topic, (device_name, resource) in commands.items():
+        hcprint(device_name, f"{resource} command topic: {topic}")
+
+    # The addresses appliances last connected on, so a restart needs no lookup
+    if address_cache_file:
+        default_resolver.load(address_cache_file)
+
     client = mqtt.Client(mqtt_clientname)
 
     if mqtt_username and mqtt_password:
@@ -232,24 +405,42 @@ def hc2mqtt(
 
     shutdown = Event()
 
+    connections = []
     for device in devices:
-        mqtt_topic = mqtt_prefix + clean_international_text(device["name"])
-        thread = Thread(
-            target=client_connect,
-            args=(
+        connections.append(
+            (
                 client,
                 device,
-                mqtt_topic,
+                device_topics[device["name"]].base,
                 domain_suffix,
                 debug,
                 shutdown,
                 ha_discovery,
                 discovery_file,
                 events_as_sensors,
-            ),
-            daemon=True,
+                values_coalesce_ms,
+                record_dir,
+                state_document,
+                state_per_key,
+            )
         )
-        thread.start()
+
+    if use_asyncio:
+        # All devices share one event loop thread
+        async def connect_all():
+            await asyncio.gather(*(async_client_connect(*args) for args in connections))
+
+        Thread(target=asyncio.run, args=(connect_all(),), daemon=True).start()
+    else:
+        for args in connections:
+            Thread(target=client_connect, args=args, daemon=True).start()
+
+    if stats_interval > 0:
+        Thread(
+            target=publish_stats_every,
+            args=(client, mqtt_prefix, stats_interval, shutdown),
+            daemon=True,
+        ).start()
 
     def handle_exit(signum, frame):
         shutdown.set()
@@ -257,67 +448,173 @@ def hc2mqtt(
 
     signal.signal(signal.SIGTERM, handle_exit)
     signal.signal(signal.SIGINT, handle_exit)
-    client.loop_forever()
+    try:
+        client.loop_forever()
+    finally:
+        close_recorders()
 
 
 global dev
 dev = {}
+# Seconds before a flush of rate limited values that couldn't publish tries again
+FLUSH_RETRY = 5
+# The FrameRecorders of --record_dir, closed on shutdown
+recorders = []
 
 
-def client_connect(
+def publish_stats(client, mqtt_prefix):
+    """Publish the connection and message handling counters of every device."""
+    for name, device in list(dev.items()):
+        try:
+            topics = topics_for(f"{mqtt_prefix}{name}", name)
+            stats = device.stats()
+            stats["outbox"] = outbox_for(topics.base).stats()
+            client.publish(topics.stats, jsoncodec.dumps_compact(stats))
+        except Exception as e:
+            print(now(), name, "ERROR publishing stats", e, file=sys.stderr, flush=True)
+
+
+def publish_stats_every(client, mqtt_prefix, interval, shutdown):
+    while not shutdown.wait(interval):
+        if client.is_connected():
+            publish_stats(client, mqtt_prefix)
+
+
+def open_recorder(record_dir, name):
+    """Return the recorder of a device's traffic, or None when not recording."""
+    if not record_dir:
+        return None
+    path = os.path.join(record_dir, f"{clean_international_text(name)}.hcrec")
+    try:
+        os.makedirs(record_dir, exist_ok=True)
+        recorder = FrameRecorder(path)
+    except OSError as e:
+        print(now(), name, "ERROR unable to record frames", e, file=sys.stderr, flush=True)
+        return None
+    hcprint(name, f"recording frames to {path}")
+    recorders.append(recorder)
+    return recorder
+
+
+def close_recorders():
+    """Flush and close the recordings on shutdown."""
+    while recorders:
+        recorders.pop().close()
+
+
+def device_callbacks(
+    mydevice,
     client,
     device,
     mqtt_topic,
-    domain_suffix,
     debug,
-    shutdown=None,
-    ha_discovery=False,
-    discovery_file=None,
-    events_as_sensors=False,
+    ha_discovery,
+    discovery_file,
+    events_as_sensors,
+    state_document=False,
+    state_per_key=True,
+    run_blocking=None,
 ):
-    host = device["host"]
+    """Return the on_message, on_open and on_close callbacks for one connection.
+
+    run_blocking(func, *args) runs calls that read files, like the discovery
+    config, somewhere else than the thread delivering the messages.
+    """
     name = device["name"]
-    mydevice = None
-    published_state = {}
-    discovery_published = False
+    topics = topics_for(mqtt_topic, name)
+    discovery_published = False  # Re-publish discovery on each new connection.
 
     def on_message(msg):
         nonlocal discovery_published
         try:
-            handle_device_message(msg, mydevice, published_state, client, mqtt_topic, name, debug)
+            handle_device_message(
+                msg, mydevice, client, mqtt_topic, name, debug, state_document, state_per_key
+            )
             # Wait until /ci/info or /iz/info has been processed so discovery
             # has access to MAC, firmware, etc.
             device_info_ready = "mac" in mydevice.state or "swVersion" in mydevice.state
             if ha_discovery and not discovery_published and device_info_ready:
-                publish_ha_discovery(
-                    discovery_file, device, mydevice.state, client, mqtt_topic, events_as_sensors
+                args = (
+                    discovery_file,
+                    # The features as /ro/descriptionChange has left them
+                    {**device, "features": mydevice.features},
+                    mydevice.state,
+                    client,
+                    mqtt_topic,
+                    events_as_sensors,
                 )
+                if run_blocking is None:
+                    publish_ha_discovery(*args)
+                else:
+                    run_blocking(publish_ha_discovery, *args)
                 discovery_published = True
         except Exception as e:
             print(repr(e))
 
     def on_open(ws):
-        client.publish(f"{mqtt_topic}/LWT", "online", retain=True)
+        client.publish(topics.lwt, "online", retain=True)
 
     def on_close(ws, code, message):
-        client.publish(f"{mqtt_topic}/LWT", "offline", retain=True)
-        hcprint(device["name"], "websocket closed, reconnecting...")
+        client.publish(topics.lwt, "offline", retain=True)
+        hcprint(name, "websocket closed, reconnecting...")
+
+    return on_message, on_open, on_close
+
+
+def client_connect(
+    client,
+    device,
+    mqtt_topic,
+    domain_suffix,
+    debug,
+    shutdown=None,
+    ha_discovery=False,
+    discovery_file=None,
+    events_as_sensors=False,
+    values_coalesce_ms=0,
+    record_dir=None,
+    state_document=False,
+    state_per_key=True,
+):
+    host = device["host"]
+    # Writes to /ro/values arriving within this window are sent as one POST
+    coalesce_window = device.get("values_coalesce_ms", values_coalesce_ms) / 1000
+    name = device["name"]
+    recorder = open_recorder(record_dir, name)
 
     retry_delay = 5
     while not (shutdown and shutdown.is_set()):
         try:
-            ws = HCSocket(host, device["key"], device.get("iv", None), domain_suffix, debug)
-            mydevice = HCDevice(ws, device, debug)
-            published_state.clear()
-            discovery_published = False  # Re-publish discovery on each new connection.
-            dev[clean_international_text(name)] = mydevice
+            ws = HCSocket(
+                host,
+                device["key"],
+                device.get("iv", None),
+                domain_suffix,
+                debug,
+                device.get("port"),
+            )
+            ws.recorder = recorder
+            mydevice = HCDevice(ws, current_config(device, mqtt_topic), debug, coalesce_window)
+            dev[topics_for(mqtt_topic, name).ident] = mydevice
+            on_message, on_open, on_close = device_callbacks(
+                mydevice,
+                client,
+                device,
+                mqtt_topic,
+                debug,
+                ha_discovery,
+                discovery_file,
+                events_as_sensors,
+                state_document,
+                state_per_key,
+            )
             hcprint(name, f"connecting to {host}")
             mydevice.run_forever(on_message=on_message, on_open=on_open, on_close=on_close)
             hcprint(name, f"not connected {host}")
             retry_delay = 5
         except Exception as e:
             print(now(), device["name"], "ERROR", e, file=sys.stderr, flush=True)
-            client.publish(f"{mqtt_topic}/LWT", "offline", retain=True)
+            client.publish(topics_for(mqtt_topic, name).lwt, "offline", retain=True)
 
         hcprint(name, f"reconnecting in {retry_delay}s")
         if shutdown:
@@ -327,5 +624,90 @@ def client_connect(
         retry_delay = min(retry_delay * 2, 60)
 
 
+def current_config(device, mqtt_topic):
+    """Return the devices.json entry of device with the features of its last connection.
+
+    A new connection starts from the /ro/descriptionChange updates of the
+    previous one rather than from the features devices.json was loaded with.
+    """
+    previous = dev.get(topics_for(mqtt_topic, device["name"]).ident)
+    if previous is None:
+        return device
+    return {**device, "features": previous.features}
+
+
+def run_in_executor(func, *args):
+    """Run a blocking call from a callback on the event loop in the loop's executor."""
+
+    def done(future):
+        if not future.cancelled() and future.exception() is not None:
+            print(repr(future.exception()))
+
+    asyncio.get_running_loop().run_in_executor(None, func, *args).add_done_callback(done)
+
+
+async def async_client_connect(
+    client,
+    device,
+    mqtt_topic,
+    domain_suffix,
+    debug,
+    shutdown=None,
+    ha_discovery=False,
+    discovery_file=None,
+    events_as_sensors=False,
+    values_coalesce_ms=0,
+    record_dir=None,
+    state_document=False,
+    state_per_key=True,
+):
+    """client_connect for --asyncio, running as a task on the shared event loop."""
+    host = device["host"]
+    coalesce_window = device.get("values_coalesce_ms", values_coalesce_ms) / 1000
+    name = device["name"]
+    recorder = open_recorder(record_dir, name)
+
+    retry_delay = 5
+    while not (shutdown and shutdown.is_set()):
+        try:
+            ws = AsyncHCSocket(
+                host,
+                device["key"],
+                device.get("iv", None),
+                domain_suffix,
+                debug,
+                device.get("port"),
+            )
+            ws.recorder = recorder
+            mydevice = AsyncHCDevice(
+                ws, current_config(device, mqtt_topic), debug, coalesce_window
+            )
+            dev[topics_for(mqtt_topic, name).ident] = mydevice
+            on_message, on_open, on_close = device_callbacks(
+                mydevice,
+                client,
+                device,
+                mqtt_topic,
+                debug,
+                ha_discovery,
+                discovery_file,
+                events_as_sensors,
+                state_document,
+                state_per_key,
+                run_in_executor,
+            )
+            hcprint(name, f"connecting to {host}")
+            await mydevice.run(on_message=on_message, on_open=on_open, on_close=on_close)
+            hcprint(name, f"not connected {host}")
+            retry_delay = 5
+        except Exception as e:
+            print(now(), device["name"], "ERROR", e, file=sys.stderr, flush=True)
+            client.publish(topics_for(mqtt_topic, name).lwt, "offline", retain=True)
+
+        hcprint(name, f"reconnecting in {retry_delay}s")
+        await asyncio.sleep(retry_delay)
+        retry_delay = min(retry_delay * 2, 60)
+
+
 if __name__ == "__main__":
     hc2mqtt(auto_envvar_prefix="HCPY")
@@ -0,0 +1,66 @@
+# JSON encoding and decoding for the device and MQTT paths
+#
+# Every websocket frame and every MQTT message goes through here. Decoding
+# uses orjson when it is installed, otherwise the standard library json
+# module.
+#
+# Encoding keeps the bytes hcpy has always sent: dumps() matches json.dumps()
+# for MQTT payloads, including the retained Home Assistant discovery configs,
+# and dumps_frame() matches the compact ASCII frames sent to the devices.
+# Only dumps_compact(), used for logs and the optional stats and state
+# document topics, uses the backend and writes compact UTF-8.
+#
+# Call the functions through the module rather than importing them, so
+# set_backend() applies everywhere.
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_loads(buf):
+    return json.loads(buf)
+
+
+def _json_dumps_compact(obj):
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+
+BACKENDS = {"json": (_json_loads, _json_dumps_compact)}
+
+if orjson is not None:
+    # orjson.JSONDecodeError is a subclass of json.JSONDecodeError
+
+    def _orjson_dumps_compact(obj):
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+        except TypeError:
+            # Integers wider than 64 bits and types orjson doesn't know
+            return _json_dumps_compact(obj)
+
+    BACKENDS["orjson"] = (orjson.loads, _orjson_dumps_compact)
+
+
+def dumps(obj):
+    """Encode an MQTT payload, the same as json.dumps(obj)."""
+    return json.dumps(obj)
+
+
+def dumps_frame(obj):
+    """Encode (part of) a frame for a device, compact and ASCII only."""
+    return json.dumps(obj, separators=(",", ":"))
+
+
+def set_backend(name):
+    """Select the backend used by loads() and dumps_compact(), "json" or "orjson"."""
+    global backend, loads, dumps_compact
+    if name not in BACKENDS:
+        raise ValueError(f"JSON backend {name} is not available")
+    backend = name
+    loads, dumps_compact = BACKENDS[name]
+
+
+set_backend("orjson" if orjson is not None else "json")
@@ -3,7 +3,7 @@ from unittest.mock import mock_open, patch
 
 import pytest
 
-from HADiscovery import CONTROL_COMPONENT_TYPES, publish_ha_discovery
+from HADiscovery import CONTROL_COMPONENT_TYPES, load_discovery_config, publish_ha_discovery
 
 
 class TestHADiscovery:
@@ -733,6 +733,16 @@ class TestHADiscovery:
         expected_types = ["switch", "number", "light", "button", "select"]
         assert CONTROL_COMPONENT_TYPES == expected_types
 
+    @patch("builtins.print")
+    def test_load_discovery_config_fallback(self, _print, temp_discovery_config):
+        """Test the shipped discovery.yaml is used when the configured file is missing"""
+        config = load_discovery_config(temp_discovery_config)
+        assert config["HA_DISCOVERY_PREFIX"] == "homeassistant"
+
+        config = load_discovery_config("missing/discovery.yaml")
+        assert "MAGIC_OVERRIDES" in config
+        assert "PUBLISH_RATE_LIMITS" in config
+
 
 if __name__ == "__main__":
     pytest.main([__file__])
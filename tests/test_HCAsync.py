@@ -0,0 +1,330 @@
+import asyncio
+import datetime
+import json
+import ssl
+import threading
+
+import pytest
+
+from HCAsync import (
+    OPCODE_BINARY,
+    OPCODE_CLOSE,
+    OPCODE_PING,
+    OPCODE_PONG,
+    AsyncHCDevice,
+    AsyncHCSocket,
+    TLSStream,
+    encode_ws_frame,
+    mask_payload,
+    open_connection_staggered,
+    read_ws_frame,
+    websocket_accept,
+)
+from HCCrypto import CLIENT_TO_DEVICE, DEVICE_TO_CLIENT, FrameCodec
+from HCResolver import address_info
+
+PSK64 = "Lq6DlW_5gkZVdMWfFIU0EGIAWEdqPgh6TNDMt3w5hOg"
+IV64 = "VDEyT8bsH4UTVhLWJCPiVg"
+
+FEATURES = {
+    "256": {
+        "name": "BSH.Common.Status.DoorState",
+        "access": "read",
+        "refCID": "03",
+        "refDID": "80",
+        "values": {"0": "Open", "1": "Closed"},
+    },
+    "539": {
+        "name": "BSH.Common.Setting.PowerState",
+        "access": "readWrite",
+        "refCID": "03",
+        "refDID": "80",
+        "values": {"1": "Off", "2": "On"},
+    },
+}
+
+
+class FakeAppliance:
+    """Device side of an HTTP-mode appliance, answering the handshake requests."""
+
+    def __init__(self, sock):
+        self.codec = FrameCodec(
+            sock.enckey, sock.mackey, sock.iv, rx=CLIENT_TO_DEVICE, tx=DEVICE_TO_CLIENT
+        )
+        self.received = []
+        self.pings = 0
+        self.msg_id = 100
+
+    def send(self, writer, msg):
+        frame = self.codec.encrypt(json.dumps(msg))
+        writer.write(encode_ws_frame(OPCODE_BINARY, frame, mask=False))
+
+    def respond(self, writer, msg, data):
+        reply = {k: msg[k] for k in ("sID", "msgID", "resource", "version")}
+        reply["action"] = "RESPONSE"
+        if data is not None:
+            reply["data"] = data
+        self.send(writer, reply)
+
+    async def handle(self, reader, writer):
+        self.codec.reset()
+        request = (await reader.readuntil(b"\r\n\r\n")).decode()
+        key = [line.split(": ")[1] for line in request.split("\r\n") if line.startswith("Sec-")]
+        writer.write(
+            (
+                "HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n"
+                f"Connection: Upgrade\r\nSec-WebSocket-Accept: {websocket_accept(key[0])}\r\n\r\n"
+            ).encode()
+        )
+        self.send(
+            writer,
+            {
+                "sID": 1,
+                "msgID": 1,
+                "resource": "/ei/initialValues",
+                "version": 2,
+                "action": "POST",
+                "data": [{"edMsgID": 10}],
+            },
+        )
+        writer.write(encode_ws_frame(OPCODE_PING, b"hi", mask=False))
+        while True:
+            try:
+                fin, opcode, payload = await read_ws_frame(reader.readexactly)
+            except asyncio.IncompleteReadError:
+                break
+            if opcode == OPCODE_CLOSE:
+                writer.write(encode_ws_frame(OPCODE_CLOSE, payload, mask=False))
+                break
+            if opcode == OPCODE_PONG:
+                self.pings += 1
+                continue
+            msg = json.loads(self.codec.decrypt(payload))
+            self.received.append(msg)
+            resource = msg["resource"]
+            if msg["action"] in ("NOTIFY", "RESPONSE"):
+                continue
+            if resource == "/ci/services":
+                self.respond(writer, msg, [{"service": "ci", "version": 3}])
+            elif resource == "/ro/allMandatoryValues":
+                self.respond(writer, msg, [{"uid": 256, "value": 1}])
+            else:
+                self.respond(writer, msg, [])
+        writer.close()
+
+
+async def wait_until(condition, timeout=5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+class TestFrames:
+    def test_mask_round_trip(self):
+        payload = bytes(range(200))
+        assert mask_payload(b"\x01\x02\x03\x04", mask_payload(b"\x01\x02\x03\x04", payload)) == (
+            payload
+        )
+
+    @pytest.mark.parametrize("size", [0, 125, 126, 65535, 65536])
+    def test_frame_round_trip(self, size):
+        payload = b"x" * size
+        frame = encode_ws_frame(OPCODE_BINARY, payload)
+
+        async def read():
+            reader = asyncio.StreamReader()
+            reader.feed_data(frame)
+            return await read_ws_frame(reader.readexactly)
+
+        assert asyncio.run(read()) == (True, OPCODE_BINARY, payload)
+
+    def test_accept(self):
+        # Example from RFC 6455
+        assert websocket_accept("dGhlIHNhbXBsZSBub25jZQ==") == "s3pPLMBiTxaQ9kYGzzhZRbK+xOo="
+
+
+class TestAsyncDevice:
+    def test_handshake_and_write(self, capsys):
+        async def scenario():
+            ws = AsyncHCSocket("127.0.0.1", PSK64, IV64)
+            appliance = FakeAppliance(ws)
+            server = await asyncio.start_server(appliance.handle, "127.0.0.1", 0)
+            ws.port = server.sockets[0].getsockname()[1]
+            device = AsyncHCDevice(ws, {"name": "oven", "features": dict(FEATURES)})
+            values = []
+            closed = []
+            threads = threading.active_count()
+
+            task = asyncio.ensure_future(
+                device.run(values.append, lambda ws: None, lambda *args: closed.append(args))
+            )
+            await wait_until(lambda: device.handshake_duration is not None)
+            assert device.connected
+            assert threading.active_count() <= threads + 1  # the getaddrinfo executor
+
+            # Writes come from the MQTT thread
+            loop = asyncio.get_running_loop()
+            request = await loop.run_in_executor(
+                None, device.set_values, {"name": "BSH.Common.Setting.PowerState", "value": 2}
+            )
+            await asyncio.wait_for(asyncio.wrap_future(request), 5)
+
+            ws.close()
+            await asyncio.wait_for(task, 5)
+            server.close()
+            await server.wait_closed()
+            return appliance, device, values, closed
+
+        appliance, device, values, closed = asyncio.run(scenario())
+
+        resources = [msg["resource"] for msg in appliance.received]
+        assert resources[0] == "/ei/initialValues"
+        assert resources[1] == "/ci/services"
+        assert "/ci/authentication" in resources
+        assert "/ro/allMandatoryValues" in resources
+        assert appliance.received[-1]["data"] == [{"uid": 539, "value": 2}]
+        assert appliance.pings == 1
+        assert {"BSH.Common.Status.DoorState": "Closed"} in values
+        assert not device.connected
+        assert len(closed) == 1
+
+    def test_connection_refused(self, capsys):
+        async def scenario():
+            server = await asyncio.start_server(lambda r, w: None, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            server.close()
+            await server.wait_closed()
+            ws = AsyncHCSocket("127.0.0.1", PSK64, IV64)
+            ws.port = port
+            device = AsyncHCDevice(ws, {"name": "oven", "features": dict(FEATURES)})
+            opened = []
+            await device.run(lambda values: None, opened.append, lambda *args: None)
+            return opened, device
+
+        opened, device = asyncio.run(scenario())
+        assert opened == []
+        assert not device.connected
+
+    def test_staggered_connect(self):
+        async def scenario():
+            server = await asyncio.start_server(lambda r, w: w.close(), "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            addresses = [address_info("192.0.2.1", port), address_info("127.0.0.1", port)]
+            reader, writer, address = await asyncio.wait_for(
+                open_connection_staggered(addresses, delay=0.05), 5
+            )
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            return address, port
+
+        address, port = asyncio.run(scenario())
+        assert address == ("127.0.0.1", port)
+
+    def test_request_timeout_on_loop(self):
+        async def scenario():
+            ws = AsyncHCSocket("127.0.0.1", PSK64, IV64)
+            ws.loop = asyncio.get_running_loop()
+            ws.send = lambda msg: None
+            device = AsyncHCDevice(ws, {"name": "oven", "features": dict(FEATURES)})
+            device.session_id = 1
+            device.tx_msg_id = 1
+            # One from the loop, one from another thread
+            on_loop = device.get("/ni/info", timeout=0.01)
+            other = await ws.loop.run_in_executor(
+                None, lambda: device.get("/ci/info", timeout=0.01)
+            )
+            answered = await ws.loop.run_in_executor(
+                None, lambda: device.get("/iz/info", timeout=0.01)
+            )
+            answered_timer = device._requests[3][1]
+            answered_timer.cancel()
+            for future in (on_loop, other):
+                with pytest.raises(TimeoutError):
+                    await asyncio.wait_for(asyncio.wrap_future(future), 5)
+            await asyncio.sleep(0.05)
+            return device, answered
+
+        device, answered = asyncio.run(scenario())
+        assert list(device._requests) == [3]
+        assert not answered.done()
+
+    def test_closed_before_stream(self):
+        async def scenario():
+            ws = AsyncHCSocket("127.0.0.1", PSK64, IV64)
+
+            async def connect():
+                ws.loop = asyncio.get_running_loop()
+
+            async def recv():
+                raise ConnectionError("reset")
+
+            ws.connect = connect
+            ws.recv = recv
+            closed = []
+            await ws.run(lambda ws, msg: None, lambda ws: None, lambda *args: closed.append(args))
+            return ws, closed
+
+        ws, closed = asyncio.run(scenario())
+        assert closed == [(ws, None, None)]
+
+    def test_send_when_not_connected(self):
+        ws = AsyncHCSocket("127.0.0.1", PSK64, IV64)
+        with pytest.raises(ConnectionError):
+            ws.send({"sID": 1, "msgID": 1, "resource": "/ci/info", "version": 1, "action": "GET"})
+
+
+class TestTLSStream:
+    def test_tls_round_trip(self, tmp_path):
+        x509 = pytest.importorskip("cryptography.x509")
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import ec
+
+        key = ec.generate_private_key(ec.SECP256R1())
+        name = x509.Name([x509.NameAttribute(x509.oid.NameOID.COMMON_NAME, "appliance")])
+        today = datetime.datetime.now(datetime.timezone.utc)
+        cert = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(1)
+            .not_valid_before(today - datetime.timedelta(days=1))
+            .not_valid_after(today + datetime.timedelta(days=1))
+            .sign(key, hashes.SHA256())
+        )
+        (tmp_path / "cert.pem").write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+        (tmp_path / "key.pem").write_bytes(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+        )
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(tmp_path / "cert.pem", tmp_path / "key.pem")
+        client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        client_context.check_hostname = False
+        client_context.verify_mode = ssl.CERT_NONE
+
+        async def echo(reader, writer):
+            writer.write(await reader.readexactly(5))
+            await writer.drain()
+            writer.close()
+
+        async def scenario():
+            server = await asyncio.start_server(echo, "127.0.0.1", 0, ssl=server_context)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            stream = TLSStream(reader, writer, client_context)
+            await stream.handshake()
+            stream.write(b"hello")
+            data = await stream.read()
+            eof = await stream.read()
+            stream.close()
+            server.close()
+            await server.wait_closed()
+            return data, eof
+
+        assert asyncio.run(scenario()) == (b"hello", b"")
@@ -0,0 +1,94 @@
+import pytest
+
+import HCCrypto
+from HCCrypto import (
+    BACKENDS,
+    CLIENT_TO_DEVICE,
+    DEVICE_TO_CLIENT,
+    CryptoBackend,
+    FrameCodec,
+    PycryptodomeBackend,
+    self_test,
+    set_backend,
+)
+
+ENCKEY = bytes(range(32))
+MACKEY = bytes(range(32, 64))
+IV = bytes(range(16))
+
+
+def fixed_random(n):
+    return bytes(range(n))
+
+
+def codec_pair(client_backend, device_backend):
+    client = FrameCodec(ENCKEY, MACKEY, IV, backend=client_backend)
+    device = FrameCodec(
+        ENCKEY, MACKEY, IV, rx=CLIENT_TO_DEVICE, tx=DEVICE_TO_CLIENT, backend=device_backend
+    )
+    return client, device
+
+
+class TestBackends:
+    @pytest.mark.parametrize("name", sorted(BACKENDS))
+    def test_self_test(self, name):
+        assert self_test(BACKENDS[name])
+
+    @pytest.mark.parametrize("name", sorted(BACKENDS))
+    def test_round_trip_with_reference(self, name):
+        client, device = codec_pair(BACKENDS[name], BACKENDS["pycryptodome"])
+        for size in (0, 14, 15, 16, 17, 1000):
+            text = "y" * size
+            assert device.decrypt(client.encrypt(text)) == text.encode()
+            assert client.decrypt(device.encrypt(text)) == text.encode()
+
+    def test_cryptography_frames_identical(self):
+        if "cryptography" not in BACKENDS:
+            pytest.skip("cryptography is not installed")
+        ours, _ = codec_pair(BACKENDS["cryptography"], None)
+        theirs, _ = codec_pair(BACKENDS["pycryptodome"], None)
+        ours.random_bytes = theirs.random_bytes = fixed_random
+        for i in range(10):
+            text = '{"msgID":%d}' % i
+            assert ours.encrypt(text) == theirs.encrypt(text)
+
+    def test_broken_backend_fails_self_test(self):
+        class BrokenBackend(PycryptodomeBackend):
+            name = "broken"
+
+            def cbc_encryptor(self, key, iv):
+                return super().cbc_encryptor(key, bytes(16))
+
+        assert self_test(BrokenBackend()) is False
+
+    def test_backend_must_implement_primitives(self):
+        class PartialBackend(CryptoBackend):
+            def hmac(self, key, msg=b""):
+                return None
+
+        with pytest.raises(TypeError):
+            PartialBackend()
+
+    def test_hmac_copy(self):
+        mac = BACKENDS["pycryptodome"].hmac(b"key", b"iv")
+        copy = mac.copy()
+        copy.update(b"frame")
+        assert mac.digest() != copy.digest()
+
+    def test_cryptography_selected_when_installed(self):
+        expected = "cryptography" if "cryptography" in BACKENDS else "pycryptodome"
+        assert HCCrypto.default_backend.name == expected
+
+
+class TestSetBackend:
+    def test_set_backend(self):
+        previous = HCCrypto.default_backend
+        try:
+            set_backend("pycryptodome")
+            assert FrameCodec(ENCKEY, MACKEY, IV).backend is BACKENDS["pycryptodome"]
+        finally:
+            HCCrypto.default_backend = previous
+
+    def test_unknown_backend(self):
+        with pytest.raises(ValueError):
+            set_backend("nacl")
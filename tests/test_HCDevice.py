@@ -1,14 +1,17 @@
+import threading
+import time
 from unittest.mock import Mock, patch
 
 import pytest
 
-from HCDevice import HCDevice
+from HCDevice import HCDevice, HCDeviceError, Timers
 
 
 def make_device(services, features=None):
     """Build an HCDevice with pre-set services, ready to call reconnect().
 
-    Sets the services event so reconnect() proceeds past the wait.
+    Sets the services event and answers /ci/services with the services, so
+    reconnect() proceeds past the wait.
     Mocks ws.send and ws.close so nothing hits the network.
     """
     ws = Mock()
@@ -21,6 +24,15 @@ def make_device(services, features=None):
     dev.tx_msg_id = 1000
     dev.services = services
     dev._services_event.set()
+
+    def send(msg):
+        # Answered from another thread, like the receive loop would
+        if msg["resource"] == "/ci/services" and msg["action"] == "GET":
+            data = [{"service": k, "version": v["version"]} for k, v in services.items()]
+            reply = response(msg["msgID"], "/ci/services", data)
+            threading.Thread(target=dev.handle_message, args=(reply,)).start()
+
+    ws.send.side_effect = send
     return dev
 
 
@@ -182,28 +194,64 @@ class TestReconnectRoValues:
         assert "/ro/values" not in gets
 
 
+class TestTimers:
+    def test_runs_in_due_order_on_one_thread(self):
+        timers = Timers("test")
+        done = threading.Event()
+        calls = []
+        timers.call_later(0.02, lambda: calls.append(("late", threading.current_thread())))
+        timers.call_later(0, lambda: calls.append(("early", threading.current_thread())))
+        timers.call_later(0.03, done.set)
+
+        assert done.wait(5)
+        assert [name for name, _ in calls] == ["early", "late"]
+        assert calls[0][1] is calls[1][1]
+
+    def test_cancel(self):
+        timers = Timers("test")
+        done = threading.Event()
+        calls = []
+        timers.call_later(0, lambda: calls.append(1)).cancel()
+        timers.call_later(0.01, done.set)
+
+        assert done.wait(5)
+        assert calls == []
+
+    def test_thread_exits_when_idle(self):
+        timers = Timers("test")
+        done = threading.Event()
+        timers.call_later(0, done.set)
+        assert done.wait(5)
+
+        deadline = time.monotonic() + 5
+        while timers._thread is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert timers._thread is None
+
+
 @patch("HCDevice.HCDevice.print")
 class TestReconnectTimeout:
     """When /ci/services never arrives, reconnect should close and return."""
 
+    @patch("HCDevice.SERVICES_TIMEOUT", 0)
     def test_closes_websocket_on_timeout(self, _print):
         ws = Mock()
         dev = HCDevice(ws, {"name": "TestDevice", "features": {}})
         dev.session_id = 1
         dev.tx_msg_id = 1000
-        # Do not set the event, so wait() will time out.
-        dev._services_event.wait = Mock(return_value=False)
+        # Nothing answers /ci/services, so the request times out.
 
         dev.reconnect()
 
         ws.close.assert_called_once()
+        assert dev._requests == {}
 
+    @patch("HCDevice.SERVICES_TIMEOUT", 0)
     def test_no_post_discovery_requests_on_timeout(self, _print):
         ws = Mock()
         dev = HCDevice(ws, {"name": "TestDevice", "features": {}})
         dev.session_id = 1
         dev.tx_msg_id = 1000
-        dev._services_event.wait = Mock(return_value=False)
 
         dev.reconnect()
 
@@ -299,3 +347,432 @@ class TestServicesEvent:
             "ro": {"version": 1},
             "ci": {"version": 2},
         }
+
+
+LOOKUP_FEATURES = {
+    "8196": {"name": "Dishcare.Dishwasher.Program.Eco50"},
+    "8197": {"name": "Dishcare.Dishwasher.Program.Intensiv70"},
+    "8198": {"name": "Dishcare.Dishwasher.Program.Eco50Plus"},
+    "539": {"name": "BSH.Common.Setting.PowerState"},
+    "9999": {"access": "read"},
+}
+
+
+@patch("HCDevice.HCDevice.print")
+class TestFeatureLookup:
+    """get_feature_uid returns the first feature whose name contains the given name."""
+
+    def test_exact_name(self, _print):
+        dev = make_device({}, LOOKUP_FEATURES)
+        assert dev.get_feature_uid("Dishcare.Dishwasher.Program.Intensiv70") == "8197"
+
+    def test_short_name(self, _print):
+        dev = make_device({}, LOOKUP_FEATURES)
+        assert dev.get_feature_uid("Eco50") == "8196"
+        assert dev.get_feature_uid("Eco50Plus") == "8198"
+
+    def test_partial_name_falls_back_to_substring(self, _print):
+        dev = make_device({}, LOOKUP_FEATURES)
+        assert dev.get_feature_uid("Setting.Power") == "539"
+
+    def test_unknown_name(self, _print):
+        dev = make_device({}, LOOKUP_FEATURES)
+        assert dev.get_feature_uid("Dishcare.Dishwasher.Program.Quick45") is None
+
+    def test_first_match_in_devices_json_order(self, _print):
+        features = {
+            "8198": {"name": "Dishcare.Dishwasher.Program.Eco50Plus"},
+            "8196": {"name": "Dishcare.Dishwasher.Program.Eco50"},
+        }
+        dev = make_device({}, features)
+        # The substring match of the original scan, not the exact name
+        assert dev.get_feature_uid("Eco50") == "8198"
+        assert dev.get_feature_uid("Eco50") == "8198"
+        assert dev.get_feature_uid("Dishcare.Dishwasher.Program.Eco50") == "8198"
+
+    @patch("HCDevice.MAX_UID_QUERIES", 0)
+    def test_same_as_scan_when_memo_full(self, _print):
+        dev = make_device({}, LOOKUP_FEATURES)
+        for name in ("Eco50", "Eco50Plus", "Program.", "Setting.Power", "Quick45", "", "\n"):
+            expected = next(
+                (uid for uid, f in LOOKUP_FEATURES.items() if "name" in f and name in f["name"]),
+                None,
+            )
+            assert dev.get_feature_uid(name) == expected
+        assert dev._snapshot.uid_by_query == {}
+
+    def test_description_change_adds_to_index(self, _print):
+        import json
+
+        dev = make_device({}, dict(LOOKUP_FEATURES))
+        msg = json.dumps(
+            {
+                "sID": 1,
+                "msgID": 1000,
+                "resource": "/ro/descriptionChange",
+                "version": 1,
+                "action": "NOTIFY",
+                "data": [{"uid": 8200, "name": "Dishcare.Dishwasher.Program.Quick45"}],
+            }
+        )
+        dev.handle_message(msg)
+
+        assert dev.get_feature_uid("Quick45") == "8200"
+
+
+WRITE_FEATURES = {
+    "256": {
+        "name": "BSH.Common.Status.DoorState",
+        "access": "readWrite",
+        "values": {"0": "Open", "1": "Closed"},
+    },
+    "258": {
+        "name": "Cooking.Oven.Option.SetpointTemperature",
+        "access": "readWrite",
+        "min": 30,
+        "max": 250,
+    },
+}
+
+
+@patch("HCDevice.HCDevice.print")
+class TestFeatureValidation:
+    """test_feature converts names and enum labels before a /ro/values POST."""
+
+    def test_enum_label_converted_to_key(self, _print):
+        dev = make_device({}, WRITE_FEATURES)
+        data = dev.test_feature([{"uid": 256, "value": "Closed"}])
+        assert data == [{"uid": 256, "value": 1}]
+
+    def test_enum_digit_string_converted(self, _print):
+        dev = make_device({}, WRITE_FEATURES)
+        data = dev.test_feature([{"uid": "256", "value": "0"}])
+        assert data == [{"uid": 256, "value": 0}]
+
+    def test_name_resolved_to_uid(self, _print):
+        dev = make_device({}, WRITE_FEATURES)
+        data = dev.test_feature([{"name": "SetpointTemperature", "value": 180}])
+        assert data == [{"uid": 258, "value": 180}]
+
+    def test_unknown_enum_label_rejected(self, _print):
+        dev = make_device({}, WRITE_FEATURES)
+        with pytest.raises(Exception, match="allowed values"):
+            dev.test_feature([{"uid": 256, "value": "Ajar"}])
+
+    def test_unknown_enum_key_rejected(self, _print):
+        dev = make_device({}, WRITE_FEATURES)
+        with pytest.raises(Exception, match="not a valid value"):
+            dev.test_feature([{"uid": 256, "value": 5}])
+
+    def test_out_of_range_rejected(self, _print):
+        dev = make_device({}, WRITE_FEATURES)
+        with pytest.raises(Exception, match="range 30 and 250"):
+            dev.test_feature([{"uid": 258, "value": 300}])
+
+    def test_validate_feature_value_returns_pair(self, _print):
+        dev = make_device({}, WRITE_FEATURES)
+        assert dev.validate_feature_value("256", "Open") == (256, 0)
+
+    def test_description_change_enum_labels(self, _print):
+        import json
+
+        dev = make_device({}, dict(WRITE_FEATURES))
+        msg = json.dumps(
+            {
+                "sID": 1,
+                "msgID": 1000,
+                "resource": "/ro/descriptionChange",
+                "version": 1,
+                "action": "NOTIFY",
+                "data": [{"uid": 600, "access": "readWrite", "values": {"0": "Off", "1": "On"}}],
+            }
+        )
+        dev.handle_message(msg)
+
+        assert dev.validate_feature_value(600, "On") == (600, 1)
+
+
+PARSE_FEATURES = {
+    "256": {"name": "BSH.Common.Status.DoorState", "values": {"0": "Open", "1": "Closed"}},
+    "257": {"name": "BSH.Common.Setting.ChildLock", "refCID": "01", "refDID": "00"},
+    "258": {"name": "Cooking.Oven.Option.SetpointTemperature", "refCID": "07"},
+    "259": {"name": "BSH.Common.Root.SelectedProgram"},
+    "8196": {"name": "Dishcare.Dishwasher.Program.Eco50"},
+}
+
+
+@patch("HCDevice.HCDevice.print")
+class TestParseValues:
+    """parse_values decodes through the per-UID decoders."""
+
+    def test_enum(self, _print):
+        dev = make_device({}, PARSE_FEATURES)
+        values = dev.parse_values([{"uid": 256, "value": 1}, {"uid": "256", "value": "0"}])
+        assert values == {"BSH.Common.Status.DoorState": "Open"}
+        assert dev.parse_values([{"uid": 256, "value": 7}]) == {
+            "BSH.Common.Status.DoorState": None
+        }
+
+    def test_boolean(self, _print):
+        dev = make_device({}, PARSE_FEATURES)
+        assert dev.parse_values([{"uid": 257, "value": 1}]) == {
+            "BSH.Common.Setting.ChildLock": True
+        }
+        assert dev.parse_values([{"uid": 257, "value": "false"}]) == {
+            "BSH.Common.Setting.ChildLock": False
+        }
+
+    def test_program_name(self, _print):
+        dev = make_device({}, PARSE_FEATURES)
+        assert dev.parse_values([{"uid": 259, "value": 8196}]) == {
+            "BSH.Common.Root.SelectedProgram": "Eco50"
+        }
+
+    def test_passthrough(self, _print):
+        dev = make_device({}, PARSE_FEATURES)
+        values = dev.parse_values([{"uid": 258, "value": 180}, {"uid": 999, "value": 5}])
+        assert values == {"Cooking.Oven.Option.SetpointTemperature": 180, "999": 5}
+
+    def test_none_value_skipped(self, _print):
+        dev = make_device({}, PARSE_FEATURES)
+        assert dev.parse_values([{"uid": 256, "value": None}]) == {}
+
+
+@patch("HCDevice.HCDevice.print")
+class TestFeatureSnapshot:
+    """descriptionChange swaps in a new snapshot instead of editing the old one."""
+
+    def _change(self, dev, data):
+        import json
+
+        dev.handle_message(
+            json.dumps(
+                {
+                    "sID": 1,
+                    "msgID": 1000,
+                    "resource": "/ro/descriptionChange",
+                    "version": 1,
+                    "action": "NOTIFY",
+                    "data": data,
+                }
+            )
+        )
+
+    def test_old_snapshot_unchanged(self, _print):
+        dev = make_device({}, {"256": dict(WRITE_FEATURES["256"])})
+        old = dev._snapshot
+        self._change(dev, [{"uid": 256, "access": "read"}, {"uid": 700, "access": "read"}])
+
+        assert old.features["256"]["access"] == "readWrite"
+        assert "700" not in old.features
+        assert dev.features["256"]["access"] == "read"
+        assert "700" in dev.features
+        assert dev._snapshot is not old
+
+    def test_device_config_unchanged(self, _print):
+        config = {"name": "TestDevice", "features": {"256": dict(WRITE_FEATURES["256"])}}
+        dev = HCDevice(Mock(), config)
+        self._change(dev, [{"uid": 256, "available": "false"}, {"uid": 700, "name": "New"}])
+
+        assert dev.features["256"]["available"] == "false"
+        assert config["features"] == {"256": WRITE_FEATURES["256"]}
+
+    def test_attribute_change_shares_lookup_tables(self, _print):
+        dev = make_device({}, LOOKUP_FEATURES)
+        old = dev._snapshot
+        self._change(dev, [{"uid": 8196, "available": "false"}])
+
+        assert dev._snapshot.decoders is old.decoders
+        assert dev._snapshot.uid_by_query is old.uid_by_query
+
+
+def response(msg_id, resource, data=None, code=None):
+    import json
+
+    msg = {"sID": 1, "msgID": msg_id, "resource": resource, "version": 1, "action": "RESPONSE"}
+    if data is not None:
+        msg["data"] = data
+    if code is not None:
+        msg["code"] = code
+    return json.dumps(msg)
+
+
+@patch("HCDevice.HCDevice.print")
+class TestRequestFutures:
+    """get() returns a future that is resolved by the matching RESPONSE."""
+
+    def test_response_resolves_future(self, _print):
+        dev = make_device(IZ_SERVICES)
+        future = dev.get("/ni/info")
+        assert not future.done()
+
+        dev.handle_message(response(1000, "/ni/info", [{"ipV4": {}}]))
+
+        assert future.result(timeout=0) == [{"ipV4": {}}]
+
+    def test_error_code_raises(self, _print):
+        dev = make_device(IZ_SERVICES)
+        future = dev.get("/ni/info")
+
+        dev.handle_message(response(1000, "/ni/info", code=403))
+
+        with pytest.raises(HCDeviceError) as e:
+            future.result(timeout=0)
+        assert e.value.code == 403
+        assert e.value.resource == "/ni/info"
+
+    def test_responses_matched_by_msg_id(self, _print):
+        dev = make_device(IZ_SERVICES)
+        first = dev.get("/iz/info")
+        second = dev.get("/ni/info")
+
+        dev.handle_message(response(1001, "/ni/info", [{"second": 1}]))
+
+        assert not first.done()
+        assert second.result(timeout=0) == [{"second": 1}]
+
+    def test_notify_resolved_when_sent(self, _print):
+        dev = make_device(IZ_SERVICES)
+        future = dev.get("/ei/deviceReady", version=2, action="NOTIFY")
+        assert future.result(timeout=0) is None
+
+    def test_send_failure(self, _print):
+        dev = make_device(IZ_SERVICES)
+        dev.ws.send.side_effect = OSError("closed")
+        with patch("builtins.print"):
+            future = dev.get("/ni/info")
+        with pytest.raises(OSError):
+            future.result(timeout=0)
+        assert dev.tx_msg_id == 1001
+
+    def test_timeout(self, _print):
+        dev = make_device(IZ_SERVICES)
+        # Expires without any other message arriving
+        future = dev.get("/ni/info", timeout=0)
+
+        with pytest.raises(TimeoutError):
+            future.result(timeout=5)
+        assert dev._requests == {}
+
+    def test_response_cancels_timeout(self, _print):
+        dev = make_device(IZ_SERVICES)
+        future = dev.get("/ni/info", timeout=0.05)
+        timer = dev._requests[1000][1]
+        dev.handle_message(response(1000, "/ni/info", [{}]))
+
+        assert timer.cancelled
+        assert future.result(timeout=0) == [{}]
+
+    def test_fail_requests(self, _print):
+        dev = make_device(IZ_SERVICES)
+        future = dev.get("/ni/info")
+        dev.fail_requests(ConnectionError("closed"))
+        with pytest.raises(ConnectionError):
+            future.result(timeout=0)
+
+    def test_gather(self, _print):
+        dev = make_device(IZ_SERVICES)
+        futures = [dev.get("/iz/info"), dev.get("/ni/info")]
+        combined = dev.gather(futures)
+
+        dev.handle_message(response(1000, "/iz/info", [{}]))
+        assert not combined.done()
+        dev.handle_message(response(1001, "/ni/info", code=404))
+
+        assert combined.result(timeout=0) == futures
+
+    def test_handshake_duration(self, _print):
+        dev = make_device(IZ_SERVICES)
+        dev.reconnect()
+        assert dev.handshake_duration is None
+
+        for call in dev.ws.send.call_args_list:
+            msg = call.args[0]
+            if msg["action"] == "GET":
+                dev.handle_message(response(msg["msgID"], msg["resource"], []))
+
+        assert dev.handshake_duration is not None
+
+
+@patch("HCDevice.HCDevice.print")
+class TestCoalescedValues:
+    """set_values merges writes into one /ro/values POST."""
+
+    def make(self, window):
+        dev = make_device(IZ_SERVICES, WRITE_FEATURES)
+        dev.coalesce_window = window
+        return dev
+
+    def posts(self, dev):
+        return [
+            c.args[0]["data"]
+            for c in dev.ws.send.call_args_list
+            if c.args[0]["resource"] == "/ro/values"
+        ]
+
+    def test_sent_immediately_without_window(self, _print):
+        dev = self.make(0)
+        dev.set_values({"uid": 256, "value": "Closed"})
+        assert self.posts(dev) == [[{"uid": 256, "value": 1}]]
+
+    def test_writes_merged(self, _print):
+        dev = self.make(60)
+        first = dev.set_values({"uid": 256, "value": "Closed"})
+        second = dev.set_values([{"uid": 258, "value": 200}])
+        assert self.posts(dev) == []
+
+        dev.flush_values()
+
+        assert self.posts(dev) == [[{"uid": 256, "value": 1}, {"uid": 258, "value": 200}]]
+        dev.handle_message(response(1000, "/ro/values", []))
+        assert first.result(timeout=0) == []
+        assert second.result(timeout=0) == []
+
+    def test_last_write_wins(self, _print):
+        dev = self.make(60)
+        dev.set_values({"uid": 258, "value": 100})
+        dev.set_values({"name": "SetpointTemperature", "value": 150})
+        dev.flush_values()
+        assert self.posts(dev) == [[{"uid": 258, "value": 150}]]
+
+    def test_invalid_value_raised_immediately(self, _print):
+        dev = self.make(60)
+        with pytest.raises(Exception, match="range"):
+            dev.set_values({"uid": 258, "value": 1000})
+        dev.flush_values()
+        assert self.posts(dev) == []
+
+    def test_error_reaches_every_writer(self, _print):
+        dev = self.make(60)
+        first = dev.set_values({"uid": 256, "value": "Open"})
+        second = dev.set_values({"uid": 258, "value": 100})
+        dev.flush_values()
+        dev.handle_message(response(1000, "/ro/values", code=400))
+        for future in (first, second):
+            with pytest.raises(HCDeviceError):
+                future.result(timeout=0)
+
+    def test_window_timer_flushes(self, _print):
+        dev = self.make(0.05)
+        future = dev.set_values({"uid": 256, "value": "Open"})
+        deadline = time.monotonic() + 1
+        while not self.posts(dev) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert self.posts(dev) == [[{"uid": 256, "value": 0}]]
+        assert not future.done()
+
+
+@patch("HCDevice.HCDevice.print")
+class TestStats:
+    def test_handler_time_per_resource(self, _print):
+        dev = make_device(IZ_SERVICES)
+        dev.ws.stats.return_value = {"frames_in": 3}
+        dev.handle_message(response(1000, "/ni/info", [{"ipV4": {}}]))
+        dev.handle_message(response(1001, "/ni/info", [{"ipV4": {}}]))
+        dev.handle_message(response(1002, "/ro/values", []))
+
+        stats = dev.stats()
+        assert stats["socket"] == {"frames_in": 3}
+        assert stats["handlers"]["/ni/info"]["count"] == 2
+        assert stats["handlers"]["/ro/values"]["count"] == 1
+        assert stats["handlers"]["/ni/info"]["max_us"] > 0
@@ -0,0 +1,85 @@
+import pytest
+
+from HCFeature import Feature, load_features
+
+
+def make_feature(**kwargs):
+    data = {
+        "name": "BSH.Common.Setting.PowerState",
+        "access": "readWrite",
+        "available": "true",
+        "refCID": "03",
+        "refDID": "80",
+        "values": {"2": "On", "3": "Standby"},
+    }
+    data.update(kwargs)
+    return Feature.from_dict("539", data)
+
+
+class TestFeature:
+    def test_typed_fields(self):
+        feature = Feature.from_dict(
+            "258", {"name": "Temp", "min": "30", "max": 250, "stepSize": "0.5"}
+        )
+        assert feature.uid == 258
+        assert feature.min == 30
+        assert feature.max == 250
+        assert feature.step == 0.5
+
+    def test_no_instance_dict(self):
+        with pytest.raises(AttributeError):
+            make_feature().__dict__
+
+    def test_dict_view(self):
+        feature = make_feature()
+        assert feature["name"] == "BSH.Common.Setting.PowerState"
+        assert feature.get("refCID") == "03"
+        assert "values" in feature
+        assert "min" not in feature
+        assert feature.get("min", 5) == 5
+        with pytest.raises(KeyError):
+            feature["min"]
+
+    def test_dict_view_matches_source(self):
+        data = {
+            "name": "BSH.Common.Setting.PowerState",
+            "access": "readWrite",
+            "refCID": "03",
+            "refDID": "80",
+            "notifyOnChange": "true",
+        }
+        assert dict(Feature.from_dict("539", data)) == {"uid": 539, **data}
+
+    def test_unknown_attributes_kept(self):
+        feature = make_feature(liveUpdate="true")
+        assert feature["liveUpdate"] == "true"
+        assert feature.extra == {"liveUpdate": "true"}
+
+    def test_enum_tables_shared(self):
+        first = make_feature()
+        second = Feature.from_dict("540", {"name": "Other", "values": {"2": "On", "3": "Standby"}})
+        assert first.values is second.values
+        assert first.labels is second.labels
+        assert first.labels == {"On": 2, "Standby": 3}
+
+    def test_updated_returns_copy(self):
+        feature = make_feature()
+        changed = feature.updated({"access": "read", "min": "1"})
+        assert feature.access == "readWrite"
+        assert changed.access == "read"
+        assert changed.min == 1
+        assert changed.values is feature.values
+
+
+class TestLoadFeatures:
+    def test_converts_dicts(self):
+        features = load_features({"539": {"name": "BSH.Common.Setting.PowerState"}})
+        assert isinstance(features["539"], Feature)
+        assert features["539"].name == "BSH.Common.Setting.PowerState"
+
+    def test_keeps_loaded_features(self):
+        feature = make_feature()
+        assert load_features({"539": feature})["539"] is feature
+
+    def test_none(self):
+        assert load_features(None) is None
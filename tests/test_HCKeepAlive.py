@@ -0,0 +1,165 @@
+from unittest.mock import patch
+
+import pytest
+
+from HCKeepAlive import RTT_SAMPLE_INTERVAL, KeepAlive, RTTHistogram, keepalive_for
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    clock = Clock()
+    with patch("HCKeepAlive.time.monotonic", clock):
+        yield clock
+
+
+class TestRTTHistogram:
+    def test_empty(self):
+        histogram = RTTHistogram()
+        assert histogram.percentile(50) is None
+        assert histogram.summary() == {"count": 0}
+
+    def test_percentiles(self):
+        histogram = RTTHistogram()
+        for _ in range(90):
+            histogram.add(0.004)
+        for _ in range(10):
+            histogram.add(0.150)
+        assert histogram.percentile(50) == 0.005
+        assert histogram.percentile(95) == 0.2
+        summary = histogram.summary()
+        assert summary["count"] == 100
+        assert summary["buckets"] == {"<=5ms": 90, "<=200ms": 10}
+
+    def test_overflow_bucket(self):
+        histogram = RTTHistogram()
+        histogram.add(7.5)
+        assert histogram.percentile(99) == 7.5
+
+    def test_rolling_window(self):
+        histogram = RTTHistogram(window=4)
+        for _ in range(4):
+            histogram.add(0.5)
+        for _ in range(4):
+            histogram.add(0.001)
+        assert len(histogram) == 4
+        assert histogram.summary()["buckets"] == {"<=1ms": 4}
+
+
+class TestKeepAlive:
+    def test_no_ping_while_frames_arrive(self, clock):
+        keepalive = KeepAlive(interval_max=30)
+        keepalive.connected()
+        for _ in range(10):
+            clock.now += 20
+            keepalive.received()
+            assert keepalive.check() is None
+
+    def test_ping_when_idle(self, clock):
+        keepalive = KeepAlive(interval_max=30)
+        keepalive.connected()
+        clock.now += 29
+        assert keepalive.check() is None
+        assert keepalive.poll_timeout() == pytest.approx(1)
+        clock.now += 1
+        assert keepalive.check() == "ping"
+
+    def test_ping_chatty_appliance_for_rtt(self, clock):
+        keepalive = KeepAlive()
+        keepalive.connected()
+        clock.now += RTT_SAMPLE_INTERVAL
+        keepalive.received()
+        assert keepalive.check() == "ping"
+
+    def test_pong_records_rtt(self, clock):
+        keepalive = KeepAlive(interval_min=5, interval_max=30)
+        keepalive.connected()
+        payload = keepalive.ping()
+        clock.now += 0.012
+        assert keepalive.pong(payload) == pytest.approx(0.012)
+        assert keepalive.rtt.summary()["count"] == 1
+        assert keepalive.check() is None
+
+    def test_unsolicited_pong_ignored(self, clock):
+        keepalive = KeepAlive()
+        assert keepalive.pong(b"") is None
+        keepalive.ping()
+        assert keepalive.pong(b"other") is None
+        assert len(keepalive.rtt) == 0
+
+    def test_missed_pong_is_dead(self, clock):
+        keepalive = KeepAlive(interval_min=5, interval_max=30, timeout_max=10)
+        keepalive.connected()
+        keepalive.ping()
+        clock.now += 9
+        assert keepalive.check() is None
+        clock.now += 1
+        assert keepalive.check() == "dead"
+        assert keepalive.missed == 1
+
+    def test_frames_after_ping_extend_deadline(self, clock):
+        keepalive = KeepAlive(timeout_max=10)
+        keepalive.connected()
+        keepalive.ping()
+        clock.now += 8
+        keepalive.received()
+        clock.now += 8
+        assert keepalive.check() is None
+
+    def test_interval_follows_idle_gap(self, clock):
+        keepalive = KeepAlive(interval_min=5, interval_max=30)
+        keepalive.connected()
+        assert keepalive.interval == 30
+        for _ in range(20):
+            clock.now += 3
+            keepalive.received()
+        assert keepalive.interval == pytest.approx(9)
+        # Quiet for three times the usual gap
+        clock.now += 9
+        assert keepalive.check() == "ping"
+
+    def test_interval_bounds(self, clock):
+        keepalive = KeepAlive(interval_min=5, interval_max=30)
+        keepalive.connected()
+        for _ in range(20):
+            clock.now += 0.1
+            keepalive.received()
+        assert keepalive.interval == 5
+        for _ in range(20):
+            clock.now += 60
+            keepalive.received()
+        assert keepalive.interval == 30
+
+    def test_timeout_follows_rtt(self, clock):
+        keepalive = KeepAlive(timeout_min=2, timeout_max=10)
+        assert keepalive.timeout() == 10
+        for _ in range(20):
+            payload = keepalive.ping()
+            clock.now += 0.004
+            keepalive.pong(payload)
+        assert keepalive.timeout() == 2
+        for _ in range(20):
+            payload = keepalive.ping()
+            clock.now += 0.8
+            keepalive.pong(payload)
+        assert keepalive.timeout() == 4
+
+    def test_stats(self, clock):
+        keepalive = KeepAlive()
+        keepalive.pong(keepalive.ping())
+        stats = keepalive.stats()
+        assert stats["pings"] == 1
+        assert stats["missed_pongs"] == 0
+        assert stats["rtt"]["count"] == 1
+
+
+def test_keepalive_shared_per_host():
+    assert keepalive_for("oven.local") is keepalive_for("oven.local")
+    assert keepalive_for("oven.local") is not keepalive_for("washer.local")
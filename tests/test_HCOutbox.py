@@ -0,0 +1,99 @@
+import time
+
+from HCOutbox import (
+    Outbox,
+    RateLimits,
+    outbox_for,
+    rate_limits_from,
+)
+
+
+class TestOutbox:
+    def test_latest_value_wins(self):
+        outbox = Outbox()
+        outbox.put("a", "1")
+        outbox.put("b", "2")
+        outbox.put("a", "3")
+        assert outbox.take() == [("b", "2"), ("a", "3")]
+        assert outbox.take() == []
+        assert outbox.superseded == 1
+
+    def test_oldest_dropped_when_full(self):
+        outbox = Outbox(limit=2)
+        outbox.put("a", "1")
+        outbox.put("b", "2")
+        outbox.put("c", "3")
+        assert outbox.take() == [("b", "2"), ("c", "3")]
+        assert outbox.stats() == {
+            "pending": 0,
+            "deferred": 0,
+            "superseded": 0,
+            "dropped": 1,
+            "rate_limited": 0,
+        }
+
+    def test_shared_per_device(self):
+        assert outbox_for("homeconnect/Oven") is outbox_for("homeconnect/Oven")
+        assert outbox_for("homeconnect/Oven") is not outbox_for("homeconnect/Washer")
+
+
+class TestRateLimits:
+    def test_longest_prefix_wins(self):
+        limits = RateLimits({"Cooking.Hob.Status.Zone.": 10, "Cooking.Hob.Status.Zone.001.": 5})
+        assert limits.interval("Cooking.Hob.Status.Zone.001.PowerLevel") == 5
+        assert limits.interval("Cooking.Hob.Status.Zone.002.PowerLevel") == 10
+        assert limits.interval("BSH.Common.Status.DoorState") is None
+        assert not RateLimits()
+
+    def test_hold_back(self):
+        outbox = Outbox()
+        outbox.rate_limits = RateLimits({"BSH.Common.Option.ProgramProgress": 30})
+        changed = {"BSH.Common.Option.ProgramProgress": 10, "BSH.Common.Status.DoorState": "Open"}
+        assert outbox.hold_back(changed) == {}
+        assert len(changed) == 2
+        outbox.published(changed)
+        assert list(outbox.last_published) == ["BSH.Common.Option.ProgramProgress"]
+
+        changed = {
+            "BSH.Common.Option.ProgramProgress": 11,
+            "BSH.Common.Status.DoorState": "Closed",
+        }
+        held = outbox.hold_back(changed)
+        assert changed == {"BSH.Common.Status.DoorState": "Closed"}
+        assert 29 < held["BSH.Common.Option.ProgramProgress"] <= 30
+        assert outbox.rate_limited == 1
+
+    def test_held_back_counted_once(self):
+        outbox = Outbox()
+        outbox.rate_limits = RateLimits({"BSH.Common.Option.ProgramProgress": 30})
+        outbox.last_published["BSH.Common.Option.ProgramProgress"] = time.monotonic()
+        for _ in range(10):
+            # The held back key stays dirty and is offered again with each message
+            outbox.hold_back({"BSH.Common.Option.ProgramProgress": 11})
+        assert outbox.rate_limited == 1
+
+        # Due and published, then held back again
+        outbox.last_published["BSH.Common.Option.ProgramProgress"] -= 30
+        assert outbox.hold_back({"BSH.Common.Option.ProgramProgress": 12}) == {}
+        outbox.published(["BSH.Common.Option.ProgramProgress"])
+        outbox.hold_back({"BSH.Common.Option.ProgramProgress": 13})
+        assert outbox.rate_limited == 2
+
+    def test_not_limited_when_not_configured(self):
+        assert not rate_limits_from({})
+        assert not rate_limits_from(None)
+        configured = rate_limits_from({"PUBLISH_RATE_LIMITS": {"Cooking.Oven.": 10}})
+        assert configured.interval("BSH.Common.Option.RemainingProgramTime") is None
+        assert configured.interval("Cooking.Oven.Status.CurrentCavityTemperature") == 10
+        # An empty section turns rate limiting off
+        assert not rate_limits_from({"PUBLISH_RATE_LIMITS": None})
+
+    def test_interval_starts_when_published(self):
+        outbox = Outbox()
+        outbox.rate_limits = RateLimits({"BSH.Common.Option.ProgramProgress": 30})
+        changed = {"BSH.Common.Option.ProgramProgress": 10}
+        outbox.hold_back(changed)
+        # Not published, e.g. MQTT is down, so the next change isn't held back
+        changed = {"BSH.Common.Option.ProgramProgress": 11}
+        assert outbox.hold_back(changed) == {}
+        assert changed == {"BSH.Common.Option.ProgramProgress": 11}
@@ -0,0 +1,170 @@
+import json
+import time
+from unittest.mock import Mock, patch
+
+import pytest
+
+from HCDevice import HCDevice
+from HCReplay import MAGIC, OPEN, RX, TX, FrameRecorder, ReplaySocket, read_recording
+from HCSocket import HCSocket
+
+PSK64 = "Lq6DlW_5gkZVdMWfFIU0EGIAWEdqPgh6TNDMt3w5hOg"
+IV64 = "VDEyT8bsH4UTVhLWJCPiVg"
+
+FEATURES = {
+    "256": {
+        "name": "BSH.Common.Status.DoorState",
+        "access": "read",
+        "refCID": "03",
+        "refDID": "80",
+        "values": {"0": "Open", "1": "Closed"},
+    },
+}
+
+
+def frame(msg_id, resource, action, data):
+    return json.dumps(
+        {
+            "sID": 7,
+            "msgID": msg_id,
+            "resource": resource,
+            "version": 1,
+            "action": action,
+            "data": data,
+        }
+    )
+
+
+SESSION = [
+    frame(1, "/ei/initialValues", "POST", [{"edMsgID": 100}]),
+    frame(100, "/ci/services", "RESPONSE", [{"service": "ci", "version": 3}]),
+    frame(2, "/ro/values", "NOTIFY", [{"uid": 256, "value": 0}]),
+    frame(3, "/ro/values", "NOTIFY", [{"uid": 256, "value": 1}]),
+]
+
+
+@pytest.fixture
+def recording(tmp_path):
+    path = tmp_path / "oven.hcrec"
+    recorder = FrameRecorder(path)
+    recorder.opened("ws://oven/homeconnect")
+    for i, text in enumerate(SESSION):
+        recorder.received(text)
+        if i == 0:
+            recorder.sent('{"sID":7,"msgID":1,"action":"RESPONSE"}')
+    recorder.close()
+    return path
+
+
+class TestRecording:
+    def test_round_trip(self, recording):
+        records = list(read_recording(recording))
+        assert [direction for _, direction, _ in records] == [OPEN, RX, TX, RX, RX, RX]
+        assert [payload for _, direction, payload in records if direction == RX] == SESSION
+        timestamps = [timestamp for timestamp, _, _ in records]
+        assert timestamps == sorted(timestamps)
+
+    def test_append(self, recording):
+        recorder = FrameRecorder(recording)
+        recorder.received(b'{"bytes":1}')
+        recorder.close()
+        records = list(read_recording(recording))
+        assert len(records) == 7
+        assert records[-1][2] == '{"bytes":1}'
+        assert recording.read_bytes().count(MAGIC) == 1
+
+    def test_flushed_on_close(self, tmp_path):
+        path = tmp_path / "oven.hcrec"
+        recorder = FrameRecorder(path)
+        recorder.received(SESSION[0])
+        # Buffered until the flush interval has passed
+        assert path.read_bytes() == b""
+        recorder.close()
+        recorder.received(SESSION[1])
+        assert [payload for _, _, payload in read_recording(path)] == SESSION[:1]
+
+    @patch("HCReplay.FLUSH_INTERVAL", 0)
+    def test_flushed_after_interval(self, tmp_path):
+        path = tmp_path / "oven.hcrec"
+        recorder = FrameRecorder(path)
+        recorder.received(SESSION[0])
+        assert [payload for _, _, payload in read_recording(path)] == SESSION[:1]
+        recorder.close()
+
+    @patch("HCReplay.FLUSH_INTERVAL", 0.05)
+    def test_last_frame_flushed_by_timer(self, tmp_path):
+        path = tmp_path / "oven.hcrec"
+        recorder = FrameRecorder(path)
+        recorder.received(SESSION[0])
+        # No frame follows, the timer flushes it
+        deadline = time.monotonic() + 5
+        while path.stat().st_size <= len(MAGIC) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert [payload for _, _, payload in read_recording(path)] == SESSION[:1]
+        recorder.close()
+
+    def test_close_cancels_flush_timer(self, tmp_path):
+        recorder = FrameRecorder(tmp_path / "oven.hcrec")
+        recorder.received(SESSION[0])
+        timer = recorder._flush_timer
+        recorder.close()
+        timer.join(1)
+        assert not timer.is_alive()
+
+    def test_truncated_record_dropped(self, recording):
+        data = recording.read_bytes()
+        recording.write_bytes(data[:-3])
+        assert len(list(read_recording(recording))) == 5
+
+    def test_not_a_recording(self, tmp_path):
+        path = tmp_path / "log.txt"
+        path.write_text("hello")
+        with pytest.raises(ValueError):
+            list(read_recording(path))
+
+    def test_socket_records_sent_frames(self, tmp_path):
+        sock = HCSocket("192.0.2.10", PSK64, IV64)
+        sock.ws = Mock()
+        sock.recorder = FrameRecorder(tmp_path / "oven.hcrec")
+        sock.send({"sID": 1, "msgID": 2, "resource": "/ci/info", "version": 1, "action": "GET"})
+        sock.recorder.close()
+        [(_, direction, payload)] = read_recording(tmp_path / "oven.hcrec")
+        assert direction == TX
+        assert json.loads(payload)["resource"] == "/ci/info"
+
+
+@patch("HCDevice.HCDevice.print")
+class TestReplaySocket:
+    @patch("HCDevice.HCDevice.start_handshake")
+    def test_replay_through_device(self, start_handshake, _print, recording):
+        ws = ReplaySocket(recording, speed=0)
+        device = HCDevice(ws, {"name": "oven", "features": dict(FEATURES)})
+        values = []
+        closed = []
+        device.run_forever(values.append, lambda ws: None, lambda *args: closed.append(args))
+
+        assert {"BSH.Common.Status.DoorState": "Open"} in values
+        assert values[-1] == {"BSH.Common.Status.DoorState": "Closed"}
+        assert json.loads(ws.sent[0])["resource"] == "/ei/initialValues"
+        start_handshake.assert_called_once()
+        assert device.services == {"ci": {"version": 3}}
+        assert device.handler_stats.summary()["/ro/values"]["count"] == 2
+        assert ws.stats()["frames_in"] == 4
+        assert closed == [(ws, 1000, "end of recording")]
+
+    def test_speed(self, _print, tmp_path):
+        path = tmp_path / "slow.hcrec"
+        recorder = FrameRecorder(path)
+        recorder.received(SESSION[2])
+        time.sleep(0.2)
+        recorder.received(SESSION[3])
+        recorder.close()
+
+        def replay(speed):
+            ws = ReplaySocket(path, speed=speed)
+            start = time.monotonic()
+            ws.run_forever(Mock(), Mock(), Mock(), Mock())
+            return time.monotonic() - start
+
+        assert replay(1) >= 0.2
+        assert replay(4) < 0.15
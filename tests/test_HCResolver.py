@@ -0,0 +1,128 @@
+import json
+import socket
+from unittest.mock import patch
+
+import pytest
+
+from HCResolver import Resolver, address_info, interleave
+
+V4 = [address_info("192.0.2.1", 80), address_info("192.0.2.2", 80)]
+V6 = [address_info("2001:db8::1", 80), address_info("2001:db8::2", 80)]
+
+
+@patch("HCResolver.socket.getaddrinfo")
+class TestResolve:
+    def test_lookup_is_cached(self, getaddrinfo):
+        getaddrinfo.return_value = list(V4)
+        resolver = Resolver()
+        assert resolver.resolve("oven", 80) == V4
+        assert resolver.resolve("oven", 80) == V4
+        assert getaddrinfo.call_count == 1
+
+    def test_cache_expires(self, getaddrinfo):
+        getaddrinfo.return_value = list(V4)
+        resolver = Resolver(ttl=0)
+        resolver.resolve("oven", 80)
+        resolver.resolve("oven", 80)
+        assert getaddrinfo.call_count == 2
+
+    def test_failure_is_cached(self, getaddrinfo):
+        getaddrinfo.side_effect = socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        resolver = Resolver()
+        for _ in range(3):
+            with pytest.raises(socket.gaierror):
+                resolver.resolve("oven", 80)
+        assert getaddrinfo.call_count == 1
+
+    def test_failure_expires(self, getaddrinfo):
+        getaddrinfo.side_effect = [socket.gaierror(socket.EAI_AGAIN, "again"), list(V4)]
+        resolver = Resolver(negative_ttl=0)
+        with pytest.raises(socket.gaierror):
+            resolver.resolve("oven", 80)
+        assert resolver.resolve("oven", 80) == V4
+
+    def test_families_interleaved(self, getaddrinfo):
+        getaddrinfo.return_value = V6 + V4
+        assert Resolver().resolve("oven", 80) == [V6[0], V4[0], V6[1], V4[1]]
+
+    def test_last_good_first(self, getaddrinfo):
+        getaddrinfo.return_value = list(V4)
+        resolver = Resolver()
+        resolver.resolve("oven", 80)
+        resolver.remember("oven", 80, ("192.0.2.2", 80))
+        assert resolver.resolve("oven", 80)[0] == V4[1]
+        assert getaddrinfo.call_count == 1
+
+    def test_failed_after_lookup(self, getaddrinfo):
+        getaddrinfo.return_value = list(V4)
+        resolver = Resolver()
+        resolver.resolve("oven", 80)
+        resolver.failed("oven", 80)
+        assert resolver.resolve("oven", 80) == V4
+        assert getaddrinfo.call_count == 2
+
+    def test_failed_address_demoted(self, getaddrinfo):
+        getaddrinfo.return_value = list(V4)
+        resolver = Resolver()
+        resolver.resolve("oven", 80)
+        resolver.remember("oven", 80, ("192.0.2.1", 80))
+        for _ in range(3):
+            resolver.failed("oven", 80)
+        assert resolver.resolve("oven", 80) == [V4[1], V4[0]]
+        assert getaddrinfo.call_count == 1
+
+
+class TestPersistence:
+    @patch("HCResolver.socket.getaddrinfo")
+    def test_restart_without_lookup(self, getaddrinfo, tmp_path):
+        cache_file = tmp_path / "addresses.json"
+        resolver = Resolver(cache_file=str(cache_file))
+        resolver.remember("oven", 443, ("2001:db8::1", 443, 0, 0))
+        assert json.loads(cache_file.read_text()) == {"oven": "2001:db8::1"}
+
+        restarted = Resolver()
+        restarted.load(str(cache_file))
+        assert restarted.resolve("oven", 443) == [address_info("2001:db8::1", 443)]
+        getaddrinfo.assert_not_called()
+
+    def test_missing_file(self, tmp_path):
+        resolver = Resolver()
+        resolver.load(str(tmp_path / "addresses.json"))
+        assert resolver.cached("oven", 80) is None
+
+    @patch("builtins.print")
+    def test_corrupt_file(self, mock_print, tmp_path):
+        cache_file = tmp_path / "addresses.json"
+        cache_file.write_text("{")
+        resolver = Resolver()
+        resolver.load(str(cache_file))
+        assert resolver.cached("oven", 80) is None
+        mock_print.assert_called_once()
+
+    def test_unchanged_address_not_rewritten(self, tmp_path):
+        cache_file = tmp_path / "addresses.json"
+        resolver = Resolver(cache_file=str(cache_file))
+        resolver.remember("oven", 80, ("192.0.2.1", 80))
+        cache_file.unlink()
+        resolver.remember("oven", 80, ("192.0.2.1", 80))
+        assert not cache_file.exists()
+
+    @patch("HCResolver.socket.getaddrinfo")
+    def test_failure_keeps_last_good(self, getaddrinfo, tmp_path):
+        getaddrinfo.return_value = [address_info("192.0.2.1", 80)]
+        cache_file = tmp_path / "addresses.json"
+        resolver = Resolver(cache_file=str(cache_file))
+        resolver.remember("oven", 80, ("192.0.2.1", 80))
+        resolver.resolve("oven", 80)
+        resolver.failed("oven", 80)
+        resolver.resolve("oven", 80)
+        resolver.failed("oven", 80)
+        assert json.loads(cache_file.read_text()) == {"oven": "192.0.2.1"}
+
+        restarted = Resolver()
+        restarted.load(str(cache_file))
+        assert restarted.cached("oven", 80) == [address_info("192.0.2.1", 80)]
+
+
+def test_interleave_single_family():
+    assert interleave(V4) == V4
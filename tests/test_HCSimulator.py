@@ -0,0 +1,164 @@
+import asyncio
+import json
+import random
+import threading
+
+from click.testing import CliRunner
+
+from HCAsync import AsyncHCDevice, AsyncHCSocket
+from HCDevice import HCDevice
+from HCSimulator import VirtualAppliance, changed_value, initial_value, simulate
+from HCSocket import HCSocket
+
+PSK64 = "Lq6DlW_5gkZVdMWfFIU0EGIAWEdqPgh6TNDMt3w5hOg"
+IV64 = "VDEyT8bsH4UTVhLWJCPiVg"
+
+FEATURES = {
+    "256": {
+        "name": "BSH.Common.Status.DoorState",
+        "access": "read",
+        "refCID": "03",
+        "refDID": "80",
+        "values": {"0": "Open", "1": "Closed"},
+    },
+    "539": {
+        "name": "BSH.Common.Setting.PowerState",
+        "access": "readWrite",
+        "refCID": "03",
+        "refDID": "80",
+        "values": {"1": "Off", "2": "On"},
+    },
+    "5120": {
+        "name": "Cooking.Oven.Option.SetpointTemperature",
+        "access": "readWrite",
+        "refCID": "07",
+        "refDID": "A1",
+        "min": "30",
+        "max": "275",
+        "stepSize": "5",
+    },
+    "544": {"name": "BSH.Common.Command.AbortProgram", "access": "writeOnly", "refCID": "01"},
+}
+
+
+def oven():
+    # HCDevice replaces the features with parsed ones
+    return {
+        "name": "oven",
+        "host": "127.0.0.1",
+        "key": PSK64,
+        "iv": IV64,
+        "features": dict(FEATURES),
+    }
+
+
+async def wait_until(condition, timeout=5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+class TestValues:
+    def test_initial_values(self):
+        appliance = VirtualAppliance(oven())
+        # Write-only features have no value to report
+        assert appliance.values == {256: 0, 539: 1, 5120: 30}
+        assert initial_value({"refCID": "01"}) is False
+        assert initial_value({"refCID": "03", "initValue": "7"}) == 7
+
+    def test_changed_values(self):
+        rnd = random.Random(1)
+        assert changed_value(FEATURES["539"], 1, rnd) == 2
+        assert changed_value({"refCID": "01"}, False, rnd) is True
+        for _ in range(20):
+            value = changed_value(FEATURES["5120"], 30, rnd)
+            assert 30 <= value <= 275 and value % 5 == 0
+
+
+class TestAsyncDevice:
+    def test_handshake_changes_and_write(self, capsys):
+        async def scenario():
+            appliance = await VirtualAppliance(oven(), change_interval=0.01, seed=1).start()
+            ws = AsyncHCSocket("127.0.0.1", PSK64, IV64, port=appliance.port)
+            device = AsyncHCDevice(ws, oven())
+            values = []
+            task = asyncio.ensure_future(
+                device.run(values.append, lambda ws: None, lambda *args: None)
+            )
+            await wait_until(lambda: device.handshake_duration is not None)
+            await wait_until(lambda: len(values) > 5)
+
+            loop = asyncio.get_running_loop()
+            request = await loop.run_in_executor(
+                None, device.set_values, {"name": "BSH.Common.Setting.PowerState", "value": 2}
+            )
+            await asyncio.wait_for(asyncio.wrap_future(request), 5)
+            await wait_until(lambda: appliance.values[539] == 2)
+
+            ws.close()
+            await asyncio.wait_for(task, 5)
+            await appliance.stop()
+            return device, values
+
+        device, values = asyncio.run(scenario())
+        assert any(batch.get("mac", "").startswith("02-00-00") for batch in values)
+        assert any(batch.get("BSH.Common.Status.DoorState") == "Open" for batch in values)
+        names = {name for batch in values for name in batch}
+        assert "BSH.Common.Setting.PowerState" in names
+        assert "BSH.Common.Command.AbortProgram" not in names
+
+
+class TestHCSocket:
+    def test_threaded_client(self, capsys):
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        appliance = asyncio.run_coroutine_threadsafe(
+            VirtualAppliance(oven(), change_interval=0.01, seed=2).start(), loop
+        ).result(5)
+
+        ws = HCSocket("127.0.0.1", PSK64, IV64, port=appliance.port)
+        device = HCDevice(ws, oven())
+        values = []
+
+        def on_message(batch):
+            values.append(batch)
+            if len(values) > 5:
+                ws.close()
+
+        device.run_forever(on_message, lambda ws: None, lambda *args: None)
+
+        asyncio.run_coroutine_threadsafe(appliance.stop(), loop).result(5)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(5)
+        assert len(values) > 5
+        assert appliance.frames_in >= 3
+
+
+class TestCommandLine:
+    def test_writes_devices_file(self, tmp_path, capsys):
+        devices_file = tmp_path / "devices.json"
+        devices_file.write_text(json.dumps([oven()]))
+        out_file = tmp_path / "sim-devices.json"
+
+        result = CliRunner().invoke(
+            simulate,
+            [
+                "-d",
+                str(devices_file),
+                "--count",
+                "3",
+                "--base_port",
+                "0",
+                "--duration",
+                "0",
+                "--out",
+                str(out_file),
+            ],
+        )
+
+        assert result.exit_code == 0, result.output
+        devices = json.loads(out_file.read_text())
+        assert [d["name"] for d in devices] == ["oven_sim0", "oven_sim1", "oven_sim2"]
+        assert all(d["host"] == "127.0.0.1" for d in devices)
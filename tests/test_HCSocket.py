@@ -0,0 +1,503 @@
+import inspect
+import json
+import socket
+import ssl
+import threading
+import time
+from unittest.mock import Mock, patch
+
+import pytest
+import websocket
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+
+import HCSocket as HCSocket_module
+from HCCrypto import CLIENT_TO_DEVICE, DEVICE_TO_CLIENT, FrameCodec
+from HCKeepAlive import KeepAlive
+from HCResolver import Resolver, address_info
+from HCSocket import (
+    SOCKET_TIMEOUT,
+    HCSocket,
+    KeepAliveApp,
+    KeepAliveDispatcher,
+    connect_staggered,
+    encode_frame,
+    hmac,
+    tls_handshake,
+)
+
+
+def legacy_encode(msg):
+    # HCSocket.send before frames were built from templates
+    return json.dumps(msg, separators=(",", ":")).replace("'", '"')
+
+
+FRAMES = [
+    {
+        "sID": 1834234000,
+        "msgID": 3906210004,
+        "resource": "/ci/services",
+        "version": 1,
+        "action": "GET",
+    },
+    {
+        "sID": 1834234000,
+        "msgID": 3906210005,
+        "resource": "/ro/values",
+        "version": 1,
+        "action": "POST",
+        "data": [{"uid": 539, "value": 2}],
+    },
+    {
+        "sID": 1834234000,
+        "msgID": 3906210006,
+        "resource": "/ro/activeProgram",
+        "version": 1,
+        "action": "POST",
+        "data": [{"program": 8196, "options": [{"uid": 558, "value": 600}]}],
+    },
+    {
+        "sID": 1834234000,
+        "msgID": 3906210007,
+        "resource": "/ei/deviceReady",
+        "version": 2,
+        "action": "NOTIFY",
+    },
+    {
+        "sID": 1834234000,
+        "msgID": 3906210008,
+        "resource": "/ci/authentication",
+        "version": 2,
+        "action": "GET",
+        "data": [{"nonce": "cGFkZGluZw'"}],
+    },
+    {
+        "sID": 1834234000,
+        "msgID": 3906210009,
+        "resource": "/ro/values",
+        "version": 1,
+        "action": "RESPONSE",
+        "data": [{"uid": 539, "value": None}],
+    },
+]
+
+
+class TestEncodeFrame:
+    @pytest.mark.parametrize("msg", FRAMES)
+    def test_matches_legacy_encoding(self, msg):
+        assert encode_frame(msg) == legacy_encode(msg)
+
+    def test_template_reused(self):
+        first = encode_frame(FRAMES[1])
+        second = encode_frame(dict(FRAMES[1], msgID=3906210010, data=[{"uid": 539, "value": 3}]))
+        assert (
+            first.replace("3906210005", "3906210010").replace('"value":2', '"value":3') == second
+        )
+
+    def test_single_quotes_swapped_in_data(self):
+        assert '"nonce":"cGFkZGluZw""' in encode_frame(FRAMES[4])
+
+    def test_no_session_id_yet(self):
+        msg = {"sID": None, "msgID": 1, "resource": "/ci/services", "version": 1, "action": "GET"}
+        assert encode_frame(msg) == legacy_encode(msg)
+
+    def test_unexpected_keys(self):
+        msg = dict(FRAMES[0], extra="it's")
+        assert encode_frame(msg) == legacy_encode(msg)
+
+    def test_missing_keys(self):
+        msg = {"sID": 1, "msgID": 2, "resource": "/ci/services", "version": 1, "data": []}
+        assert encode_frame(msg) == legacy_encode(msg)
+
+
+class TestSend:
+    def test_send_tls(self):
+        sock = HCSocket("192.0.2.10", "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA")
+        sock.ws = Mock()
+        sock.send(FRAMES[1])
+        sock.ws.send.assert_called_once_with(legacy_encode(FRAMES[1]))
+
+
+PSK64 = "Lq6DlW_5gkZVdMWfFIU0EGIAWEdqPgh6TNDMt3w5hOg"
+IV64 = "VDEyT8bsH4UTVhLWJCPiVg"
+
+
+class LegacyCodec:
+    # HCSocket.encrypt/decrypt before FrameCodec
+    def __init__(self, enckey, mackey, iv, rx=b"\x43", tx=b"\x45"):
+        self.enckey, self.mackey, self.iv, self.rx, self.tx = enckey, mackey, iv, rx, tx
+        self.last_rx_hmac = bytes(16)
+        self.last_tx_hmac = bytes(16)
+        self.aes_encrypt = AES.new(enckey, AES.MODE_CBC, iv)
+        self.aes_decrypt = AES.new(enckey, AES.MODE_CBC, iv)
+
+    def hmac_msg(self, direction, enc_msg):
+        return hmac(self.mackey, self.iv + direction + enc_msg)[0:16]
+
+    def decrypt(self, buf):
+        enc_msg = buf[0:-16]
+        their_hmac = buf[-16:]
+        if their_hmac != self.hmac_msg(self.rx + self.last_rx_hmac, enc_msg):
+            return None
+        self.last_rx_hmac = their_hmac
+        msg = self.aes_decrypt.decrypt(enc_msg)
+        pad_len = msg[-1]
+        return msg[0:-pad_len]
+
+    def encrypt(self, clear_msg):
+        clear_msg = bytes(clear_msg, "utf-8")
+        pad_len = 16 - (len(clear_msg) % 16)
+        if pad_len == 1:
+            pad_len += 16
+        clear_msg += b"\x00" + get_random_bytes(pad_len - 2) + bytearray([pad_len])
+        enc_msg = self.aes_encrypt.encrypt(clear_msg)
+        self.last_tx_hmac = self.hmac_msg(self.tx + self.last_tx_hmac, enc_msg)
+        return enc_msg + self.last_tx_hmac
+
+
+def fixed_random(n):
+    return bytes(range(n))
+
+
+@pytest.fixture
+def http_socket():
+    sock = HCSocket("192.0.2.10", PSK64, IV64)
+    sock.reset()
+    return sock
+
+
+def device_codec(sock, cls=FrameCodec):
+    return cls(sock.enckey, sock.mackey, sock.iv, rx=CLIENT_TO_DEVICE, tx=DEVICE_TO_CLIENT)
+
+
+class TestFrameCodec:
+    def test_encrypt_matches_legacy(self, http_socket):
+        http_socket.codec.random_bytes = fixed_random
+        legacy = LegacyCodec(http_socket.enckey, http_socket.mackey, http_socket.iv)
+        with patch(f"{__name__}.get_random_bytes", fixed_random):
+            for msg in FRAMES:
+                text = encode_frame(msg)
+                assert http_socket.encrypt(text) == legacy.encrypt(text)
+
+    @pytest.mark.parametrize("size", [0, 1, 14, 15, 16, 17, 31, 32, 5000])
+    def test_round_trip(self, http_socket, size):
+        device = device_codec(http_socket)
+        text = "x" * size
+        for _ in range(3):
+            assert device.decrypt(http_socket.encrypt(text)) == text.encode()
+            assert http_socket.decrypt(device.encrypt(text)) == text.encode()
+
+    def test_decrypt_matches_legacy(self, http_socket):
+        device = device_codec(http_socket, LegacyCodec)
+        for msg in FRAMES:
+            text = encode_frame(msg)
+            assert http_socket.decrypt(device.encrypt(text)) == text.encode()
+
+    def test_decrypt_bytearray(self, http_socket):
+        device = device_codec(http_socket)
+        frame = bytearray(device.encrypt('{"sID":1}'))
+        assert http_socket.decrypt(frame) == b'{"sID":1}'
+
+    @patch("builtins.print")
+    def test_hmac_failure(self, mock_print, http_socket):
+        device = device_codec(http_socket)
+        frame = bytearray(device.encrypt('{"sID":1}'))
+        frame[-1] ^= 1
+        assert http_socket.decrypt(bytes(frame)) is None
+        assert http_socket.codec.hmac_failures == 1
+
+    @patch("builtins.print")
+    def test_hmac_chained(self, mock_print, http_socket):
+        device = device_codec(http_socket)
+        device.encrypt('{"sID":1}')
+        # Skipping a frame breaks the chain
+        assert http_socket.decrypt(device.encrypt('{"sID":2}')) is None
+
+    @patch("builtins.print")
+    def test_short_frame(self, mock_print, http_socket):
+        assert http_socket.decrypt(bytes(16)) is None
+
+    def test_reset(self, http_socket):
+        device = device_codec(http_socket)
+        http_socket.encrypt('{"sID":1}')
+        http_socket.reset()
+        assert device.decrypt(http_socket.encrypt('{"sID":2}')) == b'{"sID":2}'
+
+    def test_send_http(self, http_socket):
+        http_socket.ws = Mock()
+        http_socket.send(FRAMES[0])
+        frame = http_socket.ws.send_bytes.call_args.args[0]
+        assert device_codec(http_socket).decrypt(frame) == encode_frame(FRAMES[0]).encode()
+
+    def test_stats(self, http_socket):
+        http_socket.ws = Mock()
+        device = device_codec(http_socket)
+        http_socket.send(FRAMES[0])
+        frame = device.encrypt('{"sID":1}')
+        http_socket.decrypt(frame)
+        stats = http_socket.stats()
+        assert stats["frames_out"] == 1
+        assert stats["bytes_out"] == len(http_socket.ws.send_bytes.call_args.args[0])
+        assert stats["encrypt_ms"] > 0
+        assert stats["decrypt_ms"] > 0
+        assert stats["hmac_failures"] == 0
+        assert "ping_interval" in stats["keepalive"]
+
+
+@pytest.fixture
+def tls_cache():
+    HCSocket_module._tls_contexts.clear()
+    HCSocket_module._tls_sessions.clear()
+    yield
+    HCSocket_module._tls_contexts.clear()
+    HCSocket_module._tls_sessions.clear()
+
+
+def tls_socket(session, reused=False):
+    sock = Mock()
+    sock.session = session
+    sock.session_reused = reused
+    return sock
+
+
+@patch("builtins.print")
+@patch("HCSocket.tls_psk_mechanism", return_value="native")
+class TestTLSResumption:
+    def test_context_reused_and_session_resumed(self, mock_mechanism, mock_print, tls_cache):
+        context = Mock()
+        context.wrap_socket.side_effect = [tls_socket("first"), tls_socket("second", True)]
+        with patch.object(HCSocket, "create_tls_context", return_value=context) as create:
+            first = HCSocket("192.0.2.10", PSK64)
+            first.wrap_socket_psk(Mock())
+            second = HCSocket("192.0.2.10", PSK64)
+            second.wrap_socket_psk(Mock())
+
+        create.assert_called_once()
+        sessions = [c.kwargs["session"] for c in context.wrap_socket.call_args_list]
+        assert sessions == [None, "first"]
+        assert first.tls_session_reused is False
+        assert second.tls_session_reused is True
+        assert second.tls_handshake_duration >= 0
+
+    def test_context_per_appliance(self, mock_mechanism, mock_print, tls_cache):
+        with patch.object(HCSocket, "create_tls_context", side_effect=lambda: Mock()) as create:
+            HCSocket("192.0.2.10", PSK64).tls_context()
+            HCSocket("192.0.2.11", PSK64).tls_context()
+            HCSocket("192.0.2.10", PSK64).tls_context()
+        assert create.call_count == 2
+
+    def test_failed_handshake_drops_session(self, mock_mechanism, mock_print, tls_cache):
+        context = Mock()
+        context.wrap_socket.side_effect = [
+            tls_socket("first"),
+            OSError("reset"),
+            tls_socket("new"),
+        ]
+        with patch.object(HCSocket, "create_tls_context", return_value=context):
+            for _ in range(3):
+                HCSocket("192.0.2.10", PSK64).wrap_socket_psk(Mock())
+        sessions = [c.kwargs["session"] for c in context.wrap_socket.call_args_list]
+        assert sessions == [None, "first", None]
+
+    def test_no_psk_mechanism(self, mock_mechanism, mock_print, tls_cache):
+        mock_mechanism.return_value = None
+        with pytest.raises(NotImplementedError):
+            HCSocket("192.0.2.10", PSK64).wrap_socket_psk(Mock())
+
+
+@patch("builtins.print")
+@patch("HCSocket.tls_psk_mechanism", return_value="sslpsk")
+class TestSslpsk:
+    """sslpsk has no public API for a socket wrapped by our context or a memory BIO."""
+
+    def test_sets_psk_callback(self, mock_mechanism, mock_print, tls_cache):
+        fake = Mock()
+        sock = tls_socket(None)
+        context = Mock()
+        context.wrap_socket.return_value = sock
+        with (
+            patch.object(HCSocket_module, "sslpsk", fake, create=True),
+            patch.object(HCSocket, "create_tls_context", return_value=context),
+        ):
+            ws = HCSocket("192.0.2.10", PSK64)
+            assert ws.wrap_socket_psk(Mock()) is sock
+
+        set_callback = fake.sslpsk._ssl_set_psk_client_callback
+        set_callback.assert_called_once()
+        wrapped, callback = set_callback.call_args.args
+        assert wrapped is sock
+        assert callback(b"HCCOM_Local_App") == (ws.psk, b"")
+
+    def test_private_api_missing(self, mock_mechanism, mock_print, tls_cache):
+        fake = Mock()
+        fake.sslpsk = Mock(spec=[])
+        with (
+            patch.object(HCSocket_module, "sslpsk", fake, create=True),
+            patch.object(HCSocket, "create_tls_context", return_value=Mock()),
+        ):
+            with pytest.raises(NotImplementedError):
+                HCSocket("192.0.2.10", PSK64).wrap_socket_psk(Mock())
+
+    def test_installed_sslpsk_api(self, mock_mechanism, mock_print, tls_cache):
+        sslpsk = pytest.importorskip("sslpsk")
+        set_callback = sslpsk.sslpsk._ssl_set_psk_client_callback
+        assert len(inspect.signature(set_callback).parameters) == 2
+        assert callable(sslpsk.sslpsk._sslobj)
+
+
+@pytest.fixture
+def listener():
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    yield server
+    server.close()
+
+
+class TestConnect:
+    def test_connect_socket(self, listener):
+        sock = HCSocket("127.0.0.1", PSK64, IV64)
+        sock.port = listener.getsockname()[1]
+        threads = threading.active_count()
+        conn = sock.connect_socket(time.monotonic() + 5)
+        try:
+            assert conn.getpeername() == listener.getsockname()
+            assert conn.gettimeout() == SOCKET_TIMEOUT
+            assert set(sock.timings) == {"resolve", "connect"}
+            assert threading.active_count() == threads
+        finally:
+            conn.close()
+
+    def test_connection_refused(self, listener):
+        sock = HCSocket("127.0.0.1", PSK64, IV64)
+        sock.port = listener.getsockname()[1]
+        listener.close()
+        with pytest.raises(OSError):
+            sock.connect_socket(time.monotonic() + 5)
+
+    def test_staggered_skips_stalled_address(self, listener):
+        # 192.0.2.1 (TEST-NET-1) is never answered, the listener wins after the stagger delay
+        port = listener.getsockname()[1]
+        addresses = [address_info("192.0.2.1", port), address_info("127.0.0.1", port)]
+        start = time.monotonic()
+        conn, address = connect_staggered(addresses, start + 5, delay=0.05)
+        conn.close()
+        assert address == ("127.0.0.1", port)
+        assert time.monotonic() - start < 2
+
+    def test_staggered_timeout(self):
+        start = time.monotonic()
+        with pytest.raises(OSError):
+            connect_staggered([address_info("192.0.2.1", 9)], start + 0.2)
+        assert time.monotonic() - start < 2
+
+    def test_connect_remembers_address(self, listener):
+        sock = HCSocket("localhost", PSK64, IV64)
+        sock.resolver = Resolver()
+        sock.port = listener.getsockname()[1]
+        sock.connect_socket(time.monotonic() + 5).close()
+        assert sock.resolver.cached("localhost", sock.port)[0][4][0] == "127.0.0.1"
+
+    def test_connect_failure_keeps_address(self, listener):
+        sock = HCSocket("oven", PSK64, IV64)
+        sock.resolver = Resolver()
+        sock.resolver._last_good["oven"] = "127.0.0.1"
+        sock.port = listener.getsockname()[1]
+        listener.close()
+        with pytest.raises(OSError):
+            sock.connect_socket(time.monotonic() + 5)
+        # Tried again without a lookup, the appliance may just be switched off
+        assert sock.resolver.cached("oven", sock.port) == [address_info("127.0.0.1", sock.port)]
+
+    def test_tls_handshake_deadline(self, listener):
+        # The server accepts the connection but never answers the ClientHello
+        client = socket.create_connection(listener.getsockname())
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        tls = context.wrap_socket(client, do_handshake_on_connect=False)
+        start = time.monotonic()
+        try:
+            with pytest.raises(TimeoutError):
+                tls_handshake(tls, start + 0.2)
+            assert time.monotonic() - start < 2
+        finally:
+            tls.close()
+
+    @patch("builtins.print")
+    def test_run_forever_connect_failure(self, mock_print, listener):
+        sock = HCSocket("127.0.0.1", PSK64, IV64)
+        sock.port = listener.getsockname()[1]
+        listener.close()
+        with patch("HCSocket.websocket.WebSocketApp") as app:
+            sock.run_forever(Mock(), Mock(), Mock(), Mock())
+        app.assert_not_called()
+
+
+class TestKeepAliveDispatcher:
+    def make_dispatcher(self, keepalive):
+        app = Mock(keep_running=True)
+        return app, KeepAliveDispatcher(app, Mock(), keepalive)
+
+    def test_ping_then_timeout(self):
+        keepalive = KeepAlive(interval_max=0.05, timeout_max=0.05)
+        app, dispatcher = self.make_dispatcher(keepalive)
+        ours, theirs = socket.socketpair()
+        start = time.monotonic()
+        try:
+            with pytest.raises(websocket.WebSocketTimeoutException):
+                dispatcher.read(ours, Mock(return_value=True), Mock())
+        finally:
+            ours.close()
+            theirs.close()
+        app.sock.ping.assert_called_once_with(keepalive.ping_payload)
+        assert keepalive.missed == 1
+        assert time.monotonic() - start < 2
+
+    def test_reads_until_closed(self):
+        keepalive = KeepAlive()
+        app, dispatcher = self.make_dispatcher(keepalive)
+        ours, theirs = socket.socketpair()
+        theirs.sendall(b"ab")
+
+        def read_callback():
+            return ours.recv(1) == b"a"
+
+        try:
+            dispatcher.read(ours, read_callback, Mock())
+        finally:
+            ours.close()
+            theirs.close()
+        app.sock.ping.assert_not_called()
+
+    def test_delegates_to_wrapped_dispatcher(self):
+        app, dispatcher = self.make_dispatcher(KeepAlive())
+        dispatcher.send("sock", b"data")
+        dispatcher.dispatcher.send.assert_called_once_with("sock", b"data")
+
+
+class TestWebsocketClientAPI:
+    """KeepAliveApp relies on websocket-client internals, fail here if they change."""
+
+    def test_run_forever_reads_through_create_dispatcher(self):
+        source = inspect.getsource(websocket.WebSocketApp.run_forever)
+        assert "self.create_dispatcher(" in source
+        assert "dispatcher.read(self.sock.sock, read, check)" in source
+
+    def test_create_dispatcher_signature(self):
+        parameters = inspect.signature(websocket.WebSocketApp.create_dispatcher).parameters
+        assert list(parameters) == [
+            "self",
+            "ping_timeout",
+            "dispatcher",
+            "is_ssl",
+            "handleDisconnect",
+        ]
+
+    @pytest.mark.parametrize("is_ssl", [False, True])
+    def test_dispatcher_wrapped(self, is_ssl):
+        app = KeepAliveApp("ws://192.0.2.1/homeconnect", KeepAlive())
+        dispatcher = app.create_dispatcher(None, None, is_ssl, Mock())
+        assert isinstance(dispatcher, KeepAliveDispatcher)
+        parameters = inspect.signature(type(dispatcher.dispatcher).read).parameters
+        assert list(parameters) == ["self", "sock", "read_callback", "check_callback"]
@@ -0,0 +1,89 @@
+from HCState import DeviceState
+
+
+class TestDeviceState:
+    def test_update_records_change(self):
+        state = DeviceState()
+        assert state.update("BSH.Common.Status.DoorState", "Closed") is True
+        assert state["BSH.Common.Status.DoorState"] == "Closed"
+        assert state.version == 1
+        assert state.seq("BSH.Common.Status.DoorState") == 1
+
+    def test_seq_of_seeded_and_unknown_keys(self):
+        state = DeviceState()
+        state.seed("BSH.Common.Setting.PowerState", "On")
+        assert state.seq("BSH.Common.Setting.PowerState") == 0
+        assert state.seq("BSH.Common.Status.DoorState") == 0
+
+    def test_same_value_not_a_change(self):
+        state = DeviceState()
+        state.update("BSH.Common.Status.DoorState", "Closed")
+        assert state.update("BSH.Common.Status.DoorState", "Closed") is False
+        assert state.version == 1
+
+    def test_dict_values_compared_by_content(self):
+        state = DeviceState()
+        state.update("ipV4", {"ipAddress": "198.51.100.50"})
+        assert state.update("ipV4", {"ipAddress": "198.51.100.50"}) is False
+        assert state.update("ipV4", {"ipAddress": "198.51.100.99"}) is True
+
+    def test_seeded_value_not_dirty(self):
+        state = DeviceState()
+        state.seed("BSH.Common.Setting.PowerState", "On")
+        assert state["BSH.Common.Setting.PowerState"] == "On"
+        assert state.dirty == set()
+        assert state.changes_since(0) == {}
+
+    def test_first_report_of_seeded_value_is_a_change(self):
+        state = DeviceState()
+        state.seed("BSH.Common.Setting.PowerState", "On")
+        assert state.update("BSH.Common.Setting.PowerState", "On") is True
+        assert state.dirty == {"BSH.Common.Setting.PowerState"}
+
+    def test_changes_since(self):
+        state = DeviceState()
+        state.update("a", 1)
+        state.update("b", 2)
+        version = state.version
+        state.update("c", 3)
+        state.update("a", 4)
+
+        assert state.changes_since(version) == {"c": 3, "a": 4}
+        assert list(state.changes_since(version)) == ["c", "a"]
+        assert state.changes_since(state.version) == {}
+        assert state.changes_since(0) == {"b": 2, "c": 3, "a": 4}
+
+    def test_take_dirty(self):
+        state = DeviceState()
+        state.update("a", 1)
+        state.update("b", 2)
+        state.update("a", 3)
+
+        assert state.take_dirty() == {"a": 3, "b": 2}
+        assert state.take_dirty() == {}
+        assert state.dirty == set()
+
+    def test_mapping(self):
+        state = DeviceState()
+        state.seed("a", 1)
+        state.update("b", 2)
+        assert dict(state) == {"a": 1, "b": 2}
+        assert len(state) == 2
+        assert "a" in state
+        assert state.get("c") is None
+
+    def test_snapshot(self):
+        state = DeviceState()
+        state.seed("a", 1)
+        state.update("b", 2)
+        snapshot = state.snapshot()
+        state.update("b", 3)
+        assert snapshot == {"a": 1, "b": 2}
+
+    def test_mark_dirty(self):
+        state = DeviceState()
+        state.update("a", 1)
+        state.take_dirty()
+        state.mark_dirty("a")
+        state.mark_dirty("b")
+        assert state.take_dirty() == {"a": 1}
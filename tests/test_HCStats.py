@@ -0,0 +1,30 @@
+from HCStats import FrameStats, TimingStats
+
+
+class TestFrameStats:
+    def test_counts(self):
+        stats = FrameStats()
+        stats.received(100)
+        stats.received(20)
+        stats.sent(64)
+        summary = stats.summary()
+        assert summary["frames_in"] == 2
+        assert summary["bytes_in"] == 120
+        assert summary["frames_out"] == 1
+        assert summary["bytes_out"] == 64
+
+
+class TestTimingStats:
+    def test_record(self):
+        stats = TimingStats()
+        stats.record("/ro/values", 0.001)
+        stats.record("/ro/values", 0.003)
+        stats.record("/ci/info", 0.0005)
+        summary = stats.summary()
+        assert summary["/ro/values"] == {
+            "count": 2,
+            "total_ms": 4.0,
+            "mean_us": 2000.0,
+            "max_us": 3000.0,
+        }
+        assert summary["/ci/info"]["count"] == 1
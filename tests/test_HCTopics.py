@@ -0,0 +1,33 @@
+from HCTopics import DeviceTopics, topics_for
+
+
+class TestDeviceTopics:
+    def test_topics(self):
+        topics = DeviceTopics("homeconnect/Bäckofen", "Bäckofen")
+        assert topics.ident == "Backofen"
+        assert topics.lwt == "homeconnect/Bäckofen/LWT"
+        assert topics.set == "homeconnect/Bäckofen/set"
+        assert topics.feature_id("BSH.Common.Status.DoorState") == "bsh_common_status_doorstate"
+        assert (
+            topics.state("BSH.Common.Status.DoorState")
+            == "homeconnect/Bäckofen/state/bsh_common_status_doorstate"
+        )
+        assert (
+            topics.event("BSH.Common.Event.ProgramFinished")
+            == "homeconnect/Bäckofen/event/bsh_common_event_programfinished"
+        )
+        assert (
+            topics.discovery("homeassistant", "sensor", "BSH.Common.Status.DoorState")
+            == "homeassistant/sensor/hcpy/Backofen_bsh_common_status_doorstate/config"
+        )
+
+    def test_topics_are_cached(self):
+        topics = DeviceTopics("homeconnect/Oven", "Oven")
+        key = "BSH.Common.Status.DoorState"
+        assert topics.state(key) is topics.state("".join(key))
+        assert topics.event(key) is topics.event(key)
+        assert topics.discovery("ha", "sensor", key) is topics.discovery("ha", "sensor", key)
+
+    def test_shared_per_device(self):
+        assert topics_for("homeconnect/Oven", "Oven") is topics_for("homeconnect/Oven", "Oven")
+        assert topics_for("homeconnect/Oven", "Oven") is not topics_for("other/Oven", "Oven")
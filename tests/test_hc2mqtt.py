@@ -1,15 +1,50 @@
+import asyncio
 import json
+import threading
 from unittest.mock import Mock, patch
 
+import paho.mqtt.client as mqtt
 import pytest
 
-from hc2mqtt import client_connect, handle_device_message
-
-
-def make_device(state=None):
-    """Build a mock device with a .state dict."""
+from hc2mqtt import (
+    FLUSH_RETRY,
+    client_connect,
+    close_recorders,
+    command_topics,
+    dev,
+    device_callbacks,
+    handle_device_message,
+    open_recorder,
+    publish_pending,
+    publish_stats,
+    run_in_executor,
+)
+from HCFeature import load_features
+from HCOutbox import RateLimits, outbox_for
+from HCState import DeviceState
+from HCTopics import topics_for
+
+
+@pytest.fixture(autouse=True)
+def empty_outboxes():
+    """Outboxes are kept per MQTT topic for the whole process, start each test without any."""
+    with patch.dict("HCOutbox._outboxes", clear=True):
+        yield
+
+
+def make_device(state=None, published=None):
+    """Build a mock device with a .state store.
+
+    state holds values seeded from devices.json that have not been published,
+    published holds values that the device reported and were already published.
+    """
     device = Mock()
-    device.state = state if state is not None else {}
+    device.state = DeviceState()
+    for key, value in (state or {}).items():
+        device.state.seed(key, value)
+    for key, value in (published or {}).items():
+        device.state.update(key, value)
+    device.state.take_dirty()
     return device
 
 
@@ -34,27 +69,24 @@ class TestNoop:
     def test_none_message(self, _hcprint):
         client = make_client()
         device = make_device()
-        ps = {}
-        handle_device_message(None, device, ps, client, TOPIC, NAME)
+        handle_device_message(None, device, client, TOPIC, NAME)
         client.publish.assert_not_called()
-        assert ps == {}
+        assert device.state.version == 0
 
     def test_empty_message(self, _hcprint):
         client = make_client()
         device = make_device()
-        ps = {}
-        handle_device_message({}, device, ps, client, TOPIC, NAME)
+        handle_device_message({}, device, client, TOPIC, NAME)
         client.publish.assert_not_called()
-        assert ps == {}
+        assert device.state.version == 0
 
     def test_all_values_unchanged(self, _hcprint):
-        """When every key in the message matches published_state, nothing publishes."""
+        """When every key in the message matches the published state, nothing publishes."""
         client = make_client()
-        device = make_device({"BSH.Common.Status.DoorState": "Closed"})
-        ps = {"BSH.Common.Status.DoorState": "Closed"}
+        device = make_device(published={"BSH.Common.Status.DoorState": "Closed"})
 
         handle_device_message(
-            {"BSH.Common.Status.DoorState": "Closed"}, device, ps, client, TOPIC, NAME
+            {"BSH.Common.Status.DoorState": "Closed"}, device, client, TOPIC, NAME
         )
         client.publish.assert_not_called()
 
@@ -64,14 +96,13 @@ class TestFirstPublish:
     def test_all_keys_published_when_published_state_empty(self, _hcprint):
         client = make_client()
         device = make_device()
-        ps = {}
 
         msg = {
             "BSH.Common.Status.DoorState": "Closed",
             "BSH.Common.Setting.PowerState": "On",
             "BSH.Common.Status.OperationState": "Ready",
         }
-        handle_device_message(msg, device, ps, client, TOPIC, NAME)
+        handle_device_message(msg, device, client, TOPIC, NAME)
 
         assert client.publish.call_count == 3
         payloads = published_payloads(client)
@@ -85,24 +116,19 @@ class TestDiffPublish:
     def test_only_changed_key_published(self, _hcprint):
         client = make_client()
         device = make_device(
-            {
+            published={
                 "BSH.Common.Status.DoorState": "Closed",
                 "BSH.Common.Setting.PowerState": "On",
                 "BSH.Common.Status.OperationState": "Ready",
             }
         )
-        ps = {
-            "BSH.Common.Status.DoorState": "Closed",
-            "BSH.Common.Setting.PowerState": "On",
-            "BSH.Common.Status.OperationState": "Ready",
-        }
 
         msg = {
             "BSH.Common.Status.DoorState": "Open",
             "BSH.Common.Setting.PowerState": "On",
             "BSH.Common.Status.OperationState": "Ready",
         }
-        handle_device_message(msg, device, ps, client, TOPIC, NAME)
+        handle_device_message(msg, device, client, TOPIC, NAME)
 
         assert client.publish.call_count == 1
         payloads = published_payloads(client)
@@ -115,31 +141,25 @@ class TestNoneValues:
         """A new key with None value is not stored or published."""
         client = make_client()
         device = make_device()
-        ps = {}
 
-        handle_device_message(
-            {"BSH.Common.Status.DoorState": None}, device, ps, client, TOPIC, NAME
-        )
+        handle_device_message({"BSH.Common.Status.DoorState": None}, device, client, TOPIC, NAME)
 
         client.publish.assert_not_called()
         assert "BSH.Common.Status.DoorState" not in device.state
-        assert "BSH.Common.Status.DoorState" not in ps
+        assert device.state.dirty == set()
 
     def test_none_for_existing_key_published(self, _hcprint):
         """An existing key set to None is a real change and gets published."""
         client = make_client()
-        device = make_device({"BSH.Common.Status.DoorState": "Closed"})
-        ps = {"BSH.Common.Status.DoorState": "Closed"}
+        device = make_device(published={"BSH.Common.Status.DoorState": "Closed"})
 
-        handle_device_message(
-            {"BSH.Common.Status.DoorState": None}, device, ps, client, TOPIC, NAME
-        )
+        handle_device_message({"BSH.Common.Status.DoorState": None}, device, client, TOPIC, NAME)
 
         assert client.publish.call_count == 1
         payloads = published_payloads(client)
         assert payloads[f"{TOPIC}/state/bsh_common_status_doorstate"] == "None"
-        assert ps["BSH.Common.Status.DoorState"] is None
         assert device.state["BSH.Common.Status.DoorState"] is None
+        assert device.state.dirty == set()
 
 
 @patch("hc2mqtt.hcprint")
@@ -147,10 +167,9 @@ class TestEvents:
     def test_event_published_to_event_topic(self, _hcprint):
         client = make_client()
         device = make_device()
-        ps = {}
 
         msg = {"BSH.Common.Event.ProgramFinished": "Program Finished"}
-        handle_device_message(msg, device, ps, client, TOPIC, NAME)
+        handle_device_message(msg, device, client, TOPIC, NAME)
 
         assert client.publish.call_count == 1
         topic, payload = client.publish.call_args.args[0], client.publish.call_args.args[1]
@@ -160,23 +179,21 @@ class TestEvents:
     def test_event_not_stored_in_state(self, _hcprint):
         client = make_client()
         device = make_device()
-        ps = {}
 
         msg = {"BSH.Common.Event.ProgramFinished": "Program Finished"}
-        handle_device_message(msg, device, ps, client, TOPIC, NAME)
+        handle_device_message(msg, device, client, TOPIC, NAME)
 
         assert "BSH.Common.Event.ProgramFinished" not in device.state
-        assert "BSH.Common.Event.ProgramFinished" not in ps
+        assert device.state.dirty == set()
 
-    def test_event_not_stored_in_published_state(self, _hcprint):
+    def test_event_not_diffed(self, _hcprint):
         """Events bypass the diff mechanism entirely."""
         client = make_client()
         device = make_device()
-        ps = {}
 
         msg = {"BSH.Common.Event.ProgramFinished": "Done"}
-        handle_device_message(msg, device, ps, client, TOPIC, NAME)
-        handle_device_message(msg, device, ps, client, TOPIC, NAME)
+        handle_device_message(msg, device, client, TOPIC, NAME)
+        handle_device_message(msg, device, client, TOPIC, NAME)
 
         # Event published both times since it's not diffed.
         event_calls = [c for c in client.publish.call_args_list if "event/" in c.args[0]]
@@ -185,13 +202,12 @@ class TestEvents:
     def test_mixed_events_and_state(self, _hcprint):
         client = make_client()
         device = make_device()
-        ps = {}
 
         msg = {
             "BSH.Common.Status.DoorState": "Closed",
             "BSH.Common.Event.ProgramFinished": "Done",
         }
-        handle_device_message(msg, device, ps, client, TOPIC, NAME)
+        handle_device_message(msg, device, client, TOPIC, NAME)
 
         payloads = published_payloads(client)
         assert f"{TOPIC}/state/bsh_common_status_doorstate" in payloads
@@ -212,7 +228,7 @@ class TestClientConnectDiscovery:
     def _make_device(self, messages):
         """Create an HCDevice mock that delivers messages via run_forever."""
         dev = Mock()
-        dev.state = {}
+        dev.state = DeviceState()
 
         def run_forever(on_message, on_open, on_close):
             for msg in messages:
@@ -342,36 +358,96 @@ class TestClientConnectDiscovery:
 
         assert mock_discovery.call_count == 2
 
+    @patch.dict("hc2mqtt.dev", clear=True)
+    def test_reconnect_keeps_features(self, _print, mock_discovery, MockDevice, MockSocket, _time):
+        first = self._make_device([])
+        first.features = load_features({"8200": {"name": "Dishcare.Dishwasher.Program.Quick45"}})
+        MockDevice.side_effect = [first, self._make_device([])]
+        MockSocket.side_effect = [Mock(), Mock(), SystemExit]
+
+        with pytest.raises(SystemExit):
+            client_connect(make_client(), self.DEVICE, TOPIC, "", False)
+
+        assert MockDevice.call_args_list[0].args[1] is self.DEVICE
+        # The descriptionChange updates of the first connection carry over
+        assert MockDevice.call_args_list[1].args[1] == {**self.DEVICE, "features": first.features}
+
+
+@patch("hc2mqtt.publish_ha_discovery")
+@patch("hc2mqtt.hcprint")
+class TestDiscoveryOffLoop:
+    def test_run_blocking(self, _print, mock_discovery):
+        device = make_device()
+        device.features = load_features({"8200": {"name": "Dishcare.Dishwasher.Program.Quick45"}})
+        run_blocking = Mock()
+        on_message, _, _ = device_callbacks(
+            device,
+            make_client(),
+            {"name": NAME},
+            TOPIC,
+            False,
+            True,
+            "d",
+            False,
+            run_blocking=run_blocking,
+        )
+        on_message({"mac": "AA-BB-CC-DD-EE-FF"})
+
+        mock_discovery.assert_not_called()
+        run_blocking.assert_called_once()
+        # With the features of the connection, not those devices.json was loaded with
+        assert run_blocking.call_args.args[:3] == (
+            mock_discovery,
+            "d",
+            {"name": NAME, "features": device.features},
+        )
+
+    def test_run_in_executor(self, _print, mock_discovery):
+        async def scenario():
+            loop = asyncio.get_running_loop()
+            caller = threading.current_thread()
+            threads = []
+            done = loop.create_future()
+
+            def blocking(value):
+                threads.append(threading.current_thread())
+                loop.call_soon_threadsafe(done.set_result, value)
+
+            run_in_executor(blocking, 1)
+            assert await asyncio.wait_for(done, 5) == 1
+            return caller, threads
+
+        caller, threads = asyncio.run(scenario())
+        assert threads and threads[0] is not caller
+
 
 @patch("hc2mqtt.hcprint")
 class TestReconnectSync:
-    """When the WebSocket drops and reconnects, published_state.clear() runs
-    in the while True loop. Everything must republish even if values haven't
-    changed, because the broker may have lost retained messages or HA may have
-    restarted."""
+    """When the WebSocket drops and reconnects, the while True loop creates a new
+    HCDevice with an empty state store. Everything must republish even if values
+    haven't changed, because the broker may have lost retained messages or HA may
+    have restarted."""
 
-    def test_clear_forces_full_republish(self, _hcprint):
-        """Simulates the reconnect lifecycle: publish -> clear -> same values
+    def test_new_device_forces_full_republish(self, _hcprint):
+        """Simulates the reconnect lifecycle: publish -> new device -> same values
         arrive -> all keys republish."""
         client = make_client()
         device = make_device()
-        ps = {}
 
         state = {
             "BSH.Common.Status.DoorState": "Closed",
             "BSH.Common.Setting.PowerState": "On",
             "BSH.Common.Status.OperationState": "Ready",
         }
-        handle_device_message(state, device, ps, client, TOPIC, NAME)
+        handle_device_message(state, device, client, TOPIC, NAME)
         assert client.publish.call_count == 3
         client.reset_mock()
 
-        # WebSocket drops, while loop creates new HCDevice and clears published_state.
-        ps.clear()
-        device.state.clear()
+        # WebSocket drops, while loop creates new HCDevice with a new state store.
+        device = make_device()
 
         # Same values arrive from /ro/allMandatoryValues on the new connection.
-        handle_device_message(state, device, ps, client, TOPIC, NAME)
+        handle_device_message(state, device, client, TOPIC, NAME)
         assert client.publish.call_count == 3
 
 
@@ -383,7 +459,6 @@ class TestPayloadFormat:
     def test_bool_published_as_string(self, _hcprint):
         client = make_client()
         device = make_device()
-        ps = {}
 
         handle_device_message(
             {
@@ -391,7 +466,6 @@ class TestPayloadFormat:
                 "BSH.Common.Setting.RemoteStart": False,
             },
             device,
-            ps,
             client,
             TOPIC,
             NAME,
@@ -404,10 +478,9 @@ class TestPayloadFormat:
     def test_integer_published_as_string(self, _hcprint):
         client = make_client()
         device = make_device()
-        ps = {}
 
         handle_device_message(
-            {"BSH.Common.Option.RemainingTime": 180}, device, ps, client, TOPIC, NAME
+            {"BSH.Common.Option.RemainingTime": 180}, device, client, TOPIC, NAME
         )
 
         payload = client.publish.call_args.args[1]
@@ -416,12 +489,10 @@ class TestPayloadFormat:
     def test_dict_published_as_json(self, _hcprint):
         client = make_client()
         device = make_device()
-        ps = {}
 
         handle_device_message(
             {"ipV4": {"ipAddress": "198.51.100.50"}},
             device,
-            ps,
             client,
             TOPIC,
             NAME,
@@ -439,24 +510,22 @@ class TestDictComparison:
     def test_same_dict_not_republished(self, _hcprint):
         client = make_client()
         device = make_device()
-        ps = {}
 
         msg = {"ipV4": {"ipAddress": "198.51.100.50"}}
-        handle_device_message(msg, device, ps, client, TOPIC, NAME)
+        handle_device_message(msg, device, client, TOPIC, NAME)
         client.reset_mock()
 
         # Same dict content, different object.
         msg2 = {"ipV4": {"ipAddress": "198.51.100.50"}}
-        handle_device_message(msg2, device, ps, client, TOPIC, NAME)
+        handle_device_message(msg2, device, client, TOPIC, NAME)
         client.publish.assert_not_called()
 
     def test_changed_nested_value_republished(self, _hcprint):
         client = make_client()
-        device = make_device({"ipV4": {"ipAddress": "198.51.100.50"}})
-        ps = {"ipV4": {"ipAddress": "198.51.100.50"}}
+        device = make_device(published={"ipV4": {"ipAddress": "198.51.100.50"}})
 
         handle_device_message(
-            {"ipV4": {"ipAddress": "198.51.100.99"}}, device, ps, client, TOPIC, NAME
+            {"ipV4": {"ipAddress": "198.51.100.99"}}, device, client, TOPIC, NAME
         )
 
         assert client.publish.call_count == 1
@@ -467,45 +536,42 @@ class TestMqttDisconnected:
     def test_state_updated_when_disconnected(self, _hcprint):
         client = make_client(connected=False)
         device = make_device()
-        ps = {}
 
         handle_device_message(
-            {"BSH.Common.Status.DoorState": "Closed"}, device, ps, client, TOPIC, NAME
+            {"BSH.Common.Status.DoorState": "Closed"}, device, client, TOPIC, NAME
         )
 
         assert device.state["BSH.Common.Status.DoorState"] == "Closed"
 
-    def test_published_state_not_updated_when_disconnected(self, _hcprint):
+    def test_change_stays_dirty_when_disconnected(self, _hcprint):
         client = make_client(connected=False)
         device = make_device()
-        ps = {}
 
         handle_device_message(
-            {"BSH.Common.Status.DoorState": "Closed"}, device, ps, client, TOPIC, NAME
+            {"BSH.Common.Status.DoorState": "Closed"}, device, client, TOPIC, NAME
         )
 
-        assert "BSH.Common.Status.DoorState" not in ps
+        assert device.state.dirty == {"BSH.Common.Status.DoorState"}
         client.publish.assert_not_called()
 
     def test_stale_value_published_after_reconnect(self, _hcprint):
         """If the value didn't change between disconnect and reconnect,
-        it still gets published because published_state never recorded it."""
+        it still gets published because it was never taken from the dirty set."""
         client = make_client(connected=False)
         device = make_device()
-        ps = {}
 
         handle_device_message(
-            {"BSH.Common.Status.DoorState": "Closed"}, device, ps, client, TOPIC, NAME
+            {"BSH.Common.Status.DoorState": "Closed"}, device, client, TOPIC, NAME
         )
 
         client.is_connected.return_value = True
-        # Same value, but published_state doesn't have it.
+        # Same value, but it is still dirty.
         handle_device_message(
-            {"BSH.Common.Status.DoorState": "Closed"}, device, ps, client, TOPIC, NAME
+            {"BSH.Common.Status.DoorState": "Closed"}, device, client, TOPIC, NAME
         )
 
         assert client.publish.call_count == 1
-        assert ps["BSH.Common.Status.DoorState"] == "Closed"
+        assert device.state.dirty == set()
 
 
 @patch("hc2mqtt.hcprint")
@@ -513,10 +579,9 @@ class TestRetainFlag:
     def test_state_published_with_retain(self, _hcprint):
         client = make_client()
         device = make_device()
-        ps = {}
 
         handle_device_message(
-            {"BSH.Common.Status.DoorState": "Closed"}, device, ps, client, TOPIC, NAME
+            {"BSH.Common.Status.DoorState": "Closed"}, device, client, TOPIC, NAME
         )
 
         call_kwargs = client.publish.call_args_list[0]
@@ -527,10 +592,9 @@ class TestRetainFlag:
     def test_event_published_with_retain(self, _hcprint):
         client = make_client()
         device = make_device()
-        ps = {}
 
         handle_device_message(
-            {"BSH.Common.Event.ProgramFinished": "Done"}, device, ps, client, TOPIC, NAME
+            {"BSH.Common.Event.ProgramFinished": "Done"}, device, client, TOPIC, NAME
         )
 
         call_kwargs = client.publish.call_args_list[0]
@@ -544,10 +608,9 @@ class TestTopicFormatting:
     def test_dots_replaced_with_underscores(self, _hcprint):
         client = make_client()
         device = make_device()
-        ps = {}
 
         handle_device_message(
-            {"BSH.Common.Status.DoorState": "Closed"}, device, ps, client, TOPIC, NAME
+            {"BSH.Common.Status.DoorState": "Closed"}, device, client, TOPIC, NAME
         )
 
         topic = client.publish.call_args_list[0].args[0]
@@ -555,24 +618,341 @@ class TestTopicFormatting:
 
 
 @patch("hc2mqtt.hcprint")
-class TestSentinel:
-    def test_sentinel_distinguishes_never_published_from_none(self, _hcprint):
+class TestSeededState:
+    def test_seeded_key_distinguishes_never_published_from_none(self, _hcprint):
         """A key published as None should not re-publish when it arrives as None again.
         But a key never published should publish even if the value is None (for existing keys)."""
         client = make_client()
         device = make_device({"BSH.Common.Status.DoorState": "Closed"})
-        ps = {}
 
         # First time: None for existing key. Never published, so it's new.
-        handle_device_message(
-            {"BSH.Common.Status.DoorState": None}, device, ps, client, TOPIC, NAME
-        )
+        handle_device_message({"BSH.Common.Status.DoorState": None}, device, client, TOPIC, NAME)
         assert client.publish.call_count == 1
-        assert ps["BSH.Common.Status.DoorState"] is None
+        assert device.state["BSH.Common.Status.DoorState"] is None
         client.reset_mock()
 
         # Second time: None again. Already published as None, skip.
+        handle_device_message({"BSH.Common.Status.DoorState": None}, device, client, TOPIC, NAME)
+        client.publish.assert_not_called()
+
+
+class TestPublishStats:
+    def test_publishes_per_device(self):
+        client = make_client()
+        device = Mock()
+        device.stats.return_value = {"connected": True, "socket": {"frames_in": 12}}
+        with patch.dict(dev, {"TestOven": device}, clear=True):
+            publish_stats(client, "homeconnect/")
+        assert json.loads(published_payloads(client)["homeconnect/TestOven/stats"]) == {
+            "connected": True,
+            "socket": {"frames_in": 12},
+            "outbox": {
+                "pending": 0,
+                "deferred": 0,
+                "superseded": 0,
+                "dropped": 0,
+                "rate_limited": 0,
+            },
+        }
+
+
+@patch("hc2mqtt.hcprint")
+class TestStateDocument:
+    def test_document_published_once_per_message(self, _hcprint):
+        client = make_client()
+        device = make_device(state={"BSH.Common.Setting.PowerState": "Off"})
+
+        msg = {
+            "BSH.Common.Status.DoorState": "Closed",
+            "BSH.Common.Status.OperationState": "Ready",
+            "BSH.Common.Event.ProgramFinished": "Present",
+        }
+        handle_device_message(
+            msg, device, client, TOPIC, NAME, state_document=True, state_per_key=False
+        )
+
+        payloads = published_payloads(client)
+        assert set(payloads) == {
+            f"{TOPIC}/event/bsh_common_event_programfinished",
+            f"{TOPIC}/state",
+        }
+        assert json.loads(payloads[f"{TOPIC}/state"]) == {
+            "BSH.Common.Setting.PowerState": "Off",
+            "BSH.Common.Status.DoorState": "Closed",
+            "BSH.Common.Status.OperationState": "Ready",
+        }
+
+    def test_document_and_per_key(self, _hcprint):
+        client = make_client()
+        device = make_device(published={"BSH.Common.Status.DoorState": "Closed"})
+
         handle_device_message(
-            {"BSH.Common.Status.DoorState": None}, device, ps, client, TOPIC, NAME
+            {"BSH.Common.Status.DoorState": "Open"},
+            device,
+            client,
+            TOPIC,
+            NAME,
+            state_document=True,
+        )
+
+        payloads = published_payloads(client)
+        assert payloads[f"{TOPIC}/state/bsh_common_status_doorstate"] == "Open"
+        assert json.loads(payloads[f"{TOPIC}/state"]) == {"BSH.Common.Status.DoorState": "Open"}
+
+    def test_no_document_when_unchanged(self, _hcprint):
+        client = make_client()
+        device = make_device(published={"BSH.Common.Status.DoorState": "Closed"})
+
+        handle_device_message(
+            {"BSH.Common.Status.DoorState": "Closed"},
+            device,
+            client,
+            TOPIC,
+            NAME,
+            state_document=True,
+        )
+
+        client.publish.assert_not_called()
+
+
+class TestCommandTopics:
+    @pytest.fixture(autouse=True)
+    def no_devices(self):
+        with patch.dict("hc2mqtt.dev", clear=True):
+            yield
+
+    def test_dispatch_table(self):
+        devices = [
+            {
+                "name": "Oven",
+                "features": load_features(
+                    {
+                        "256": {"name": "BSH.Common.Root.SelectedProgram"},
+                        "257": {"name": "BSH.Common.Root.ActiveProgram"},
+                        "539": {"name": "BSH.Common.Setting.PowerState"},
+                    }
+                ),
+            },
+            {"name": "Kühlschrank", "features": load_features({})},
+        ]
+        device_topics = {
+            "Oven": topics_for("homeconnect/Oven", "Oven"),
+            "Kühlschrank": topics_for("homeconnect/Kuhlschrank", "Kühlschrank"),
+        }
+
+        assert command_topics(devices, device_topics) == {
+            "homeconnect/Oven/set": ("Oven", "/ro/values"),
+            "homeconnect/Oven/activeProgram": ("Oven", "/ro/activeProgram"),
+            "homeconnect/Oven/selectedProgram": ("Oven", "/ro/selectedProgram"),
+            "homeconnect/Kuhlschrank/set": ("Kuhlschrank", "/ro/values"),
+        }
+
+    def test_features_of_connected_device(self):
+        devices = [{"name": "Oven", "features": load_features({})}]
+        device_topics = {"Oven": topics_for("homeconnect/Oven", "Oven")}
+        # Added by /ro/descriptionChange after devices.json was loaded
+        mydevice = make_device()
+        mydevice.features = load_features({"256": {"name": "BSH.Common.Root.SelectedProgram"}})
+        dev["Oven"] = mydevice
+
+        assert command_topics(devices, device_topics) == {
+            "homeconnect/Oven/set": ("Oven", "/ro/values"),
+            "homeconnect/Oven/selectedProgram": ("Oven", "/ro/selectedProgram"),
+        }
+
+
+@patch("hc2mqtt.hcprint")
+class TestOutbox:
+    def test_flushed_on_reconnect(self, _hcprint):
+        client = make_client(connected=False)
+        device = make_device()
+
+        handle_device_message(
+            {"BSH.Common.Status.DoorState": "Open", "BSH.Common.Event.ProgramFinished": "Present"},
+            device,
+            client,
+            TOPIC,
+            NAME,
+        )
+        handle_device_message(
+            {"BSH.Common.Status.DoorState": "Closed", "BSH.Common.Event.ProgramFinished": "Off"},
+            device,
+            client,
+            TOPIC,
+            NAME,
         )
         client.publish.assert_not_called()
+
+        client.is_connected.return_value = True
+        publish_pending(device, client, TOPIC, NAME)
+
+        assert published_payloads(client) == {
+            f"{TOPIC}/event/bsh_common_event_programfinished": '{"event_type": "Off"}',
+            f"{TOPIC}/state/bsh_common_status_doorstate": "Closed",
+        }
+        assert outbox_for(TOPIC).stats() == {
+            "pending": 0,
+            "deferred": 4,
+            "superseded": 1,
+            "dropped": 0,
+            "rate_limited": 0,
+        }
+
+    def test_kept_when_publish_fails(self, _hcprint):
+        client = make_client()
+        client.publish.return_value.rc = mqtt.MQTT_ERR_NO_CONN
+        device = make_device()
+
+        handle_device_message(
+            {"BSH.Common.Status.DoorState": "Open", "BSH.Common.Event.ProgramFinished": "Present"},
+            device,
+            client,
+            TOPIC,
+            NAME,
+            state_document=True,
+        )
+
+        assert device.state.dirty == {"BSH.Common.Status.DoorState"}
+        assert len(outbox_for(TOPIC)) == 1
+
+        client.reset_mock()
+        client.publish.return_value.rc = mqtt.MQTT_ERR_SUCCESS
+        publish_pending(device, client, TOPIC, NAME)
+        assert client.publish.call_count == 2
+        assert device.state.dirty == set()
+        assert len(outbox_for(TOPIC)) == 0
+
+
+@patch("hc2mqtt.hcprint")
+class TestRateLimits:
+    def make(self):
+        client = make_client()
+        device = make_device()
+        timers = []
+        device.call_later.side_effect = lambda delay, func: timers.append((delay, func))
+        outbox_for(TOPIC).rate_limits = RateLimits({"BSH.Common.Option.ProgramProgress": 30})
+        return client, device, timers
+
+    @pytest.fixture(autouse=True)
+    def connected_device(self):
+        with patch.dict("hc2mqtt.dev", clear=True):
+            yield
+
+    def test_trailing_value_published(self, _hcprint):
+        client, device, timers = self.make()
+        dev[topics_for(TOPIC, NAME).ident] = device
+
+        for progress in (10, 11, 12):
+            handle_device_message(
+                {"BSH.Common.Option.ProgramProgress": progress}, device, client, TOPIC, NAME
+            )
+
+        assert [c.args[1] for c in client.publish.call_args_list] == ["10"]
+        assert len(timers) == 1
+        assert 29 < timers[0][0] <= 30
+
+        # The interval has passed when the timer fires
+        outbox_for(TOPIC).last_published["BSH.Common.Option.ProgramProgress"] -= 30
+        timers[0][1]()
+        assert [c.args[1] for c in client.publish.call_args_list] == ["10", "12"]
+        assert device.state.dirty == set()
+        assert outbox_for(TOPIC).flush_due is None
+
+    def test_flush_retried_while_disconnected(self, _hcprint):
+        client, device, timers = self.make()
+        for progress in (10, 11):
+            handle_device_message(
+                {"BSH.Common.Option.ProgramProgress": progress}, device, client, TOPIC, NAME
+            )
+        client.is_connected.return_value = False
+        outbox_for(TOPIC).last_published["BSH.Common.Option.ProgramProgress"] -= 30
+        timers[0][1]()
+
+        assert len(timers) == 2
+        assert timers[1][0] == FLUSH_RETRY
+        assert outbox_for(TOPIC).flush_due is not None
+
+        client.is_connected.return_value = True
+        timers[1][1]()
+        assert [c.args[1] for c in client.publish.call_args_list] == ["10", "11"]
+        assert outbox_for(TOPIC).flush_due is None
+
+    def test_flush_failure_rescheduled(self, _hcprint):
+        client, device, timers = self.make()
+        for progress in (10, 11):
+            handle_device_message(
+                {"BSH.Common.Option.ProgramProgress": progress}, device, client, TOPIC, NAME
+            )
+        client.is_connected.side_effect = RuntimeError("broken")
+        with pytest.raises(RuntimeError):
+            timers[0][1]()
+        assert len(timers) == 2
+
+    def test_lost_flush_replaced(self, _hcprint):
+        client, device, timers = self.make()
+        for progress in (10, 11):
+            handle_device_message(
+                {"BSH.Common.Option.ProgramProgress": progress}, device, client, TOPIC, NAME
+            )
+        # The timer never fires, e.g. its event loop is gone
+        outbox_for(TOPIC).flush_due -= 60
+        outbox_for(TOPIC).last_published["BSH.Common.Option.ProgramProgress"] -= 15
+        handle_device_message(
+            {"BSH.Common.Option.ProgramProgress": 12}, device, client, TOPIC, NAME
+        )
+        assert len(timers) == 2
+
+    def test_scheduling_failure_clears_flush(self, _hcprint):
+        client, device, timers = self.make()
+        device.call_later.side_effect = RuntimeError("Event loop is closed")
+        with patch("builtins.print"):
+            for progress in (10, 11):
+                handle_device_message(
+                    {"BSH.Common.Option.ProgramProgress": progress}, device, client, TOPIC, NAME
+                )
+        assert outbox_for(TOPIC).flush_due is None
+
+    def test_held_back_counted_once(self, _hcprint):
+        client, device, timers = self.make()
+        for progress in (10, 11):
+            handle_device_message(
+                {"BSH.Common.Option.ProgramProgress": progress}, device, client, TOPIC, NAME
+            )
+        for _ in range(10):
+            handle_device_message(
+                {"BSH.Common.Status.DoorState": "Closed"}, device, client, TOPIC, NAME
+            )
+            # Nothing new to publish
+            handle_device_message(
+                {"BSH.Common.Status.DoorState": "Closed"}, device, client, TOPIC, NAME
+            )
+        assert outbox_for(TOPIC).rate_limited == 1
+        assert device.state.dirty == {"BSH.Common.Option.ProgramProgress"}
+
+    def test_not_published_not_limited(self, _hcprint):
+        client, device, timers = self.make()
+        client.is_connected.return_value = False
+        handle_device_message(
+            {"BSH.Common.Option.ProgramProgress": 10}, device, client, TOPIC, NAME
+        )
+        assert outbox_for(TOPIC).last_published == {}
+
+
+@patch("hc2mqtt.hcprint")
+class TestRecorder:
+    def test_creates_record_dir(self, _print, tmp_path):
+        record_dir = tmp_path / "recordings"
+        recorder = open_recorder(str(record_dir), NAME)
+        recorder.received('{"sID":1}')
+        close_recorders()
+        assert (record_dir / "TestOven.hcrec").stat().st_size > 0
+
+    def test_unwritable_record_dir(self, _print, tmp_path):
+        blocker = tmp_path / "file"
+        blocker.write_text("")
+        with patch("builtins.print") as mock_print:
+            assert open_recorder(str(blocker / "recordings"), NAME) is None
+        mock_print.assert_called_once()
+
+    def test_not_recording(self, _print):
+        assert open_recorder(None, NAME) is None
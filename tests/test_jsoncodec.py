@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+import jsoncodec
+
+MESSAGE = {
+    "sID": 1834234000,
+    "msgID": 3906210004,
+    "resource": "/ro/values",
+    "version": 1,
+    "action": "NOTIFY",
+    "data": [{"uid": 527, "value": True}, {"uid": 544, "value": "Café"}],
+}
+
+
+@pytest.fixture(params=sorted(jsoncodec.BACKENDS))
+def backend(request):
+    previous = jsoncodec.backend
+    jsoncodec.set_backend(request.param)
+    yield request.param
+    jsoncodec.set_backend(previous)
+
+
+class TestJsonCodec:
+    def test_round_trip(self, backend):
+        assert jsoncodec.loads(jsoncodec.dumps(MESSAGE)) == MESSAGE
+
+    def test_compact_utf8_output(self, backend):
+        assert jsoncodec.dumps_compact({"a": [1, 2], "b": "é"}) == '{"a":[1,2],"b":"é"}'
+
+    def test_mqtt_payload_unchanged(self, backend):
+        assert jsoncodec.dumps(MESSAGE) == json.dumps(MESSAGE)
+        assert jsoncodec.dumps({"event_type": "Off"}) == '{"event_type": "Off"}'
+
+    def test_frame_unchanged(self, backend):
+        assert jsoncodec.dumps_frame(MESSAGE) == json.dumps(MESSAGE, separators=(",", ":"))
+        assert jsoncodec.dumps_frame({"b": "é"}) == '{"b":"\\u00e9"}'
+
+    def test_loads_bytes(self, backend):
+        assert jsoncodec.loads(json.dumps(MESSAGE).encode()) == MESSAGE
+
+    def test_int_keys(self, backend):
+        assert jsoncodec.dumps_compact({527: "On"}) == '{"527":"On"}'
+
+    def test_large_int(self, backend):
+        assert jsoncodec.dumps_compact({"value": 2**70}) == '{"value":%d}' % 2**70
+
+    def test_invalid_json(self, backend):
+        with pytest.raises(ValueError):
+            jsoncodec.loads("{not json")
+
+    def test_backends_agree(self):
+        outputs = {dumps(MESSAGE) for _, dumps in jsoncodec.BACKENDS.values()}
+        assert len(outputs) == 1
+
+    def test_unknown_backend(self):
+        with pytest.raises(ValueError):
+            jsoncodec.set_backend("simplejson")